@@ -4,8 +4,11 @@ class FinGPTClient {
     constructor() {
         this.ws = null;
         this.sessionId = `session_${Date.now()}_${Math.random().toString(36).substr(2, 9)}`;
+        // 浏览器插件弹窗中显示的配对码；只有配对的浏览器会向本会话发送页面并接受其操作
+        this.pairingId = localStorage.getItem('fingptPairingId') || '';
         this.isConnected = false;
         this.messageQueue = [];
+        this.frameDecoder = new TextDecoder();
         
         this.initializeElements();
         this.setupEventListeners();
@@ -18,6 +21,9 @@ class FinGPTClient {
         this.sendBtn = document.getElementById('sendBtn');
         this.clearBtn = document.getElementById('clearBtn');
         this.settingsBtn = document.getElementById('settingsBtn');
+        this.pairingRow = document.getElementById('pairingRow');
+        this.pairingInput = document.getElementById('pairingInput');
+        this.pairingSaveBtn = document.getElementById('pairingSaveBtn');
         this.modelSelect = document.getElementById('modelSelect');
         this.ragCheckbox = document.getElementById('ragCheckbox');
         this.agentCheckbox = document.getElementById('agentCheckbox');
@@ -46,15 +52,23 @@ class FinGPTClient {
         // Clear chat
         this.clearBtn.addEventListener('click', () => this.clearChat());
         
-        // Settings (placeholder)
+        // Settings: 浏览器配对码
         this.settingsBtn.addEventListener('click', () => {
-            alert('Settings panel coming soon!');
+            const hidden = this.pairingRow.style.display === 'none';
+            this.pairingRow.style.display = hidden ? 'flex' : 'none';
+            if (hidden) {
+                this.pairingInput.value = this.pairingId;
+                this.pairingInput.focus();
+            }
         });
+        this.pairingSaveBtn.addEventListener('click', () => this.savePairingId());
     }
     
     connectWebSocket() {
         try {
             this.ws = new WebSocket('ws://localhost:8000/ws/chat/');
+            // 流式内容使用compact二进制帧
+            this.ws.binaryType = 'arraybuffer';
             
             this.ws.onopen = () => {
                 console.log('WebSocket connected');
@@ -62,18 +76,19 @@ class FinGPTClient {
                 this.updateStatus('Connected', 'connected');
                 
                 // Set session ID
-                this.sendWebSocketMessage({
-                    type: 'set_session',
-                    session_id: this.sessionId
-                });
+                this.sendSetSession();
                 
                 // Process queued messages
                 this.processMessageQueue();
             };
             
             this.ws.onmessage = (event) => {
-                const data = JSON.parse(event.data);
-                this.handleWebSocketMessage(data);
+                const data = typeof event.data === 'string'
+                    ? JSON.parse(event.data)
+                    : this.decodeCompactFrame(event.data);
+                if (data) {
+                    this.handleWebSocketMessage(data);
+                }
             };
             
             this.ws.onclose = () => {
@@ -96,6 +111,33 @@ class FinGPTClient {
         }
     }
     
+    sendSetSession() {
+        this.sendWebSocketMessage({
+            type: 'set_session',
+            session_id: this.sessionId,
+            pairing_id: this.pairingId,
+            frame_format: 'compact'
+        });
+    }
+
+    savePairingId() {
+        this.pairingId = this.pairingInput.value.trim().toUpperCase();
+        localStorage.setItem('fingptPairingId', this.pairingId);
+        this.pairingRow.style.display = 'none';
+        this.sendSetSession();
+    }
+
+    decodeCompactFrame(buffer) {
+        // compact帧：首字节为类型代码，其后为UTF-8文本
+        const bytes = new Uint8Array(buffer);
+        const type = { 1: 'stream_content', 2: 'stream_chunk' }[bytes[0]];
+        if (!type) {
+            console.warn('Unknown compact frame code:', bytes[0]);
+            return null;
+        }
+        return { type, content: this.frameDecoder.decode(bytes.subarray(1)) };
+    }
+    
     sendWebSocketMessage(message) {
         if (this.isConnected && this.ws.readyState === WebSocket.OPEN) {
             this.ws.send(JSON.stringify(message));
@@ -115,6 +157,7 @@ class FinGPTClient {
         switch (data.type) {
             case 'session_set':
                 console.log('Session set:', data.session_id);
+                this.updateStatus(data.paired ? 'Connected' : 'Connected (no browser paired)', 'connected');
                 break;
 
             case 'status':
@@ -191,6 +234,14 @@ class FinGPTClient {
                 break;
 
             case 'tool_calling':
+                // 工具调用前已流式显示的文本单独成泡，之后的回复另起新泡
+                if (this.currentStreamMessage) {
+                    const streamContent = this.currentStreamMessage.querySelector('.stream-content');
+                    if (streamContent) {
+                        this.renderMarkdown(streamContent);
+                    }
+                    this.currentStreamMessage = null;
+                }
                 // 显示工具调用状态
                 this.addToolMessage('calling', data.message, data.tool_details);
                 break;
@@ -1,6 +1,9 @@
 from django.apps import AppConfig
+import logging
 import os
 import sys
+import threading
+import time
 
 
 class ApiConfig(AppConfig):
@@ -15,6 +18,29 @@ class ApiConfig(AppConfig):
     #     # Only check when running the development server
     #     if 'runserver' in sys.argv:
     #         self.check_api_keys()
+
+    def ready(self):
+        """
+        Optionally preload the RAG index in the background.
+        Set RAG_WARMUP=1 to enable; RAG_WARMUP_DELAY (seconds, default 2)
+        gives the server time to bind before faiss and the index are loaded.
+        """
+        if os.getenv('RAG_WARMUP', '').lower() not in ('1', 'true', 'yes'):
+            return
+        # The runserver autoreloader parent process never serves requests
+        if 'runserver' in sys.argv and os.environ.get('RUN_MAIN') != 'true':
+            return
+        delay = float(os.getenv('RAG_WARMUP_DELAY', '2'))
+        threading.Thread(target=self.warm_up_rag, args=(delay,), name='rag-warmup', daemon=True).start()
+
+    def warm_up_rag(self, delay):
+        """Import the RAG stack and load the index after `delay` seconds."""
+        time.sleep(delay)
+        try:
+            from datascraper import cdm_rag
+            cdm_rag.warm_up()
+        except Exception as e:
+            logging.warning(f"RAG warm-up failed: {e}")
     
     def check_api_keys(self):
         """Check if at least one valid API key is configured."""
@@ -0,0 +1,312 @@
+"""
+浏览器控制命令的请求/响应关联层。
+每条命令带唯一request_id，经channel layer只发给拥有该会话的插件连接（而不是广播到整个组），
+调用方等待对应回执的Future；超时、连接断开和无人等待的请求都会被清理。
+
+会话归属：
+- 标签页会话：插件在 register 消息中声明其标签页content script的session_id
+- 配对码：插件在 register 中、桌面客户端在 set_session 中携带同一个 pairing_id，
+  聊天会话只绑定到配对码相同的插件连接；没有配对的聊天会话收不到页面信息，
+  同一服务器上的多个浏览器互不可见
+- 插件重连时聊天会话改绑到配对码相同的新连接
+- 标签页与聊天会话新配对时（登记、改绑、聊天连接设置会话），返回需要补发页面快照的配对，
+  因为未变化的页面插件不会再次发送
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10  # 等待插件回执的默认时间（秒）
+SWEEP_GRACE = 5  # 超过截止时间多久后，仍未取走的请求视为被遗弃（秒）
+
+
+class BrowserNotConnected(Exception):
+    """没有可用的浏览器插件连接，或连接在等待回执时断开"""
+
+
+class BrowserCommandTimeout(TimeoutError):
+    """插件未在规定时间内回执"""
+
+
+class _PendingCall:
+    __slots__ = ('future', 'channel_name', 'command_type', 'deadline')
+
+    def __init__(self, future, channel_name, command_type, deadline):
+        self.future = future
+        self.channel_name = channel_name
+        self.command_type = command_type
+        self.deadline = deadline
+
+
+class _Connection:
+    __slots__ = ('tabs', 'clients', 'pairing_id')
+
+    def __init__(self):
+        self.tabs = set()  # 插件声明的标签页会话
+        self.clients = set()  # 绑定到此插件的聊天会话
+        self.pairing_id = None  # 插件的配对码
+
+
+class BrowserRPC:
+    """浏览器插件连接注册表与命令调用"""
+
+    def __init__(self, channel_layer=None, default_timeout=DEFAULT_TIMEOUT):
+        self._channel_layer = channel_layer
+        self.default_timeout = default_timeout
+        # channel_name -> _Connection；最近连接/注册的排在最后
+        self._connections = OrderedDict()
+        self._owners = {}  # session_id -> channel_name
+        self._live_clients = {}  # 在线的聊天会话 -> 连接数
+        self._client_pairing = {}  # 在线的聊天会话 -> 配对码
+        self._pending = {}  # request_id -> _PendingCall
+
+    @property
+    def channel_layer(self):
+        if self._channel_layer is None:
+            self._channel_layer = get_channel_layer()
+        return self._channel_layer
+
+    def register_connection(self, channel_name, session_ids=None, pairing_id=None):
+        """
+        登记插件连接（可重复调用）。
+
+        Args:
+            channel_name: 插件连接的channel
+            session_ids: 插件当前所有标签页的会话；传入时替换之前声明的列表
+            pairing_id: 插件的配对码；传入时替换之前的配对码
+
+        Returns:
+            新配对的 {标签页会话: [聊天会话, ...]}，需要补发这些标签页的页面快照
+        """
+        before = self._all_pairs()
+        connection = self._connections.setdefault(channel_name, _Connection())
+        self._connections.move_to_end(channel_name)
+        if session_ids is not None:
+            tabs = {session_id for session_id in session_ids if session_id}
+            for session_id in connection.tabs - tabs:
+                self._release(session_id, channel_name)
+            for session_id in tabs - connection.tabs:
+                self._bind(session_id, channel_name, tab=True)
+            connection.tabs = tabs
+        if pairing_id is not None and pairing_id != connection.pairing_id:
+            connection.pairing_id = pairing_id or None
+            # 配对码变了，原来绑定的聊天会话不再属于这个插件
+            for session_id in list(connection.clients):
+                self._release(session_id, channel_name)
+        # 配对码相同、尚未绑定插件的在线聊天会话绑定到这个连接
+        for session_id, client_pairing in self._client_pairing.items():
+            if client_pairing is not None and client_pairing == connection.pairing_id \
+                    and self.connection_for(session_id) is None:
+                self._bind(session_id, channel_name)
+        logger.info(f"Browser connection registered: {channel_name} "
+                    f"({len(connection.tabs)} tabs, {len(connection.clients)} chat sessions)")
+        return self._new_pairs(before)
+
+    def unregister_connection(self, channel_name):
+        """
+        移除插件连接，释放其会话，并让发往它的等待中命令立即失败。
+
+        Returns:
+            改绑后新配对的 {标签页会话: [聊天会话, ...]}
+        """
+        before = self._all_pairs()
+        connection = self._connections.pop(channel_name, None)
+        if connection is None:
+            return {}
+        for session_id in connection.tabs | connection.clients:
+            if self._owners.get(session_id) == channel_name:
+                del self._owners[session_id]
+        for request_id, pending in list(self._pending.items()):
+            if pending.channel_name == channel_name and not pending.future.done():
+                pending.future.set_exception(BrowserNotConnected(
+                    f"Browser extension disconnected before replying to {pending.command_type}"
+                ))
+        # 仍在线的聊天会话改绑到配对码相同的其他连接（如插件已重连）
+        paired = self._paired_connection(connection.pairing_id)
+        if paired is not None:
+            for session_id in connection.clients:
+                if session_id in self._live_clients:
+                    self._bind(session_id, paired)
+        logger.info(f"Browser connection unregistered: {channel_name}")
+        return self._new_pairs(before)
+
+    def attach_client(self, session_id, pairing_id=None):
+        """
+        聊天连接设置会话时调用；有配对码相同的插件连接时立即绑定，以便接收其页面信息。
+
+        Returns:
+            新配对的 {标签页会话: [聊天会话, ...]}
+        """
+        before = self._all_pairs()
+        self._live_clients[session_id] = self._live_clients.get(session_id, 0) + 1
+        self._client_pairing[session_id] = pairing_id or None
+        current = self.connection_for(session_id)
+        if current is not None and self._connections[current].pairing_id != self._client_pairing[session_id]:
+            self._release(session_id, current)
+            current = None
+        if current is None:
+            paired = self._paired_connection(self._client_pairing[session_id])
+            if paired is not None:
+                self._bind(session_id, paired)
+        return self._new_pairs(before)
+
+    def detach_client(self, session_id):
+        """聊天连接断开或切换会话时调用"""
+        count = self._live_clients.get(session_id, 0) - 1
+        if count > 0:
+            self._live_clients[session_id] = count
+            return
+        self._live_clients.pop(session_id, None)
+        self._client_pairing.pop(session_id, None)
+        channel_name = self._owners.get(session_id)
+        connection = self._connections.get(channel_name)
+        if connection is not None and session_id in connection.clients:
+            self._release(session_id, channel_name)
+
+    def clients_for(self, tab_session_id):
+        """与某个标签页会话属于同一插件的聊天会话"""
+        connection = self._connections.get(self._owners.get(tab_session_id))
+        return list(connection.clients) if connection is not None else []
+
+    def connection_for(self, session_id):
+        """会话当前绑定的插件连接；未绑定时返回None"""
+        channel_name = self._owners.get(session_id)
+        return channel_name if channel_name in self._connections else None
+
+    def route(self, session_id=None):
+        """
+        选择接收命令的插件连接：只发往与会话配对的插件，不会退而选择其他浏览器。
+
+        Raises:
+            BrowserNotConnected: 会话没有已连接的配对插件
+        """
+        channel_name = self.connection_for(session_id) if session_id else None
+        if channel_name is None:
+            raise BrowserNotConnected(
+                "No browser extension is paired with this chat session; "
+                "enter the extension's pairing code in the desktop app's Settings"
+            )
+        return channel_name
+
+    def _paired_connection(self, pairing_id):
+        """配对码相同的插件连接中最近登记的一个；没有配对码时返回None"""
+        if pairing_id is None:
+            return None
+        for channel_name in reversed(self._connections):
+            if self._connections[channel_name].pairing_id == pairing_id:
+                return channel_name
+        return None
+
+    def _all_pairs(self):
+        return {
+            (tab, client)
+            for connection in self._connections.values()
+            for tab in connection.tabs for client in connection.clients
+        }
+
+    def _new_pairs(self, before):
+        replays = {}
+        for tab, client in self._all_pairs() - before:
+            replays.setdefault(tab, []).append(client)
+        return replays
+
+    def _bind(self, session_id, channel_name, tab=False):
+        previous = self._owners.get(session_id)
+        if previous is not None and previous != channel_name:
+            self._release(session_id, previous)
+        self._owners[session_id] = channel_name
+        connection = self._connections[channel_name]
+        (connection.tabs if tab else connection.clients).add(session_id)
+
+    def _release(self, session_id, channel_name):
+        connection = self._connections.get(channel_name)
+        if connection is not None:
+            connection.tabs.discard(session_id)
+            connection.clients.discard(session_id)
+        if self._owners.get(session_id) == channel_name:
+            del self._owners[session_id]
+
+    async def call(self, command_type, params=None, session_id=None, timeout=None):
+        """
+        向会话所属的插件发送命令并等待回执。
+
+        Args:
+            command_type: 命令类型，如 browser_navigate
+            params: 命令参数
+            session_id: 发起命令的会话
+            timeout: 等待回执的秒数，默认 default_timeout
+
+        Returns:
+            插件的回执消息（dict）
+
+        Raises:
+            BrowserNotConnected: 会话没有配对的插件连接，或等待中连接断开
+            BrowserCommandTimeout: 超时未回执
+        """
+        self.sweep()
+        timeout = self.default_timeout if timeout is None else timeout
+        channel_name = self.route(session_id)
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = _PendingCall(future, channel_name, command_type, time.monotonic() + timeout)
+        try:
+            await self.channel_layer.send(channel_name, {
+                'type': 'browser_command',
+                'data': {**(params or {}), 'type': command_type, 'request_id': request_id}
+            })
+            try:
+                return await asyncio.wait_for(future, timeout=timeout)
+            except asyncio.TimeoutError:
+                raise BrowserCommandTimeout(
+                    f"Browser extension did not reply to {command_type} within {timeout}s"
+                ) from None
+        finally:
+            self._pending.pop(request_id, None)
+
+    def resolve(self, channel_name, reply):
+        """
+        把插件回执交给等待它的调用。
+        只接受发往该连接的请求的回执；未知或过期的request_id返回False。
+        """
+        pending = self._pending.get(reply.get('request_id'))
+        if pending is None or pending.channel_name != channel_name:
+            return False
+        if pending.future.done():
+            return False
+        pending.future.set_result(reply)
+        return True
+
+    def sweep(self):
+        """清理超过截止时间仍未被取走的请求（调用方已不在等待）"""
+        now = time.monotonic()
+        expired = [
+            request_id for request_id, pending in self._pending.items()
+            if now > pending.deadline + SWEEP_GRACE
+        ]
+        for request_id in expired:
+            pending = self._pending.pop(request_id)
+            if not pending.future.done():
+                pending.future.cancel()
+        if expired:
+            logger.info(f"Dropped {len(expired)} abandoned browser command(s)")
+
+    def pending_count(self):
+        return len(self._pending)
+
+
+# 全局实例
+_browser_rpc_instance = None
+
+def get_browser_rpc():
+    """获取全局浏览器RPC实例"""
+    global _browser_rpc_instance
+    if _browser_rpc_instance is None:
+        _browser_rpc_instance = BrowserRPC()
+    return _browser_rpc_instance
@@ -2,16 +2,254 @@
 内置工具系统 - 不依赖MCP，直接集成到FinGPT中
 """
 import json
-import re
 import asyncio
 import logging
 import uuid
 from typing import Dict, Any, List, Optional
-from channels.layers import get_channel_layer
-from urllib.parse import urlparse
+from .browser_rpc import BrowserCommandTimeout, BrowserNotConnected, get_browser_rpc
+from .page_cache import PageCache
 
 logger = logging.getLogger(__name__)
 
+# 原生工具调用模式使用的结构化定义，与 get_tool_definitions() 的文字说明对应
+TOOL_SCHEMAS = {
+    'browser_navigate': {
+        'description': "Navigate to a URL in the user's browser and return the page title, URL, content and a page_id.",
+        'parameters': {
+            'type': 'object',
+            'properties': {'url': {'type': 'string', 'description': 'URL to open'}},
+            'required': ['url'],
+        },
+    },
+    'browser_info': {
+        'description': 'Get information about a page by page_id, or about the active page if page_id is omitted.',
+        'parameters': {
+            'type': 'object',
+            'properties': {'page_id': {'type': 'string', 'description': 'page_id returned by browser_navigate'}},
+        },
+    },
+    'browser_press_key': {
+        'description': "Press a key in the user's browser.",
+        'parameters': {
+            'type': 'object',
+            'properties': {'key': {'type': 'string', 'description': 'Key name, e.g. "Enter"'}},
+            'required': ['key'],
+        },
+    },
+    'browser_type': {
+        'description': "Type text in the user's browser.",
+        'parameters': {
+            'type': 'object',
+            'properties': {'text': {'type': 'string', 'description': 'Text to type'}},
+            'required': ['text'],
+        },
+    },
+    'browser_click': {
+        'description': "Click an element in the user's browser.",
+        'parameters': {
+            'type': 'object',
+            'properties': {'selector': {'type': 'string', 'description': 'CSS selector of the element'}},
+            'required': ['selector'],
+        },
+    },
+}
+
+# 等待插件导航完成回执的最长时间（秒）；插件自身在25秒后带当前内容回执
+NAVIGATE_TIMEOUT = 30
+
+
+def _session_of(websocket_consumer) -> Optional[str]:
+    """发起工具调用的聊天会话，用于把命令发给该会话所属的浏览器"""
+    return getattr(websocket_consumer, 'session_id', None)
+
+
+TOOL_CALL_OPEN = '<tool_call>'
+TOOL_CALL_CLOSE = '</tool_call>'
+
+
+class ToolCallStreamParser:
+    """
+    增量解析流式输出中的工具调用。
+    普通文本立即产出；只有 <tool_call> 块内的内容（以及可能是开始标签前缀的末尾字符）会被暂存。
+    块内JSON一闭合就产出工具调用，不必等到 </tool_call> 或整轮输出结束。
+    JSON的结束位置按括号和字符串扫描确定，字符串参数中出现的 </tool_call> 不会提前结束调用。
+    模型漏写 </tool_call> 时，JSON之后的内容在下一个块开始或输出结束时按普通文本产出。
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._in_block = False
+        self._dispatched = False  # 当前块的JSON是否已处理
+
+    def feed(self, text: str) -> List[tuple]:
+        """
+        输入一段增量，返回事件列表：
+        ('text', str) 普通文本；('tool_call', dict) 完整的工具调用
+        """
+        self._buffer += text
+        events = []
+        while self._buffer:
+            if not self._in_block:
+                start = self._buffer.find(TOOL_CALL_OPEN)
+                if start >= 0:
+                    if start:
+                        events.append(('text', self._buffer[:start]))
+                    self._buffer = self._buffer[start + len(TOOL_CALL_OPEN):]
+                    self._in_block = True
+                    self._dispatched = False
+                    continue
+                # 末尾可能是被截断的开始标签，暂存
+                keep = self._partial_tag_length(self._buffer)
+                if len(self._buffer) > keep:
+                    events.append(('text', self._buffer[:len(self._buffer) - keep]))
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                break
+
+            if not self._dispatched:
+                body = self._buffer.lstrip()
+                if body.startswith('{'):
+                    json_end, close_at = self._scan_json(body)
+                else:
+                    json_end, close_at = None, body.find(TOOL_CALL_CLOSE)
+                if json_end is None:
+                    if close_at < 0:
+                        break  # JSON尚未完整
+                    # JSON之外出现结束标签：块内容不是合法的工具调用
+                    logger.error(f"Failed to parse tool call JSON: {body[:close_at].strip()[:200]}")
+                    self._buffer = body[close_at + len(TOOL_CALL_CLOSE):]
+                    self._in_block = False
+                    continue
+                self._dispatched = True
+                # 只保留JSON之后的内容
+                self._buffer = body[json_end:]
+                tool_call = self._decode(body[:json_end])
+                if tool_call is not None:
+                    logger.info(f"Parsed tool call: {tool_call['tool']}")
+                    events.append(('tool_call', tool_call))
+            end = self._buffer.find(TOOL_CALL_CLOSE)
+            if self._dispatched:
+                start = self._buffer.find(TOOL_CALL_OPEN)
+                if start >= 0 and (end < 0 or start < end):
+                    # 缺少结束标签且下一个块已开始：JSON之后的内容按普通文本处理
+                    self._in_block = False
+                    continue
+            if end < 0:
+                break
+            self._buffer = self._buffer[end + len(TOOL_CALL_CLOSE):]
+            self._in_block = False
+        return events
+
+    def finish(self) -> List[tuple]:
+        """输出结束：暂存的普通文本原样产出；未闭合的块中已产出调用的JSON之后的内容作为文本产出，未解析的块丢弃"""
+        events = []
+        if self._in_block:
+            if not self._dispatched:
+                logger.error("Unterminated tool call block at end of response")
+            elif self._buffer.strip():
+                events.append(('text', self._buffer.lstrip()))
+        elif self._buffer:
+            events.append(('text', self._buffer))
+        self._buffer = ''
+        self._in_block = False
+        return events
+
+    @staticmethod
+    def _scan_json(body: str) -> tuple:
+        """
+        扫描以 { 开头的块内容，返回 (JSON结束位置, 字符串外结束标签位置)。
+        JSON闭合时返回 (结束位置, -1)；未闭合时返回 (None, 字符串外第一个结束标签的位置或-1)。
+        """
+        depth = 0
+        in_string = False
+        escaped = False
+        for i, ch in enumerate(body):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    return i + 1, -1
+            elif ch == '<' and body.startswith(TOOL_CALL_CLOSE, i):
+                return None, i
+        return None, -1
+
+    @staticmethod
+    def _decode(text: str):
+        """解析闭合的JSON对象；不是合法的工具调用时记录错误并返回None"""
+        try:
+            tool_call = json.loads(text)
+        except json.JSONDecodeError:
+            logger.error(f"Failed to parse tool call JSON: {text.strip()[:200]}")
+            return None
+        if not isinstance(tool_call, dict) or 'tool' not in tool_call or 'parameters' not in tool_call:
+            logger.error(f"Tool call missing tool/parameters: {tool_call}")
+            return None
+        return tool_call
+
+    @staticmethod
+    def _partial_tag_length(text: str) -> int:
+        """text末尾与开始标签前缀重合的长度"""
+        for length in range(min(len(text), len(TOOL_CALL_OPEN) - 1), 0, -1):
+            if TOOL_CALL_OPEN.startswith(text[-length:]):
+                return length
+        return 0
+
+
+class ToolScheduler:
+    """
+    一轮Agent对话中的工具调度器。
+    修改浏览器状态的工具（点击、输入、按键、导航）严格按调用顺序执行；
+    只读工具只需等待之前的修改型工具，彼此之间以及与模型生成并发执行。
+    结果按调用顺序通过 runs 取回。
+    """
+
+    def __init__(self, manager, websocket_consumer=None):
+        self.manager = manager
+        self.websocket_consumer = websocket_consumer
+        self.runs: List[tuple] = []  # [(tool_call, task)]，按调用顺序
+        self._last_write: Optional[asyncio.Task] = None  # 最近的修改型工具
+        self._reads_since_write: List[asyncio.Task] = []  # 其后启动的只读工具
+
+    def __bool__(self) -> bool:
+        return bool(self.runs)
+
+    def submit(self, tool_call: Dict[str, Any]) -> asyncio.Task:
+        """提交工具调用，立即开始（或排队等待依赖）执行"""
+        tool_name = tool_call['tool']
+        depends_on = [self._last_write] if self._last_write is not None else []
+        if self.manager.is_read_only(tool_name):
+            task = asyncio.create_task(self._run(depends_on, tool_name, tool_call['parameters']))
+            self._reads_since_write.append(task)
+        else:
+            # 修改型工具还要等之前的只读工具读完，保证它们看到的是修改前的页面
+            depends_on += self._reads_since_write
+            task = asyncio.create_task(self._run(depends_on, tool_name, tool_call['parameters']))
+            self._last_write = task
+            self._reads_since_write = []
+        self.runs.append((tool_call, task))
+        return task
+
+    async def _run(self, depends_on, tool_name, parameters):
+        if depends_on:
+            await asyncio.wait(depends_on)
+        return await self.manager.execute_tool(tool_name, parameters, self.websocket_consumer)
+
+    def cancel(self) -> None:
+        """取消尚未完成的工具执行"""
+        for _, task in self.runs:
+            if not task.done():
+                task.cancel()
+
+
 class BuiltinToolManager:
     """内置工具管理器"""
     
@@ -23,7 +261,11 @@ class BuiltinToolManager:
             'browser_click': self.browser_click,
             'browser_info': self.browser_info,
         }
-        self.channel_layer = get_channel_layer()
+        # 只读工具（不改变浏览器状态），可与其他只读工具并发执行
+        self.read_only_tools = {'browser_info'}
+
+    def is_read_only(self, tool_name: str) -> bool:
+        return tool_name in self.read_only_tools
     
     def get_tool_definitions(self) -> str:
         """获取工具定义，用于AI提示词"""
@@ -71,26 +313,14 @@ Important:
 - After calling a tool, wait for the result before continuing
 """
 
-    def parse_tool_calls(self, text: str) -> List[Dict[str, Any]]:
-        """从AI响应中解析工具调用"""
-        tool_calls = []
-        
-        # 使用正则表达式查找工具调用
-        pattern = r'<tool_call>\s*(\{.*?\})\s*</tool_call>'
-        matches = re.findall(pattern, text, re.DOTALL)
-        
-        for match in matches:
-            try:
-                tool_call = json.loads(match)
-                if 'tool' in tool_call and 'parameters' in tool_call:
-                    tool_calls.append(tool_call)
-                    logger.info(f"Parsed tool call: {tool_call['tool']}")
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse tool call JSON: {e}")
-                continue
-        
-        return tool_calls
-    
+    def get_tool_schemas(self) -> List[Dict[str, Any]]:
+        """获取结构化工具定义（JSON Schema），用于模型原生的工具调用接口"""
+        return [
+            {'name': name, **TOOL_SCHEMAS[name]}
+            for name in self.tools
+            if name in TOOL_SCHEMAS
+        ]
+
     async def execute_tool(self, tool_name: str, parameters: Dict[str, Any], websocket_consumer=None) -> Dict[str, Any]:
         """执行工具调用"""
         if tool_name not in self.tools:
@@ -117,132 +347,31 @@ Important:
             }
     
     async def browser_navigate(self, parameters: Dict[str, Any], websocket_consumer=None) -> Dict[str, Any]:
-        """浏览器导航工具 - 通过Chrome插件执行，导航后自动获取页面信息"""
+        """
+        浏览器导航工具 - 通过Chrome插件执行。
+        插件在页面加载完成后回执，并在同一回执中带上页面内容，
+        耗时等于实际页面加载时间。
+        """
         url = parameters.get('url')
         if not url:
             raise ValueError("URL parameter is required")
 
         try:
-            # 清除旧的页面信息，强制获取新页面信息
-            if websocket_consumer and hasattr(websocket_consumer, 'page_responses'):
-                old_count = len(websocket_consumer.page_responses)
-                websocket_consumer.page_responses = []  # 清空旧的页面信息
-                logger.info(f"Cleared {old_count} old page responses before navigation")
-
-            # 发送导航命令
-            await self.channel_layer.group_send("browser_control", {
-                "type": "browser_command",
-                "data": {
-                    "type": "browser_navigate",
-                    "url": url
-                }
-            })
-
-            # 等待页面加载和页面信息更新 - 分段等待以避免阻塞
-            logger.info(f"Waiting for page to load and WebSocket to reconnect...")
-
-            # 分段等待，每秒让出控制权 - 缩短到2秒
-            for _ in range(2):
-                await asyncio.sleep(1)
-                # 让出控制权，允许处理其他消息
-                await asyncio.sleep(0)
-
-            # 从websocket_consumer获取最新的页面信息（使用现有的页面信息机制）
-            if websocket_consumer and hasattr(websocket_consumer, 'get_active_page_info'):
-                page_info = websocket_consumer.get_active_page_info()
-
-                # 检查页面信息是否匹配目标URL
-                if page_info and page_info.get('content'):
-                    page_url = page_info.get('url', '')
-
-                    # 检查URL是否匹配（考虑重定向）
-                    target_domain = urlparse(url).netloc
-                    page_domain = urlparse(page_url).netloc
-
-                    logger.info(f"Checking URL match: target={target_domain}, page={page_domain}")
-
-                    # 如果域名匹配或者是合理的重定向，使用页面信息
-                    # 更宽松的匹配逻辑
-                    domain_match = (
-                        target_domain in page_domain or
-                        page_domain in target_domain or
-                        target_domain.replace('www.', '') == page_domain.replace('www.', '') or
-                        any(keyword in page_domain.lower() for keyword in ['yahoo', 'finance', 'bilibili', 'httpbin', 'duckduckgo'])
-                    )
-
-                    if domain_match:
-                        # 处理页面内容，确保不会太长
-                        content = page_info.get('content', '')
-                        if len(content) > 3000:
-                            content = content[:3000] + '...'
-
-                        # 生成页面ID
-                        page_id = f"page_{str(uuid.uuid4())[:8]}"
-
-                        # 存储页面信息到websocket_consumer（如果可用）
-                        if websocket_consumer:
-                            if not hasattr(websocket_consumer, 'page_cache'):
-                                websocket_consumer.page_cache = {}
-                            websocket_consumer.page_cache[page_id] = page_info
-
-                        logger.info(f"Successfully matched page: {page_info.get('title', 'Unknown')}")
-                        return {
-                            'action': 'navigate',
-                            'url': url,
-                            'status': 'completed',
-                            'title': page_info.get('title', 'Unknown Title'),
-                            'final_url': page_info.get('url', url),
-                            'content': content,
-                            'timestamp': page_info.get('timestamp', ''),
-                            'page_id': page_id,
-                            'message': f'Successfully navigated to {url} and retrieved page information: {page_info.get("title", "Unknown")} (Page ID: {page_id})'
-                        }
-                    else:
-                        logger.warning(f"Page URL mismatch: expected {url}, got {page_url}")
-
-                # 如果页面信息不匹配，再等待一下
-                await asyncio.sleep(3)
-                page_info = websocket_consumer.get_active_page_info()
-
-                if page_info and page_info.get('content'):
-                    page_url = page_info.get('url', '')
-                    target_domain = urlparse(url).netloc
-                    page_domain = urlparse(page_url).netloc
-
-                    if target_domain in page_domain or page_domain in target_domain:
-                        content = page_info.get('content', '')
-                        if len(content) > 3000:
-                            content = content[:3000] + '...'
-
-                        # 生成页面ID
-                        page_id = f"page_{str(uuid.uuid4())[:8]}"
-
-                        # 存储页面信息到websocket_consumer（如果可用）
-                        if websocket_consumer:
-                            if not hasattr(websocket_consumer, 'page_cache'):
-                                websocket_consumer.page_cache = {}
-                            websocket_consumer.page_cache[page_id] = page_info
-
-                        return {
-                            'action': 'navigate',
-                            'url': url,
-                            'status': 'completed',
-                            'title': page_info.get('title', 'Unknown Title'),
-                            'final_url': page_info.get('url', url),
-                            'content': content,
-                            'timestamp': page_info.get('timestamp', ''),
-                            'page_id': page_id,
-                            'message': f'Successfully navigated to {url} and retrieved page information: {page_info.get("title", "Unknown")} (Page ID: {page_id})'
-                        }
-
-            # 如果没有获取到页面信息，返回基本的导航成功信息
+            reply = await get_browser_rpc().call(
+                'browser_navigate', {'url': url},
+                session_id=_session_of(websocket_consumer), timeout=NAVIGATE_TIMEOUT
+            )
+        except BrowserCommandTimeout:
+            logger.warning(f"Timed out after {NAVIGATE_TIMEOUT}s waiting for navigation to {url}")
             return {
                 'action': 'navigate',
                 'url': url,
-                'status': 'completed',
-                'message': f'Successfully navigated to {url}. Page information will be available shortly.'
+                'status': 'failed',
+                'message': f'Timed out waiting for {url} to load. Is the browser extension connected?'
             }
-
+        except BrowserNotConnected:
+            # 没有配对的浏览器：工具调用失败，而不是操作别人的浏览器
+            raise
         except Exception as e:
             logger.error(f"Failed to navigate: {e}")
             return {
@@ -251,66 +380,110 @@ Important:
                 'status': 'failed',
                 'message': f'Failed to navigate: {str(e)}'
             }
-    
-    async def browser_press_key(self, parameters: Dict[str, Any], websocket_consumer=None) -> Dict[str, Any]:
-        """按键工具"""
-        key = parameters.get('key')
-        if not key:
-            raise ValueError("Key parameter is required")
-
-        try:
-            await self.channel_layer.group_send("browser_control", {
-                "type": "browser_command",
-                "data": {
-                    "type": "browser_press_key",
-                    "key": key
-                }
-            })
 
+        if not reply.get('success'):
             return {
-                'action': 'press_key',
-                'key': key,
-                'status': 'completed',
-                'message': f'Successfully sent key press command: {key}'
+                'action': 'navigate',
+                'url': url,
+                'status': 'failed',
+                'message': f'Failed to navigate: {reply.get("error", "unknown error")}'
             }
+
+        page_info = reply.get('pageInfo') or {}
+        if reply.get('timed_out'):
+            logger.warning(f"Page {url} did not finish loading; using its current content")
+
+        # 新页面成为当前活跃页面
+        page_entry = {
+            'url': page_info.get('url', url),
+            'content': page_info.get('content', ''),
+            'title': page_info.get('title', ''),
+            'session_id': None,
+            'timestamp': page_info.get('timestamp'),
+            'is_active': True
+        }
+        if websocket_consumer is not None:
+            if not hasattr(websocket_consumer, 'page_responses'):
+                websocket_consumer.page_responses = PageCache()
+            websocket_consumer.page_responses.clear()
+            websocket_consumer.page_responses.put(page_entry['url'], page_entry)
+
+        # 生成页面ID并缓存页面信息
+        page_id = f"page_{str(uuid.uuid4())[:8]}"
+        if websocket_consumer is not None:
+            if not hasattr(websocket_consumer, 'page_cache'):
+                websocket_consumer.page_cache = PageCache(background_ttl=None)
+            websocket_consumer.page_cache.put(page_id, page_entry)
+
+        # 处理页面内容，确保不会太长
+        content = page_entry['content']
+        if len(content) > 3000:
+            content = content[:3000] + '...'
+
+        logger.info(f"Navigation to {url} finished: {page_entry['title'] or 'Unknown'}")
+        return {
+            'action': 'navigate',
+            'url': url,
+            'status': 'completed',
+            'title': page_entry['title'] or 'Unknown Title',
+            'final_url': page_entry['url'],
+            'content': content,
+            'timestamp': page_entry['timestamp'] or '',
+            'page_id': page_id,
+            'message': f'Successfully navigated to {url} and retrieved page information: {page_entry["title"] or "Unknown"} (Page ID: {page_id})'
+        }
+
+    async def _browser_action(self, action: str, command_type: str, params: Dict[str, Any],
+                              websocket_consumer, description: str) -> Dict[str, Any]:
+        """向插件发送一个页面操作命令，按插件回执报告成功或失败"""
+        try:
+            reply = await get_browser_rpc().call(
+                command_type, params, session_id=_session_of(websocket_consumer)
+            )
+        except BrowserNotConnected:
+            raise
         except Exception as e:
-            logger.error(f"Failed to send key press command: {e}")
+            logger.error(f"Failed to {description}: {e}")
             return {
-                'action': 'press_key',
-                'key': key,
+                'action': action,
+                **params,
                 'status': 'failed',
-                'message': f'Failed to send key press command: {str(e)}'
+                'message': f'Failed to {description}: {str(e)}'
             }
-    
+
+        if not reply.get('success'):
+            return {
+                'action': action,
+                **params,
+                'status': 'failed',
+                'message': f'Failed to {description}: {reply.get("error", "unknown error")}'
+            }
+        return {
+            'action': action,
+            **params,
+            'status': 'completed',
+            'message': reply.get('message') or f'Successfully completed: {description}'
+        }
+
+    async def browser_press_key(self, parameters: Dict[str, Any], websocket_consumer=None) -> Dict[str, Any]:
+        """按键工具"""
+        key = parameters.get('key')
+        if not key:
+            raise ValueError("Key parameter is required")
+
+        return await self._browser_action(
+            'press_key', 'browser_press_key', {'key': key}, websocket_consumer, f'press key {key}'
+        )
+
     async def browser_type(self, parameters: Dict[str, Any], websocket_consumer=None) -> Dict[str, Any]:
         """输入文本工具"""
         text = parameters.get('text')
         if not text:
             raise ValueError("Text parameter is required")
 
-        try:
-            await self.channel_layer.group_send("browser_control", {
-                "type": "browser_command",
-                "data": {
-                    "type": "browser_type",
-                    "text": text
-                }
-            })
-
-            return {
-                'action': 'type',
-                'text': text,
-                'status': 'completed',
-                'message': f'Successfully sent type command: {text}'
-            }
-        except Exception as e:
-            logger.error(f"Failed to send type command: {e}")
-            return {
-                'action': 'type',
-                'text': text,
-                'status': 'failed',
-                'message': f'Failed to send type command: {str(e)}'
-            }
+        return await self._browser_action(
+            'type', 'browser_type', {'text': text}, websocket_consumer, f'type {text}'
+        )
 
     async def browser_click(self, parameters: Dict[str, Any], websocket_consumer=None) -> Dict[str, Any]:
         """点击工具"""
@@ -318,29 +491,9 @@ Important:
         if not selector:
             raise ValueError("Selector parameter is required")
 
-        try:
-            await self.channel_layer.group_send("browser_control", {
-                "type": "browser_command",
-                "data": {
-                    "type": "browser_click",
-                    "selector": selector
-                }
-            })
-
-            return {
-                'action': 'click',
-                'selector': selector,
-                'status': 'completed',
-                'message': f'Successfully sent click command for: {selector}'
-            }
-        except Exception as e:
-            logger.error(f"Failed to send click command: {e}")
-            return {
-                'action': 'click',
-                'selector': selector,
-                'status': 'failed',
-                'message': f'Failed to send click command: {str(e)}'
-            }
+        return await self._browser_action(
+            'click', 'browser_click', {'selector': selector}, websocket_consumer, f'click {selector}'
+        )
 
     async def browser_info(self, parameters: Dict[str, Any], websocket_consumer=None) -> Dict[str, Any]:
         """获取页面信息工具 - 支持通过page_id获取特定页面信息"""
@@ -1,37 +1,108 @@
 import json
 import asyncio
 import logging
+import re
 import time
+from contextlib import aclosing
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from datascraper.r2c_context_manager import R2CContextManager
+from datascraper.r2c_context_manager import get_r2c_manager
 from datascraper.models_config import MODELS_CONFIG
-from datascraper import datascraper as ds
-from datascraper import cdm_rag
+from .browser_rpc import get_browser_rpc
+from .page_cache import PageCache
+from .page_sync import PageDeltaError, apply_line_ops, decode_page_frame, page_text_hash
+from .stream_coalescer import StreamCoalescer, FRAME_FORMATS, FRAME_FORMAT_JSON
+from .native_tools import TOOL_MODES, TOOL_MODE_NATIVE, build_agent_prompt, default_tool_mode, make_tool_adapter
 import openai
 import os
 
 logger = logging.getLogger(__name__)
 
+MAX_AGENT_ITERATIONS = 5  # 最大工具调用轮数
+MAX_PAGE_SNAPSHOTS = 16  # 每个连接保留的导航页面快照数
+SUMMARY_REQUEST = "Please provide a comprehensive summary of what you accomplished and answer the original question."
+
+def session_group(session_id):
+    """聊天会话专属的channel layer组，页面信息只发给该会话（组名仅允许字母数字、-、_、.）"""
+    return 'chat_session.' + re.sub(r'[^0-9A-Za-z_.-]', '_', session_id)[:80]
+
+def tab_group(tab_session_id):
+    """标签页会话专属的channel layer组，用于请求该标签页的页面快照"""
+    return 'page_tab.' + re.sub(r'[^0-9A-Za-z_.-]', '_', tab_session_id)[:80]
+
+async def request_page_snapshots(channel_layer, replays):
+    """
+    请求标签页把最近的页面快照补发给新配对的聊天会话。
+    插件不会重复发送未变化的页面，之后才配对的聊天会话只能通过补发获得页面内容。
+
+    Args:
+        replays: {标签页会话: [聊天会话, ...]}
+    """
+    for tab_session_id, chat_sessions in replays.items():
+        await channel_layer.group_send(tab_group(tab_session_id), {
+            'type': 'request_page_info',
+            'chat_sessions': list(chat_sessions)
+        })
+
+# 按 (provider, api_key, base_url) 复用异步客户端，共享连接池
+_async_clients = {}
+
+def get_async_client(api_key, base_url=None, provider='openai'):
+    """获取共享的异步客户端（Anthropic或OpenAI兼容）"""
+    key = (provider, api_key, base_url)
+    client = _async_clients.get(key)
+    if client is None:
+        if provider == 'anthropic':
+            import anthropic
+            client = anthropic.AsyncAnthropic(api_key=api_key)
+        else:
+            client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
+        _async_clients[key] = client
+    return client
+
+async def stream_chat_completion(client, model_config, messages):
+    """
+    流式调用模型，逐个产出文本增量。
+    使用异步客户端，等待网络数据时让出事件循环，其他连接不会被阻塞。
+    """
+    stream = await client.chat.completions.create(
+        model=model_config['model_name'],
+        messages=messages,
+        max_tokens=model_config.get('max_tokens', 2000),
+        temperature=model_config.get('temperature', 0.7),
+        stream=True
+    )
+    try:
+        async for chunk in stream:
+            if chunk.choices:
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield content
+    finally:
+        # 提前结束（如用户停止生成）时释放HTTP连接
+        await stream.close()
+
 class ChatConsumer(AsyncWebsocketConsumer):
     """处理聊天WebSocket连接"""
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.session_id = None
-        self.r2c_manager = R2CContextManager()
+        self.pairing_id = None  # 与浏览器插件共享的配对码
+        self.r2c_manager = get_r2c_manager()  # 进程级共享，重连后按session_id恢复上下文
         self.current_page_info = None  # 当前页面信息（按需获取）
+        self.page_responses = PageCache()  # 浏览器页面信息，按URL索引
+        self.page_cache = PageCache(max_entries=MAX_PAGE_SNAPSHOTS, background_ttl=None)  # 导航工具返回的页面，按page_id索引
         self.stop_generation = False  # 停止生成标志
+        self.frame_format = FRAME_FORMAT_JSON  # 流式帧格式，客户端可选compact
 
     async def connect(self):
-        # 加入聊天组以接收页面信息
-        await self.channel_layer.group_add("chat_clients", self.channel_name)
         await self.accept()
-        logger.info(f"Chat WebSocket connected - Channel: {self.channel_name} - Added to chat_clients group")
+        logger.info(f"Chat WebSocket connected - Channel: {self.channel_name}")
 
     async def disconnect(self, close_code):
-        # 离开聊天组
-        await self.channel_layer.group_discard("chat_clients", self.channel_name)
+        # 离开会话组
+        await self.leave_session()
         logger.info(f"Chat WebSocket disconnected: {close_code}")
         
     async def receive(self, text_data):
@@ -54,13 +125,34 @@ class ChatConsumer(AsyncWebsocketConsumer):
             }))
             
     async def handle_set_session(self, data):
-        """设置会话ID"""
-        self.session_id = data.get('session_id', 'default_session')
+        """设置会话ID，并加入该会话的组以接收配对浏览器的页面信息"""
+        session_id = data.get('session_id', 'default_session')
+        pairing_id = data.get('pairing_id') or None
+        if session_id != self.session_id or pairing_id != self.pairing_id:
+            await self.leave_session()
+            self.session_id = session_id
+            self.pairing_id = pairing_id
+            await self.channel_layer.group_add(session_group(session_id), self.channel_name)
+            # 绑定到配对码相同的插件，并补发其已打开标签页的页面
+            replays = get_browser_rpc().attach_client(session_id, pairing_id)
+            await request_page_snapshots(self.channel_layer, replays)
+        # 可选：compact二进制帧格式
+        frame_format = data.get('frame_format')
+        if frame_format in FRAME_FORMATS:
+            self.frame_format = frame_format
         await self.send(text_data=json.dumps({
             'type': 'session_set',
-            'session_id': self.session_id
+            'session_id': self.session_id,
+            'paired': get_browser_rpc().connection_for(self.session_id) is not None,
+            'frame_format': self.frame_format
         }))
 
+    async def leave_session(self):
+        if self.session_id is None:
+            return
+        await self.channel_layer.group_discard(session_group(self.session_id), self.channel_name)
+        get_browser_rpc().detach_client(self.session_id)
+
     async def handle_stop_generation(self, data):
         """处理停止生成请求"""
         # 设置停止标志
@@ -81,6 +173,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         models = data.get('models', ['gpt-3.5-turbo'])
         use_rag = data.get('use_rag', False)
         use_agent = data.get('use_agent', False)  # 新增agent模式
+        tool_mode = data.get('tool_mode')  # agent工具调用方式：prompt 或 native
 
         if not question:
             await self.send(text_data=json.dumps({
@@ -98,7 +191,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         try:
             if use_agent:
                 # 使用Agent模式（MCP工具调用）
-                await self.get_agent_response_stream(question, models)
+                await self.get_agent_response_stream(question, models, tool_mode)
             else:
                 # 直接使用最新的页面信息（来自定时更新）
                 # 获取AI响应（流式）
@@ -124,10 +217,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'is_active': event.get('is_active', False)
         }
 
-        # 添加到响应列表
-        if not hasattr(self, 'page_responses'):
-            self.page_responses = []
-        self.page_responses.append(page_info)
+        # 同一URL只保留最新的响应
+        self.page_responses.put(page_info['url'], page_info)
 
         active_status = "🟢 ACTIVE" if page_info['is_active'] else "⚪ background"
         logger.info(f"Page info response received: {event['url'][:50]}... ({active_status})")
@@ -145,27 +236,17 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'is_active': event.get('is_active', False)
         }
 
-        # 更新或添加到页面响应列表
-        if not hasattr(self, 'page_responses'):
-            self.page_responses = []
-
-        # 查找是否已存在相同URL的页面信息
-        existing_index = -1
-        for i, existing_page in enumerate(self.page_responses):
-            if existing_page['url'] == page_info['url']:
-                existing_index = i
-                break
-
-        if existing_index >= 0:
-            # 更新现有页面信息
-            self.page_responses[existing_index] = page_info
-        else:
-            # 添加新页面信息
-            self.page_responses.append(page_info)
+        # 更新或添加页面信息（按URL索引）
+        self.page_responses.put(page_info['url'], page_info)
 
         active_status = "🟢 ACTIVE" if page_info['is_active'] else "⚪ background"
         logger.info(f"Page info updated: {event['url'][:50]}... ({active_status})")
 
+    async def page_info_touch(self, event):
+        """页面未变化的定期通知：刷新缓存，页面已过期或被淘汰时请求标签页补发"""
+        if not self.page_responses.touch(event['url']):
+            await request_page_snapshots(self.channel_layer, {event['session_id']: [self.session_id]})
+
     async def page_navigation_signal(self, event):
         """处理页面导航信号"""
         url = event['url']
@@ -176,37 +257,27 @@ class ChatConsumer(AsyncWebsocketConsumer):
         logger.info(f"Received page navigation signal: {url}")
 
         # 清除旧的页面信息，为新页面做准备
-        if hasattr(self, 'page_responses'):
-            old_count = len(self.page_responses)
-            self.page_responses = []
-            logger.info(f"Cleared {old_count} old page responses due to navigation to {url}")
+        old_count = len(self.page_responses)
+        self.page_responses.clear()
+        logger.info(f"Cleared {old_count} old page responses due to navigation to {url}")
 
     def get_active_page_info(self):
         """获取当前活跃页面信息"""
-        if not hasattr(self, 'page_responses') or not self.page_responses:
-            return None
-
-        # 优先选择active页面
-        active_pages = [page for page in self.page_responses if page.get('is_active', False)]
-        if active_pages:
-            # 如果有多个active页面，选择最新的
-            return max(active_pages, key=lambda x: x.get('timestamp', 0))
-
-        # 如果没有active页面，选择最新的响应
-        return max(self.page_responses, key=lambda x: x.get('timestamp', 0))
+        # 优先选择最近更新的active页面，否则选择最新的响应
+        return self.page_responses.active()
 
     async def get_ai_response_stream(self, question, models, use_rag):
         """获取AI响应（流式）"""
         try:
             session_id = self.session_id or 'default_session'
 
-            # 准备上下文
-            context_messages = await database_sync_to_async(self.r2c_manager.prepare_context_messages)(session_id)
+            # 选择模型
+            model_name = models[0] if models else 'deepseek-chat'
 
             # 构建页面上下文（使用最新的定时更新数据）
             enhanced_question = question
             active_page = self.get_active_page_info()
-            logger.info(f"Available page responses: {len(getattr(self, 'page_responses', []))}")
+            logger.info(f"Available page responses: {len(self.page_responses)}")
             if active_page and active_page['content']:
                 page_context = f"""
 Current Page Information:
@@ -221,11 +292,10 @@ User Question: {question}
             else:
                 logger.info("No active page info available, using question only")
 
-            # 添加用户消息到R2C上下文
+            # 先添加用户消息，再按模型的token上限打包上下文，问题（含页面内容）计入预算
             await database_sync_to_async(self.r2c_manager.add_message)(session_id, "user", enhanced_question)
+            context_messages = await database_sync_to_async(self.r2c_manager.prepare_context_messages)(session_id, model_name)
 
-            # 选择模型
-            model_name = models[0] if models else 'deepseek-chat'
             model_config = MODELS_CONFIG.get(model_name)
 
             if not model_config:
@@ -241,8 +311,8 @@ User Question: {question}
             if not api_key:
                 raise ValueError(f"API key not found for provider {provider}")
 
-            # 构建消息
-            messages = context_messages + [{"role": "user", "content": enhanced_question}]
+            # 构建消息（上下文的最后一条即当前问题）
+            messages = context_messages
 
             # 发送流式响应开始标记
             await self.send(text_data=json.dumps({
@@ -252,6 +322,8 @@ User Question: {question}
 
             if use_rag:
                 # RAG模式暂时不支持流式，直接返回结果
+                # RAG模块按需导入（faiss/numpy加载较慢）
+                from datascraper import cdm_rag
                 rag_response = await database_sync_to_async(cdm_rag.get_rag_response)(question, model_name)
                 await self.send(text_data=json.dumps({
                     'type': 'stream_content',
@@ -259,38 +331,16 @@ User Question: {question}
                 }))
                 full_response = rag_response
             else:
-                # 流式调用模型
-                import openai
-                client = openai.OpenAI(
-                    api_key=api_key,
-                    base_url=provider_config.get('base_url')
-                )
+                # 流式调用模型（异步客户端，不阻塞事件循环）
+                client = get_async_client(api_key, provider_config.get('base_url'))
 
                 full_response = ""
-                stream = client.chat.completions.create(
-                    model=model_config['model_name'],
-                    messages=messages,
-                    max_tokens=model_config.get('max_tokens', 2000),
-                    temperature=model_config.get('temperature', 0.7),
-                    stream=True
-                )
-
-                import asyncio
-                for chunk in stream:
-                    if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                        delta = chunk.choices[0].delta
-                        if hasattr(delta, 'content') and delta.content is not None:
-                            content = delta.content
-                            full_response += content
-
-                            # 发送流式内容
-                            await self.send(text_data=json.dumps({
-                                'type': 'stream_content',
-                                'content': content
-                            }))
-
-                            # 添加小延迟确保真正的流式传输
-                            await asyncio.sleep(0.002)  # 2毫秒延迟
+                # 合并token增量，按时间/大小批量发送
+                coalescer = StreamCoalescer(self, 'stream_content', self.frame_format)
+                async for content in stream_chat_completion(client, model_config, messages):
+                    full_response += content
+                    await coalescer.push(content)
+                await coalescer.close()
 
             # 发送流式响应结束标记
             await self.send(text_data=json.dumps({
@@ -323,8 +373,8 @@ User Question: {question}
         try:
             session_id = self.session_id or 'default_session'
             
-            # 准备上下文
-            context_messages = self.r2c_manager.prepare_context_messages(session_id)
+            # 选择模型
+            model_name = models[0] if models else 'deepseek-chat'
 
             # 构建页面上下文
             enhanced_question = question
@@ -340,11 +390,10 @@ User question: {question}
                 enhanced_question = page_context
                 logger.info(f"Added page context: {self.current_page_info.get('title', 'Unknown')}")
 
-            # 添加用户消息
+            # 先添加用户消息，再按模型的token上限打包上下文，问题（含页面内容）计入预算
             self.r2c_manager.add_message(session_id, "user", enhanced_question)
+            context_messages = self.r2c_manager.prepare_context_messages(session_id, model_name)
             
-            # 选择模型
-            model_name = models[0] if models else 'deepseek-chat'
             model_config = MODELS_CONFIG.get(model_name)
 
             if not model_config:
@@ -360,11 +409,12 @@ User question: {question}
             if not api_key:
                 raise ValueError(f"API key not found for provider {provider}")
 
-            # 构建消息
-            messages = context_messages + [{"role": "user", "content": enhanced_question}]
+            # 构建消息（上下文的最后一条即当前问题）
+            messages = context_messages
 
             if use_rag:
                 # 使用RAG
+                from datascraper import cdm_rag
                 rag_response = cdm_rag.get_rag_response(question, model_name)
                 response_text = rag_response
             else:
@@ -399,13 +449,16 @@ User question: {question}
             logger.error(f"Error in get_ai_response: {e}")
             raise
 
-    async def get_agent_response_stream(self, question, models):
+    async def get_agent_response_stream(self, question, models, tool_mode=None):
         """获取Agent响应（流式，支持内置工具调用）"""
         try:
+            if tool_mode not in TOOL_MODES:
+                tool_mode = default_tool_mode()
+
             session_id = self.session_id or 'default_session'
 
-            # 准备上下文
-            context_messages = await database_sync_to_async(self.r2c_manager.prepare_context_messages)(session_id)
+            # 选择模型
+            model_name = models[0] if models else 'deepseek-chat'
 
             # 构建页面上下文（使用最新的定时更新数据）
             enhanced_question = question
@@ -422,11 +475,9 @@ User Question: {question}
                 enhanced_question = page_context
                 logger.info(f"Using active page context: {active_page.get('title', 'Unknown')}")
 
-            # 添加用户消息到R2C上下文
+            # 先添加用户消息，再按模型的token上限打包上下文，问题（含页面内容）计入预算
             await database_sync_to_async(self.r2c_manager.add_message)(session_id, "user", enhanced_question)
-
-            # 选择模型
-            model_name = models[0] if models else 'deepseek-chat'
+            context_messages = await database_sync_to_async(self.r2c_manager.prepare_context_messages)(session_id, model_name)
 
             # 发送流式响应开始标记
             await self.send(text_data=json.dumps({
@@ -437,25 +488,10 @@ User Question: {question}
             # 使用内置工具系统
             from .builtin_tools import builtin_tool_manager
 
-            # 构建Agent提示词
-            tool_definitions = builtin_tool_manager.get_tool_definitions()
-            agent_prompt = f"""
-You are a helpful financial assistant with access to browser automation tools.
-
-{tool_definitions}
-
-Context from previous conversation:
-{chr(10).join([f"{msg['role']}: {msg['content']}" for msg in context_messages[-3:]])}
-
-Current request: {enhanced_question}
-
-Instructions:
-1. Analyze the user's request carefully
-2. If the request involves web browsing, navigation, or browser interaction, use the appropriate tools
-3. Use the exact tool call format specified above
-4. After completing all necessary tool calls, provide a comprehensive summary of what was accomplished
-5. Always end with a final response that answers the user's original question
-"""
+            # 构建Agent提示词（原生模式下工具定义以schema传给接口，不写进提示词）
+            tool_definitions = None if tool_mode == TOOL_MODE_NATIVE else builtin_tool_manager.get_tool_definitions()
+            # 上下文的最后一条是当前问题，提示词中单独作为 Current request
+            agent_prompt = build_agent_prompt(enhanced_question, context_messages[:-1], tool_definitions)
 
             # 显示工具分析状态
             await self.send(text_data=json.dumps({
@@ -467,7 +503,7 @@ Instructions:
 
             # 使用内置工具系统进行多轮对话 - 完全后台执行避免阻塞
             asyncio.create_task(
-                self.run_builtin_agent_conversation_background(agent_prompt, enhanced_question, model_name)
+                self.run_builtin_agent_conversation_background(agent_prompt, enhanced_question, model_name, tool_mode)
             )
 
             # 立即返回，不等待agent完成
@@ -489,10 +525,10 @@ Instructions:
                 'message': f'Error getting Agent response: {str(e)}'
             }))
 
-    async def run_builtin_agent_conversation_background(self, system_prompt, user_question, model_name):
+    async def run_builtin_agent_conversation_background(self, system_prompt, user_question, model_name, tool_mode=None):
         """后台运行Agent对话，不阻塞消息处理"""
         try:
-            full_response = await self.run_builtin_agent_conversation(system_prompt, user_question, model_name)
+            full_response = await self.run_builtin_agent_conversation(system_prompt, user_question, model_name, tool_mode)
 
             # 发送流式响应结束标记
             await self.send(text_data=json.dumps({
@@ -500,7 +536,7 @@ Instructions:
             }))
 
             # 添加AI响应到R2C上下文
-            session_id = self.scope.get('session', {}).get('session_key', 'default_session')
+            session_id = self.session_id or 'default_session'
             await database_sync_to_async(self.r2c_manager.add_message)(session_id, "assistant", full_response)
 
         except Exception as e:
@@ -510,9 +546,9 @@ Instructions:
                 'message': f'Error getting Agent response: {str(e)}'
             }))
 
-    async def run_builtin_agent_conversation(self, system_prompt, user_question, model_name):
+    async def run_builtin_agent_conversation(self, system_prompt, user_question, model_name, tool_mode=None):
         """使用内置工具系统运行Agent对话"""
-        from .builtin_tools import builtin_tool_manager
+        from .builtin_tools import ToolCallStreamParser, ToolScheduler, builtin_tool_manager
         from datascraper.models_config import get_model_config
 
         try:
@@ -531,7 +567,13 @@ Instructions:
             if not api_key:
                 raise ValueError(f"API key not found for provider {provider}")
 
-            max_iterations = 5  # 最大工具调用轮数
+            if tool_mode == TOOL_MODE_NATIVE:
+                # 原生工具调用：工具schema交给模型接口，调用以结构化增量返回
+                client = get_async_client(api_key, provider_config.get('base_url'), provider)
+                adapter = make_tool_adapter(provider, client, model_config, builtin_tool_manager.get_tool_schemas())
+                return await self.run_native_agent_conversation(adapter, system_prompt, user_question)
+
+            max_iterations = MAX_AGENT_ITERATIONS
             conversation_history = [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_question}
@@ -546,120 +588,58 @@ Instructions:
 
                 logger.info(f"Agent iteration {iteration + 1}/{max_iterations}")
 
-                # 让出控制权，允许处理其他消息（如页面信息更新）
-                await asyncio.sleep(0)
-
-                # 调用AI模型 - 使用现有的流式响应逻辑
-                import openai
-                client = openai.OpenAI(
-                    api_key=api_key,
-                    base_url=provider_config.get('base_url')
-                )
+                # 调用AI模型（异步流式，等待期间其他消息照常处理）
+                client = get_async_client(api_key, provider_config.get('base_url'))
 
                 response_text = ""
-                stream = client.chat.completions.create(
-                    model=model_config['model_name'],
-                    messages=conversation_history,
-                    max_tokens=model_config.get('max_tokens', 2000),
-                    temperature=model_config.get('temperature', 0.7),
-                    stream=True
-                )
-
-                for chunk in stream:
-                    # 检查是否需要停止生成
-                    if self.stop_generation:
-                        logger.info("Generation stopped during streaming")
-                        self.stop_generation = False  # 重置标志
-                        return "Generation stopped by user."
-
-                    if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                        delta = chunk.choices[0].delta
-                        if hasattr(delta, 'content') and delta.content is not None:
-                            content = delta.content
-                            response_text += content
-
-                            # 暂时不发送流式响应，等确定没有工具调用时再发送
-                            # 添加小延迟确保真正的流式传输
-                            await asyncio.sleep(0.002)  # 2毫秒延迟
-
-                # 解析工具调用
-                tool_calls = builtin_tool_manager.parse_tool_calls(response_text)
-
-                if not tool_calls:
-                    # 没有工具调用，对话结束 - 现在进行流式传输
-                    logger.info("No tool calls found, streaming final response")
-
-                    # 发送流式响应
-                    for char in response_text:
-                        await self.send(text_data=json.dumps({
-                            'type': 'stream_chunk',
-                            'content': char
-                        }))
-                        await asyncio.sleep(0.01)  # 10毫秒延迟，让流式效果更明显
-
+                # 增量解析：普通文本实时发送，工具调用的JSON一闭合就开始执行
+                parser = ToolCallStreamParser()
+                coalescer = StreamCoalescer(self, 'stream_chunk', self.frame_format)
+                scheduler = ToolScheduler(builtin_tool_manager, self)  # 只读工具并发，其余按顺序
+
+                # aclosing：中途停止时立即关闭流
+                async with aclosing(stream_chat_completion(client, model_config, conversation_history)) as stream:
+                    async for content in stream:
+                        # 检查是否需要停止生成
+                        if self.stop_generation:
+                            logger.info("Generation stopped during streaming")
+                            self.stop_generation = False  # 重置标志
+                            scheduler.cancel()
+                            await coalescer.close()
+                            return "Generation stopped by user."
+
+                        response_text += content
+                        for kind, value in parser.feed(content):
+                            await self._handle_agent_stream_event(kind, value, coalescer, scheduler)
+
+                for kind, value in parser.finish():
+                    await self._handle_agent_stream_event(kind, value, coalescer, scheduler)
+                await coalescer.close()
+
+                if not scheduler:
+                    # 没有工具调用，对话结束（回复已实时发送）
+                    logger.info("No tool calls found, final response streamed")
                     return response_text
 
-                # 执行工具调用
+                # 收集工具结果（工具可能在生成过程中已经执行完）
                 conversation_history.append({"role": "assistant", "content": response_text})
 
-                for tool_call in tool_calls:
-                    # 检查是否需要停止生成
-                    if self.stop_generation:
-                        logger.info("Generation stopped before tool execution")
-                        self.stop_generation = False  # 重置标志
-                        return "Generation stopped by user."
-
+                # 按调用顺序收集结果（只读工具可能已并发执行完）
+                for tool_call, task in scheduler.runs:
                     tool_name = tool_call['tool']
                     parameters = tool_call['parameters']
 
-                    # 显示工具调用状态
-                    await self.send(text_data=json.dumps({
-                        'type': 'tool_calling',
-                        'message': f'Calling Tool: {tool_name}',
-                        'tool_details': {
-                            'tool_name': tool_name,
-                            'parameters': parameters,
-                            'timestamp': time.time()
-                        }
-                    }))
-
-                    # 执行工具
-                    tool_result = await builtin_tool_manager.execute_tool(
-                        tool_name, parameters, self
-                    )
-
-                    # 让出控制权，允许处理其他消息
-                    await asyncio.sleep(0)
+                    tool_result = await task
 
                     # 检查是否在工具执行后需要停止
                     if self.stop_generation:
                         logger.info("Generation stopped after tool execution")
                         self.stop_generation = False  # 重置标志
+                        scheduler.cancel()
                         return "Generation stopped by user."
 
                     # 显示工具完成状态
-                    if tool_result['success']:
-                        await self.send(text_data=json.dumps({
-                            'type': 'tool_result',
-                            'message': f'Tool execution completed successfully',
-                            'tool_details': {
-                                'tool_name': tool_name,
-                                'parameters': parameters,
-                                'result': tool_result['result'],
-                                'timestamp': time.time()
-                            }
-                        }))
-                    else:
-                        await self.send(text_data=json.dumps({
-                            'type': 'tool_result',
-                            'message': f'Tool execution failed: {tool_result["error"]}',
-                            'tool_details': {
-                                'tool_name': tool_name,
-                                'parameters': parameters,
-                                'error': tool_result.get('error', 'Unknown error'),
-                                'timestamp': time.time()
-                            }
-                        }))
+                    await self._send_tool_result(tool_name, parameters, tool_result)
 
                     # 将工具结果添加到对话历史
                     tool_result_message = f"Tool '{tool_name}' result: {json.dumps(tool_result, indent=2)}"
@@ -671,33 +651,18 @@ Instructions:
             # 添加总结请求
             conversation_history.append({
                 "role": "user",
-                "content": "Please provide a comprehensive summary of what you accomplished and answer the original question."
+                "content": SUMMARY_REQUEST
             })
 
             # 获取最终总结
             final_response = ""
-            stream = client.chat.completions.create(
-                model=model_config['model_name'],
-                messages=conversation_history,
-                max_tokens=model_config.get('max_tokens', 2000),
-                temperature=model_config.get('temperature', 0.7),
-                stream=True
-            )
+            coalescer = StreamCoalescer(self, 'stream_chunk', self.frame_format)
+            async for content in stream_chat_completion(client, model_config, conversation_history):
+                final_response += content
 
-            for chunk in stream:
-                if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                    delta = chunk.choices[0].delta
-                    if hasattr(delta, 'content') and delta.content is not None:
-                        content = delta.content
-                        final_response += content
-
-                        # 实时发送响应流
-                        await self.send(text_data=json.dumps({
-                            'type': 'stream_chunk',
-                            'content': content
-                        }))
-
-                        await asyncio.sleep(0.002)
+                # 实时发送响应流（合并发送）
+                await coalescer.push(content)
+            await coalescer.close()
 
             return final_response
 
@@ -705,6 +670,127 @@ Instructions:
             logger.error(f"Error in builtin agent conversation: {e}")
             raise
 
+    async def run_native_agent_conversation(self, adapter, system_prompt, user_question):
+        """原生工具调用模式的Agent对话"""
+        from .builtin_tools import ToolScheduler, builtin_tool_manager
+
+        messages = adapter.initial_messages(system_prompt, user_question)
+
+        for iteration in range(MAX_AGENT_ITERATIONS):
+            # 检查是否需要停止生成
+            if self.stop_generation:
+                logger.info("Generation stopped by user request")
+                self.stop_generation = False  # 重置标志
+                return "Generation stopped by user."
+
+            logger.info(f"Agent iteration {iteration + 1}/{MAX_AGENT_ITERATIONS} (native tools)")
+
+            response_text = ""
+            coalescer = StreamCoalescer(self, 'stream_chunk', self.frame_format)
+            scheduler = ToolScheduler(builtin_tool_manager, self)  # 只读工具并发，其余按顺序
+
+            async with aclosing(adapter.stream_turn(messages)) as stream:
+                async for kind, value in stream:
+                    # 检查是否需要停止生成
+                    if self.stop_generation:
+                        logger.info("Generation stopped during streaming")
+                        self.stop_generation = False  # 重置标志
+                        scheduler.cancel()
+                        await coalescer.close()
+                        return "Generation stopped by user."
+
+                    if kind == 'text':
+                        response_text += value
+                    await self._handle_agent_stream_event(kind, value, coalescer, scheduler)
+            await coalescer.close()
+
+            if not scheduler:
+                logger.info("No tool calls found, final response streamed")
+                return response_text
+
+            tool_calls = [tool_call for tool_call, _ in scheduler.runs]
+            messages.append(adapter.assistant_message(response_text, tool_calls))
+
+            results = []
+            for tool_call, task in scheduler.runs:
+                tool_result = await task
+
+                # 检查是否在工具执行后需要停止
+                if self.stop_generation:
+                    logger.info("Generation stopped after tool execution")
+                    self.stop_generation = False  # 重置标志
+                    scheduler.cancel()
+                    return "Generation stopped by user."
+
+                await self._send_tool_result(tool_call['tool'], tool_call['parameters'], tool_result)
+                results.append(tool_result)
+
+            messages.extend(adapter.tool_result_messages(tool_calls, results))
+
+        # 达到最大迭代次数，要求模型给出最终总结（不再调用工具）
+        logger.warning(f"Reached maximum iterations ({MAX_AGENT_ITERATIONS}), requesting final summary")
+        adapter.append_user(messages, SUMMARY_REQUEST)
+
+        final_response = ""
+        coalescer = StreamCoalescer(self, 'stream_chunk', self.frame_format)
+        async with aclosing(adapter.stream_turn(messages, allow_tools=False)) as stream:
+            async for kind, value in stream:
+                if kind == 'text':
+                    final_response += value
+                    await coalescer.push(value)
+        await coalescer.close()
+        return final_response
+
+    async def _send_tool_result(self, tool_name, parameters, tool_result):
+        """向客户端报告工具执行结果"""
+        if tool_result['success']:
+            await self.send(text_data=json.dumps({
+                'type': 'tool_result',
+                'message': f'Tool execution completed successfully',
+                'tool_details': {
+                    'tool_name': tool_name,
+                    'parameters': parameters,
+                    'result': tool_result['result'],
+                    'timestamp': time.time()
+                }
+            }))
+        else:
+            await self.send(text_data=json.dumps({
+                'type': 'tool_result',
+                'message': f'Tool execution failed: {tool_result["error"]}',
+                'tool_details': {
+                    'tool_name': tool_name,
+                    'parameters': parameters,
+                    'error': tool_result.get('error', 'Unknown error'),
+                    'timestamp': time.time()
+                }
+            }))
+
+    async def _handle_agent_stream_event(self, kind, value, coalescer, scheduler):
+        """处理增量解析器产出的事件：文本实时发送，工具调用立即交给调度器"""
+        if kind == 'text':
+            await coalescer.push(value)
+            return
+
+        # 先发出工具调用之前的文本，保持界面顺序
+        await coalescer.flush()
+
+        tool_name = value['tool']
+        parameters = value['parameters']
+
+        # 显示工具调用状态
+        await self.send(text_data=json.dumps({
+            'type': 'tool_calling',
+            'message': f'Calling Tool: {tool_name}',
+            'tool_details': {
+                'tool_name': tool_name,
+                'parameters': parameters,
+                'timestamp': time.time()
+            }
+        }))
+
+        scheduler.submit(value)
+
     async def send_to_extension(self, message):
         """向Chrome插件发送消息（通过WebSocket）"""
         try:
@@ -722,48 +808,36 @@ Instructions:
 class BrowserControlConsumer(AsyncWebsocketConsumer):
     """处理浏览器控制WebSocket连接 - 用于Chrome插件接收操作命令"""
 
-    # 类变量用于存储页面信息响应
-    _page_info_responses = {}
-    _page_info_events = {}
-
     async def connect(self):
         await self.accept()
         logger.info("Browser Control WebSocket connected")
 
-        # 将此连接存储为全局浏览器控制连接
-        # 这样其他consumer可以向浏览器发送命令
-        from channels.layers import get_channel_layer
-        channel_layer = get_channel_layer()
-        await channel_layer.group_add("browser_control", self.channel_name)
+        # 登记此连接，命令按会话归属直接发到这个channel
+        replays = get_browser_rpc().register_connection(self.channel_name)
+        await request_page_snapshots(self.channel_layer, replays)
 
     async def disconnect(self, close_code):
-        from channels.layers import get_channel_layer
-        channel_layer = get_channel_layer()
-        await channel_layer.group_discard("browser_control", self.channel_name)
+        # 等待此连接回执的命令立即失败，而不是等到超时；聊天会话改绑后补发新插件的页面
+        replays = get_browser_rpc().unregister_connection(self.channel_name)
+        await request_page_snapshots(self.channel_layer, replays)
         logger.info(f"Browser Control WebSocket disconnected: {close_code}")
 
     async def receive(self, text_data):
         try:
             data = json.loads(text_data)
-            message_type = data.get('type')
-
-            # 处理来自Chrome插件的响应消息
-            if message_type.endswith('_result'):
-                logger.info(f"Received browser operation result: {data}")
-
-                # 特别处理页面信息响应
-                if message_type == 'browser_info_result':
-                    page_info = data.get('pageInfo', {})
-                    request_id = data.get('request_id', 'default')
+            message_type = data.get('type') or ''
 
-                    # 存储页面信息
-                    BrowserControlConsumer._page_info_responses[request_id] = page_info
-
-                    # 触发等待的事件
-                    if request_id in BrowserControlConsumer._page_info_events:
-                        BrowserControlConsumer._page_info_events[request_id].set()
+            if message_type == 'register':
+                # 插件声明其标签页的会话和配对码，新配对的标签页补发页面给聊天会话
+                replays = get_browser_rpc().register_connection(
+                    self.channel_name, data.get('session_ids'), data.get('pairing_id')
+                )
+                await request_page_snapshots(self.channel_layer, replays)
 
-                    logger.info(f"Stored page info for request {request_id}: {page_info.get('title', 'No title')}")
+            # 处理来自Chrome插件的响应消息
+            elif message_type.endswith('_result'):
+                if not get_browser_rpc().resolve(self.channel_name, data):
+                    logger.info(f"Ignored browser result without a waiting request: {message_type} {data.get('request_id', '')}")
 
         except Exception as e:
             logger.error(f"Error in BrowserControlConsumer.receive: {e}")
@@ -772,56 +846,49 @@ class BrowserControlConsumer(AsyncWebsocketConsumer):
     async def browser_command(self, event):
         await self.send(text_data=json.dumps(event['data']))
 
-    @classmethod
-    async def wait_for_page_info(cls, request_id='default', timeout=10):
-        """等待页面信息响应"""
-        import asyncio
-
-        # 创建事件
-        event = asyncio.Event()
-        cls._page_info_events[request_id] = event
-
-        try:
-            # 等待响应
-            await asyncio.wait_for(event.wait(), timeout=timeout)
-
-            # 获取响应数据
-            page_info = cls._page_info_responses.get(request_id, {})
-
-            # 清理
-            cls._page_info_responses.pop(request_id, None)
-            cls._page_info_events.pop(request_id, None)
 
-            return page_info
-
-        except asyncio.TimeoutError:
-            # 清理
-            cls._page_info_events.pop(request_id, None)
-            logger.warning(f"Timeout waiting for page info response: {request_id}")
-            return None
+class PageInfoConsumer(AsyncWebsocketConsumer):
+    """处理页面信息WebSocket连接（每个标签页一个）"""
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 插件上次发送的页面，增量基于它重建；也用于忽略未变化的更新和补发给新配对的聊天会话
+        self.snapshot = None
+        self.tab_session_id = None
 
-class PageInfoConsumer(AsyncWebsocketConsumer):
-    """处理页面信息WebSocket连接"""
-    
     async def connect(self):
-        # 加入页面信息组
-        await self.channel_layer.group_add("page_info", self.channel_name)
         await self.accept()
         logger.info("PageInfo WebSocket connected")
         
     async def disconnect(self, close_code):
-        # 离开页面信息组
-        await self.channel_layer.group_discard("page_info", self.channel_name)
+        if self.tab_session_id is not None:
+            await self.channel_layer.group_discard(tab_group(self.tab_session_id), self.channel_name)
         logger.info(f"PageInfo WebSocket disconnected: {close_code}")
+
+    async def join_tab(self, tab_session_id):
+        """加入标签页会话的组，以接收页面快照请求"""
+        if not tab_session_id or tab_session_id == self.tab_session_id:
+            return
+        if self.tab_session_id is not None:
+            await self.channel_layer.group_discard(tab_group(self.tab_session_id), self.channel_name)
+        self.tab_session_id = tab_session_id
+        await self.channel_layer.group_add(tab_group(tab_session_id), self.channel_name)
         
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
+            if bytes_data is not None:
+                # 压缩的增量消息
+                text_data = decode_page_frame(bytes_data)
             data = json.loads(text_data)
             message_type = data.get('type')
+            await self.join_tab(data.get('session_id'))
 
-            if message_type == 'page_update':
+            if message_type == 'page_delta':
+                await self.handle_page_delta(data)
+            elif message_type == 'page_update':
                 await self.handle_page_update(data)
+            elif message_type == 'page_touch':
+                await self.handle_page_touch(data)
             elif message_type == 'page_info_response':
                 await self.handle_page_info_response(data)
             elif message_type == 'page_navigation':
@@ -839,8 +906,8 @@ class PageInfoConsumer(AsyncWebsocketConsumer):
 
         logger.info(f"Page navigation detected: {url}")
 
-        # 广播页面导航信号到聊天消费者，让它们清除旧的页面信息
-        await self.channel_layer.group_send("chat_clients", {
+        # 通知该标签页所属浏览器的聊天会话清除旧的页面信息
+        await self.send_to_chat_sessions(session_id, {
             'type': 'page_navigation_signal',
             'url': url,
             'title': title,
@@ -848,6 +915,26 @@ class PageInfoConsumer(AsyncWebsocketConsumer):
             'timestamp': timestamp
         })
 
+    async def handle_page_delta(self, data):
+        """处理增量页面更新：在上次内容上重建当前页面"""
+        base = data.get('base')
+        if base is None:
+            content = data.get('content', '')
+        else:
+            try:
+                if self.snapshot is None or self.snapshot['hash'] != base:
+                    raise PageDeltaError("Page delta base does not match the last snapshot")
+                content = apply_line_ops(self.snapshot['content'], data.get('ops') or [])
+                if page_text_hash(content) != data.get('hash'):
+                    raise PageDeltaError("Reassembled page does not match its hash")
+            except PageDeltaError as e:
+                # 基准丢失或不一致：让插件重新发送完整内容
+                logger.warning(f"PageInfoConsumer: {e}; requesting a full snapshot")
+                self.snapshot = None
+                await self.send(text_data=json.dumps({'type': 'page_resync'}))
+                return
+        await self.handle_page_update({**data, 'content': content})
+
     async def handle_page_update(self, data):
         """处理页面更新"""
         url = data.get('url', '')
@@ -857,21 +944,24 @@ class PageInfoConsumer(AsyncWebsocketConsumer):
         timestamp = data.get('timestamp', None)
         is_active = data.get('is_active', False)
 
-        # 广播页面信息到聊天消费者
-        logger.info(f"PageInfoConsumer: Broadcasting page_info_update to chat_clients group - URL: {url[:50]}...")
-        await self.channel_layer.group_send("chat_clients", {
-            'type': 'page_info_update',
+        snapshot = {
             'url': url,
-            'content': content,
             'title': title,
-            'session_id': session_id,
-            'timestamp': timestamp,
-            'is_active': is_active
-        })
-        logger.info(f"PageInfoConsumer: page_info_update message sent to chat_clients group")
+            'is_active': is_active,
+            'hash': data.get('hash') or page_text_hash(content),
+            'content': content,
+            'timestamp': timestamp
+        }
+        unchanged = self.snapshot is not None and all(
+            self.snapshot[key] == snapshot[key] for key in ('url', 'title', 'is_active', 'hash')
+        )
+        self.snapshot = snapshot
+        if unchanged:
+            # 内容与状态都没有变化，不再转发
+            return
 
-        # 也广播到页面信息组（用于调试）
-        await self.channel_layer.group_send("page_info", {
+        # 只发给该标签页所属浏览器的聊天会话
+        delivered = await self.send_to_chat_sessions(session_id, {
             'type': 'page_info_update',
             'url': url,
             'content': content,
@@ -882,12 +972,24 @@ class PageInfoConsumer(AsyncWebsocketConsumer):
         })
 
         status = "active" if is_active else "background"
-        logger.info(f"Page info updated and broadcasted ({status}): {url[:50]}...")
+        logger.info(f"Page info updated for {delivered} chat session(s) ({status}): {url[:50]}...")
+
+    async def handle_page_touch(self, data):
+        """页面未变化的定期通知，转发给聊天会话以免其缓存的页面过期"""
+        if self.snapshot is None or self.snapshot['hash'] != data.get('hash'):
+            # 后端没有该页面（如服务重启）或与插件不一致：让插件重新发送完整内容
+            await self.send(text_data=json.dumps({'type': 'page_resync'}))
+            return
+        await self.send_to_chat_sessions(data.get('session_id', 'default_session'), {
+            'type': 'page_info_touch',
+            'url': self.snapshot['url'],
+            'session_id': data.get('session_id', 'default_session')
+        })
 
     async def handle_page_info_response(self, data):
         """处理页面信息响应"""
-        # 转发页面信息响应到聊天消费者
-        await self.channel_layer.group_send("chat_clients", {
+        # 转发页面信息响应到该标签页所属浏览器的聊天会话
+        await self.send_to_chat_sessions(data.get('session_id', 'default_session'), {
             'type': 'page_info_response',
             'url': data.get('url', ''),
             'content': data.get('content', ''),
@@ -897,21 +999,27 @@ class PageInfoConsumer(AsyncWebsocketConsumer):
             'is_active': data.get('is_active', False)
         })
 
-    async def request_page_info(self, event):
-        """请求页面信息"""
-        logger.info("PageInfoConsumer: Sending request_page_info to content script")
-        await self.send(text_data=json.dumps({
-            'type': 'request_page_info'
-        }))
-        logger.info("PageInfoConsumer: request_page_info message sent")
+    async def send_to_chat_sessions(self, tab_session_id, event):
+        """把页面事件发给与该标签页属于同一浏览器的聊天会话，返回会话数"""
+        sessions = get_browser_rpc().clients_for(tab_session_id)
+        for session_id in sessions:
+            await self.channel_layer.group_send(session_group(session_id), event)
+        return len(sessions)
 
-    async def page_info_update(self, event):
-        """接收页面信息更新（保留用于调试）"""
-        await self.send(text_data=json.dumps({
-            'type': 'page_info',
-            'url': event['url'],
-            'content': event['content'],
-            'title': event.get('title', ''),
-            'session_id': event['session_id'],
-            'is_active': event.get('is_active', False)
-        }))
+    async def request_page_info(self, event):
+        """把最近的页面快照补发给新配对的聊天会话；还没有快照时让插件发送完整内容"""
+        if self.snapshot is None:
+            logger.info("PageInfoConsumer: No snapshot yet, requesting a full page from the content script")
+            await self.send(text_data=json.dumps({'type': 'page_resync'}))
+            return
+        for session_id in event.get('chat_sessions', []):
+            await self.channel_layer.group_send(session_group(session_id), {
+                'type': 'page_info_response',
+                'url': self.snapshot['url'],
+                'content': self.snapshot['content'],
+                'title': self.snapshot['title'],
+                'session_id': self.tab_session_id,
+                'timestamp': self.snapshot['timestamp'],
+                'is_active': self.snapshot['is_active']
+            })
+        logger.info(f"PageInfoConsumer: Replayed page snapshot to {len(event.get('chat_sessions', []))} chat session(s)")
@@ -0,0 +1,241 @@
+"""
+原生工具调用（function calling）模式。
+工具以结构化schema传给模型接口，不再把工具说明文字拼进每轮提示词；
+工具调用以流式结构化增量返回，无需正则解析JSON。
+支持OpenAI兼容接口（OpenAI、DeepSeek）和Anthropic。
+
+适配器的 stream_turn() 产出与 ToolCallStreamParser 相同的事件：
+('text', str) 和 ('tool_call', {'id', 'tool', 'parameters'})。
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+TOOL_MODE_PROMPT = 'prompt'  # 工具说明写进提示词，解析 <tool_call> 块
+TOOL_MODE_NATIVE = 'native'  # 模型原生工具调用接口
+TOOL_MODES = (TOOL_MODE_PROMPT, TOOL_MODE_NATIVE)
+
+# 输出上限；MODELS_CONFIG中的max_tokens是上下文窗口，不能直接作为输出上限
+ANTHROPIC_MAX_OUTPUT_TOKENS = 4096  # Anthropic要求显式的输出上限
+OPENAI_MAX_OUTPUT_TOKENS = 4096  # OpenAI兼容接口会拒绝或截断超过模型输出上限的请求
+
+
+def default_tool_mode():
+    """默认工具调用模式，可用环境变量 AGENT_TOOL_MODE 设置"""
+    mode = os.getenv('AGENT_TOOL_MODE', TOOL_MODE_PROMPT).lower()
+    return mode if mode in TOOL_MODES else TOOL_MODE_PROMPT
+
+
+def _parse_arguments(name, arguments):
+    """解析工具参数JSON；失败时返回空参数，由工具返回错误给模型"""
+    if not arguments:
+        return {}
+    try:
+        value = json.loads(arguments)
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse arguments of tool call {name}: {e}")
+        return {}
+    return value if isinstance(value, dict) else {}
+
+
+class OpenAIToolAdapter:
+    """OpenAI兼容接口（chat.completions + tools）"""
+
+    def __init__(self, client, model_config, tool_schemas):
+        self.client = client
+        self.model_config = model_config
+        self.tools = [{'type': 'function', 'function': schema} for schema in tool_schemas]
+
+    def initial_messages(self, system_prompt, user_question):
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_question}
+        ]
+
+    def append_user(self, messages, text):
+        messages.append({"role": "user", "content": text})
+
+    async def stream_turn(self, messages, allow_tools=True):
+        """流式调用一轮；每个工具调用在其参数完整后立即产出"""
+        stream = await self.client.chat.completions.create(
+            model=self.model_config['model_name'],
+            messages=messages,
+            max_tokens=min(self.model_config.get('max_tokens', OPENAI_MAX_OUTPUT_TOKENS), OPENAI_MAX_OUTPUT_TOKENS),
+            temperature=self.model_config.get('temperature', 0.7),
+            tools=self.tools,
+            tool_choice='auto' if allow_tools else 'none',
+            stream=True
+        )
+        current = None  # 正在接收参数的工具调用
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    yield ('text', delta.content)
+                for fragment in delta.tool_calls or []:
+                    if current is None or fragment.index != current['index']:
+                        # 工具调用按顺序流出：新调用开始时，上一个的参数已完整
+                        if current is not None:
+                            yield ('tool_call', self._to_tool_call(current))
+                        current = {'index': fragment.index, 'id': None, 'name': '', 'arguments': ''}
+                    if fragment.id:
+                        current['id'] = fragment.id
+                    if fragment.function is not None:
+                        current['name'] += fragment.function.name or ''
+                        current['arguments'] += fragment.function.arguments or ''
+            if current is not None:
+                yield ('tool_call', self._to_tool_call(current))
+        finally:
+            await stream.close()
+
+    @staticmethod
+    def _to_tool_call(entry):
+        logger.info(f"Native tool call: {entry['name']}")
+        return {
+            'id': entry['id'],
+            'tool': entry['name'],
+            'parameters': _parse_arguments(entry['name'], entry['arguments']),
+        }
+
+    def assistant_message(self, text, tool_calls):
+        return {
+            "role": "assistant",
+            "content": text or None,
+            "tool_calls": [
+                {
+                    'id': call['id'],
+                    'type': 'function',
+                    'function': {'name': call['tool'], 'arguments': json.dumps(call['parameters'])}
+                }
+                for call in tool_calls
+            ]
+        }
+
+    def tool_result_messages(self, tool_calls, results):
+        return [
+            {"role": "tool", "tool_call_id": call['id'], "content": json.dumps(result)}
+            for call, result in zip(tool_calls, results)
+        ]
+
+
+class AnthropicToolAdapter:
+    """Anthropic Messages接口（tools + tool_use/tool_result内容块）"""
+
+    def __init__(self, client, model_config, tool_schemas):
+        self.client = client
+        self.model_config = model_config
+        self.system = None
+        self.tools = [
+            {'name': schema['name'], 'description': schema['description'], 'input_schema': schema['parameters']}
+            for schema in tool_schemas
+        ]
+
+    def initial_messages(self, system_prompt, user_question):
+        # Anthropic的system提示词是单独的参数
+        self.system = system_prompt
+        return [{"role": "user", "content": user_question}]
+
+    def append_user(self, messages, text):
+        # 角色需交替：上一条是工具结果（user）时合并进去
+        if messages and messages[-1]['role'] == 'user' and isinstance(messages[-1]['content'], list):
+            messages[-1]['content'].append({'type': 'text', 'text': text})
+        else:
+            messages.append({"role": "user", "content": text})
+
+    async def stream_turn(self, messages, allow_tools=True):
+        """流式调用一轮；每个tool_use块结束时立即产出工具调用"""
+        kwargs = {}
+        if self.system:
+            kwargs['system'] = self.system
+        stream = await self.client.messages.create(
+            model=self.model_config['model_name'],
+            messages=messages,
+            max_tokens=min(self.model_config.get('max_tokens', ANTHROPIC_MAX_OUTPUT_TOKENS), ANTHROPIC_MAX_OUTPUT_TOKENS),
+            temperature=self.model_config.get('temperature', 0.7),
+            tools=self.tools,
+            tool_choice={'type': 'auto' if allow_tools else 'none'},
+            stream=True,
+            **kwargs
+        )
+        blocks = {}  # 内容块序号 -> 正在接收的tool_use
+        try:
+            async for event in stream:
+                if event.type == 'content_block_start' and event.content_block.type == 'tool_use':
+                    blocks[event.index] = {
+                        'id': event.content_block.id,
+                        'name': event.content_block.name,
+                        'arguments': ''
+                    }
+                elif event.type == 'content_block_delta':
+                    if event.delta.type == 'text_delta':
+                        yield ('text', event.delta.text)
+                    elif event.delta.type == 'input_json_delta' and event.index in blocks:
+                        blocks[event.index]['arguments'] += event.delta.partial_json
+                elif event.type == 'content_block_stop' and event.index in blocks:
+                    entry = blocks.pop(event.index)
+                    logger.info(f"Native tool call: {entry['name']}")
+                    yield ('tool_call', {
+                        'id': entry['id'],
+                        'tool': entry['name'],
+                        'parameters': _parse_arguments(entry['name'], entry['arguments']),
+                    })
+        finally:
+            await stream.close()
+
+    def assistant_message(self, text, tool_calls):
+        content = [{'type': 'text', 'text': text}] if text else []
+        content += [
+            {'type': 'tool_use', 'id': call['id'], 'name': call['tool'], 'input': call['parameters']}
+            for call in tool_calls
+        ]
+        return {"role": "assistant", "content": content}
+
+    def tool_result_messages(self, tool_calls, results):
+        return [{
+            "role": "user",
+            "content": [
+                {'type': 'tool_result', 'tool_use_id': call['id'], 'content': json.dumps(result)}
+                for call, result in zip(tool_calls, results)
+            ]
+        }]
+
+
+def make_tool_adapter(provider, client, model_config, tool_schemas):
+    """按提供商创建原生工具调用适配器"""
+    if provider == 'anthropic':
+        return AnthropicToolAdapter(client, model_config, tool_schemas)
+    return OpenAIToolAdapter(client, model_config, tool_schemas)
+
+
+def build_agent_prompt(request, context_messages, tool_definitions=None):
+    """
+    构建Agent系统提示词。
+    提示词模式传入 tool_definitions（工具说明文字与调用格式）；原生模式不传，工具以schema单独传给接口。
+    """
+    history = "\n".join(f"{msg['role']}: {msg['content']}" for msg in context_messages[-3:])
+    tools_section = f"\n{tool_definitions}\n" if tool_definitions else ""
+    format_instruction = (
+        "Use the exact tool call format specified above"
+        if tool_definitions else
+        "Call tools through the provided tool interface"
+    )
+    return f"""
+You are a helpful financial assistant with access to browser automation tools.
+{tools_section}
+Context from previous conversation:
+{history}
+
+Current request: {request}
+
+Instructions:
+1. Analyze the user's request carefully
+2. If the request involves web browsing, navigation, or browser interaction, use the appropriate tools
+3. {format_instruction}
+4. After completing all necessary tool calls, provide a comprehensive summary of what was accomplished
+5. Always end with a final response that answers the user's original question
+"""
@@ -0,0 +1,120 @@
+"""
+聊天连接的有界页面缓存。
+按键（URL或page_id）索引，按更新时间排序；记录当前活跃页面，取活跃页面为O(1)。
+后台页面超过TTL未更新（插件也未告知页面仍有效）即过期；条目数和内容字节数超出上限时从最旧的后台页面开始淘汰，
+长时间会话的单连接内存保持稳定。
+"""
+
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 32
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024  # 页面内容（UTF-8）总字节数上限
+DEFAULT_BACKGROUND_TTL = 600  # 后台页面多久未更新后过期（秒）
+
+
+class PageCache:
+    """有界、按键索引的页面信息缓存"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 background_ttl=DEFAULT_BACKGROUND_TTL):
+        """
+        Args:
+            max_entries: 最多缓存的页面数
+            max_bytes: 页面内容总字节数上限；最新的一页总会保留
+            background_ttl: 后台页面的过期时间（秒），None表示不过期
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.background_ttl = background_ttl
+        self.active_key = None
+        self._pages = OrderedDict()  # key -> (页面信息, 字节数, 更新时间)；最近更新的在最后
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __iter__(self):
+        """按更新时间从旧到新遍历页面信息"""
+        self._expire()
+        return (entry for entry, _, _ in list(self._pages.values()))
+
+    @property
+    def total_bytes(self):
+        return self._bytes
+
+    def put(self, key, entry):
+        """新增或替换页面；标记为活跃的页面成为当前活跃页面"""
+        self._remove(key)
+        size = len(entry.get('content', '').encode('utf-8'))
+        self._pages[key] = (entry, size, time.monotonic())
+        self._bytes += size
+        if entry.get('is_active', False):
+            self.active_key = key
+        elif self.active_key == key:
+            self.active_key = None
+        self._evict()
+
+    def touch(self, key):
+        """页面未变化但仍然有效：刷新更新时间。页面不在缓存中（已过期或被淘汰）时返回False"""
+        self._expire()
+        item = self._pages.get(key)
+        if item is None:
+            return False
+        self._pages[key] = (item[0], item[1], time.monotonic())
+        self._pages.move_to_end(key)
+        return True
+
+    def get(self, key, default=None):
+        self._expire()
+        item = self._pages.get(key)
+        return item[0] if item is not None else default
+
+    def active(self):
+        """当前活跃页面；没有时返回最近更新的页面"""
+        self._expire()
+        if self.active_key in self._pages:
+            return self._pages[self.active_key][0]
+        if self._pages:
+            return next(reversed(self._pages.values()))[0]
+        return None
+
+    def clear(self):
+        self._pages.clear()
+        self._bytes = 0
+        self.active_key = None
+
+    def _remove(self, key):
+        item = self._pages.pop(key, None)
+        if item is not None:
+            self._bytes -= item[1]
+
+    def _oldest_background_key(self):
+        for key in self._pages:
+            if key != self.active_key:
+                return key
+        return None
+
+    def _expire(self):
+        """移除超过TTL未更新的后台页面（从最旧的开始，遇到未过期的即停止）"""
+        if self.background_ttl is None:
+            return
+        deadline = time.monotonic() - self.background_ttl
+        expired = []
+        for key, (_, _, updated_at) in self._pages.items():
+            if updated_at > deadline:
+                break
+            if key != self.active_key:
+                expired.append(key)
+        for key in expired:
+            self._remove(key)
+
+    def _evict(self):
+        self._expire()
+        newest = next(reversed(self._pages), None)
+        while len(self._pages) > self.max_entries or (self._bytes > self.max_bytes and len(self._pages) > 1):
+            key = self._oldest_background_key()
+            if key is None or key == newest:
+                # 只剩活跃页面和最新页面
+                break
+            self._remove(key)
@@ -0,0 +1,72 @@
+"""
+插件页面内容的增量同步。
+content script 不再每次发送完整的 innerText，而是发送相对上次已发送内容的行级修改：
+    {"type": "page_delta", "base": <上次内容的哈希或null>, "hash": <新内容的哈希>,
+     "ops": [[起始行, 结束行, [替换的行...]], ...]}      # base为null时改为 "content": 完整文本
+行号基于上次的内容，按行（'\\n'）计，避免JS（UTF-16）与Python字符下标不一致。
+较大的消息以deflate压缩的二进制帧发送。
+哈希为UTF-8字节的CRC-32与字节长度，如 "1a2b3c4d:5120"，与 content.js 的 pageTextHash() 一致。
+"""
+
+import codecs
+import zlib
+
+MAX_PAGE_MESSAGE_BYTES = 8 * 1024 * 1024  # 解压后消息的上限
+
+
+class PageDeltaError(ValueError):
+    """增量无法应用（基准不一致或格式错误），需要插件重新发送完整内容"""
+
+
+def _replace_with_fffd(error):
+    # 与浏览器TextEncoder一致：孤立的代理项编码为U+FFFD
+    return '\ufffd'.encode('utf-8') * (error.end - error.start), error.end
+
+
+codecs.register_error('page_text_fffd', _replace_with_fffd)
+
+
+def page_text_hash(text):
+    """页面文本的哈希"""
+    data = text.encode('utf-8', 'page_text_fffd')
+    return f"{zlib.crc32(data):08x}:{len(data)}"
+
+
+def decode_page_frame(bytes_data, max_bytes=MAX_PAGE_MESSAGE_BYTES):
+    """解压插件发送的二进制帧，返回JSON文本"""
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(bytes_data, max_bytes)
+    except zlib.error as e:
+        raise PageDeltaError(f"Invalid compressed page frame: {e}")
+    if decompressor.unconsumed_tail:
+        raise PageDeltaError(f"Page frame exceeds {max_bytes} bytes")
+    return data.decode('utf-8')
+
+
+def apply_line_ops(base_text, ops):
+    """
+    把行级修改应用到上次的内容上。
+
+    Args:
+        base_text: 上次的完整文本
+        ops: [[起始行, 结束行, [替换的行...]], ...]，按行号升序且互不重叠
+
+    Returns:
+        新的完整文本
+    """
+    lines = base_text.split('\n')
+    previous_end = 0
+    for op in ops:
+        if not (isinstance(op, list) and len(op) == 3):
+            raise PageDeltaError(f"Malformed page delta op: {op!r}")
+        start, end, replacement = op
+        if not (isinstance(start, int) and isinstance(end, int) and previous_end <= start <= end <= len(lines)):
+            raise PageDeltaError(f"Page delta op out of range: {start}-{end} of {len(lines)} lines")
+        if not (isinstance(replacement, list) and all(isinstance(line, str) for line in replacement)):
+            raise PageDeltaError("Page delta replacement must be a list of lines")
+        previous_end = end
+    # 从后往前替换，前面的行号不受影响
+    for start, end, replacement in reversed(ops):
+        lines[start:end] = replacement
+    return '\n'.join(lines)
@@ -0,0 +1,103 @@
+"""
+WebSocket帧合并器：把模型逐token的增量缓冲起来，
+每隔 flush_interval 秒或缓冲达到 max_bytes 时合并成一帧发送。
+
+帧格式：
+- json（默认）：{"type": "stream_content", "content": "..."}
+- compact（客户端在 set_session 中以 frame_format='compact' 开启）：
+  二进制帧，首字节为帧类型代码，其后为UTF-8文本
+"""
+
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+FRAME_FORMAT_JSON = 'json'
+FRAME_FORMAT_COMPACT = 'compact'
+FRAME_FORMATS = (FRAME_FORMAT_JSON, FRAME_FORMAT_COMPACT)
+
+# compact格式的帧类型代码
+FRAME_CODES = {
+    'stream_content': 1,
+    'stream_chunk': 2,
+}
+
+DEFAULT_FLUSH_INTERVAL = 0.03  # 30毫秒
+DEFAULT_MAX_BYTES = 2048
+
+
+class StreamCoalescer:
+    """按时间或大小合并流式文本增量，减少WebSocket帧数"""
+
+    def __init__(self, consumer, frame_type='stream_content', frame_format=FRAME_FORMAT_JSON,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Args:
+            consumer: 用于发送的WebSocket consumer
+            frame_type: 帧类型（stream_content 或 stream_chunk）
+            frame_format: json 或 compact
+            flush_interval: 缓冲内容最长等待时间（秒）
+            max_bytes: 缓冲达到该字节数时立即发送
+        """
+        self.consumer = consumer
+        self.frame_type = frame_type
+        self.frame_format = frame_format
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.frames_sent = 0
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._timer = None
+        self._send_lock = asyncio.Lock()
+
+    async def push(self, content):
+        """加入一段增量；缓冲已满时立即发送，否则等定时器发送"""
+        if not content:
+            return
+        self._buffer.append(content)
+        self._buffered_bytes += len(content.encode('utf-8'))
+        if self._buffered_bytes >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.flush_interval)
+        except asyncio.CancelledError:
+            return
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # 连接已断开等情况，由后续发送或close()报告
+            logger.warning(f"Timed stream flush failed: {e}")
+
+    async def flush(self):
+        """立即发送缓冲内容"""
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        # 在锁内取走缓冲：定时器正在发送时，close()会等它发完，帧的顺序也与缓冲顺序一致
+        async with self._send_lock:
+            if not self._buffer:
+                return
+            content = ''.join(self._buffer)
+            self._buffer = []
+            self._buffered_bytes = 0
+            if self.frame_format == FRAME_FORMAT_COMPACT:
+                await self.consumer.send(
+                    bytes_data=bytes([FRAME_CODES[self.frame_type]]) + content.encode('utf-8')
+                )
+            else:
+                await self.consumer.send(text_data=json.dumps({
+                    'type': self.frame_type,
+                    'content': content
+                }))
+            self.frames_sent += 1
+
+    async def close(self):
+        """发送剩余内容并停止定时器；返回时所有帧（包括定时器正在发送的）都已发出"""
+        await self.flush()
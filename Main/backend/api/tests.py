@@ -1,3 +1,464 @@
-from django.test import TestCase
-
-# Create your tests here.
+import asyncio
+import json
+import os
+import threading
+import weakref
+from unittest import mock
+
+import openai
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import AsyncClient, SimpleTestCase
+
+from datascraper import cdm_rag
+from datascraper import create_embeddings as ce
+from datascraper.embedders import BatchingEmbedder, LocalEmbedder
+from datascraper.r2c_context_manager import R2CContextManager
+from datascraper.web_content_store import WebContentStore, WebPage, content_digest
+
+from api.browser_rpc import BrowserRPC
+from api.builtin_tools import BuiltinToolManager, ToolCallStreamParser
+from api.consumers import PageInfoConsumer
+from api.native_tools import OPENAI_MAX_OUTPUT_TOKENS, OpenAIToolAdapter
+from api.page_cache import PageCache
+from api.page_sync import PageDeltaError, apply_line_ops, page_text_hash
+from api.stream_coalescer import StreamCoalescer
+from api import views
+
+
+class FolderPathUploadTests(SimpleTestCase):
+    """api/folder_path spools the uploaded files and queues an indexing job."""
+
+    def test_spools_each_file_of_the_upload(self):
+        payload = {'filePaths': [
+            {'name': 'notes/a.md', 'content': 'Revenue grew 10%.'},
+            {'name': 'notes/b.md', 'content': 'Margins were flat.'},
+            {'name': 'notes/empty.md', 'content': ''},
+        ]}
+        spooled = {}
+
+        def submit(ndjson_path=None, source=None, **kwargs):
+            with open(ndjson_path, 'rb') as f:
+                spooled['files'] = list(ce.iter_ndjson_files(f))
+            os.remove(ndjson_path)
+            return mock.Mock(job_id='job-1')
+
+        manager = mock.Mock(submit=mock.Mock(side_effect=submit))
+        upload = SimpleUploadedFile('data.json', json.dumps(payload).encode('utf-8'), content_type='application/json')
+        with mock.patch('datascraper.indexing_jobs.get_job_manager', return_value=manager):
+            response = self.client.post('/api/folder_path', {'json_data': upload})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['job_id'], 'job-1')
+        self.assertEqual(spooled['files'], [
+            ('notes/a.md', 'Revenue grew 10%.'),
+            ('notes/b.md', 'Margins were flat.'),
+        ])
+
+
+class FolderPathStreamTests(SimpleTestCase):
+    """api/folder_path_stream streams job progress while the job is running."""
+
+    async def test_progress_arrives_before_the_job_finishes(self):
+        progress_seen = threading.Event()
+        finished_early = []
+
+        def submit(files=None, source=None, listener=None):
+            def run():
+                names = [name for name, _ in files]
+                listener({'type': 'progress', 'job_id': 'job-1', 'files_seen': len(names)})
+                # The job only finishes once the client has read the progress event
+                finished_early.append(not progress_seen.wait(timeout=5))
+                listener({'type': 'done', 'job_id': 'job-1', 'stats': {'files': len(names)}, 'error': None})
+            threading.Thread(target=run, daemon=True).start()
+            return mock.Mock(job_id='job-1')
+
+        manager = mock.Mock(submit=mock.Mock(side_effect=submit))
+        body = json.dumps({'name': 'a.md', 'content': 'Revenue grew 10%.'}) + "\n"
+        with mock.patch('datascraper.indexing_jobs.get_job_manager', return_value=manager):
+            response = await AsyncClient().post(
+                '/api/folder_path_stream', body, content_type='application/x-ndjson'
+            )
+            events = []
+            async for line in response.streaming_content:
+                event = json.loads(line)
+                events.append(event)
+                if event['type'] == 'progress':
+                    progress_seen.set()
+
+        self.assertEqual([event['type'] for event in events], ['job', 'progress', 'done'])
+        self.assertEqual(events[2]['stats'], {'files': 1})
+        self.assertEqual(finished_early, [False])
+
+
+class BrowserRPCPairingTests(SimpleTestCase):
+    """Chat sessions only see the browser that carries their pairing id."""
+
+    def test_unrelated_extensions_stay_isolated(self):
+        rpc = BrowserRPC(channel_layer=mock.Mock())
+        rpc.register_connection('ext-alice', ['tab-a'], 'ALICE')
+        rpc.register_connection('ext-bob', ['tab-b'], 'BOB')
+
+        # Bob's extension connected last, but Alice's chat pairs with Alice's browser
+        self.assertEqual(rpc.attach_client('chat-alice', 'ALICE'), {'tab-a': ['chat-alice']})
+        self.assertEqual(rpc.connection_for('chat-alice'), 'ext-alice')
+        self.assertEqual(rpc.clients_for('tab-b'), [])
+
+        # A chat without a pairing id receives no pages at all
+        self.assertEqual(rpc.attach_client('chat-anon'), {})
+        self.assertIsNone(rpc.connection_for('chat-anon'))
+        self.assertEqual(rpc.clients_for('tab-a'), ['chat-alice'])
+
+        # A chat that attaches before its extension is bound once the extension registers
+        rpc.attach_client('chat-bob', 'BOB')
+        self.assertEqual(rpc.register_connection('ext-bob', ['tab-b', 'tab-c'], 'BOB'), {'tab-c': ['chat-bob']})
+        rpc.register_connection('ext-carol', ['tab-d'], 'CAROL')
+        rpc.attach_client('chat-late', 'CAROL')
+        self.assertEqual(rpc.clients_for('tab-d'), ['chat-late'])
+
+    def test_reconnect_rebinds_only_to_the_same_pairing(self):
+        rpc = BrowserRPC(channel_layer=mock.Mock())
+        rpc.register_connection('ext-alice', ['tab-a'], 'ALICE')
+        rpc.attach_client('chat-alice', 'ALICE')
+
+        rpc.register_connection('ext-bob', ['tab-b'], 'BOB')
+        self.assertEqual(rpc.unregister_connection('ext-alice'), {})
+        self.assertIsNone(rpc.connection_for('chat-alice'))
+
+        # Alice's extension reconnects with a new channel
+        self.assertEqual(rpc.register_connection('ext-alice-2', ['tab-a'], 'ALICE'), {'tab-a': ['chat-alice']})
+        self.assertEqual(rpc.clients_for('tab-b'), [])
+
+
+class BrowserToolRoutingTests(SimpleTestCase):
+    """Browser tools never fall back to a browser the chat is not paired with."""
+
+    async def test_unpaired_chat_tool_call_fails(self):
+        layer = mock.Mock(send=mock.AsyncMock())
+        rpc = BrowserRPC(channel_layer=layer)
+        rpc.register_connection('ext-bob', ['tab-b'], 'BOB')
+        consumer = mock.Mock(session_id='chat-alice')
+        with mock.patch('api.builtin_tools.get_browser_rpc', return_value=rpc):
+            result = await BuiltinToolManager().execute_tool('browser_navigate', {'url': 'https://example.com'}, consumer)
+
+        self.assertFalse(result['success'])
+        self.assertIn('paired', result['error'])
+        layer.send.assert_not_called()
+
+
+class PageCacheTests(SimpleTestCase):
+    """PageCache evicts old background pages by count and bytes; touched pages stay cached."""
+
+    def test_evicts_oldest_background_page_by_count(self):
+        cache = PageCache(max_entries=2)
+        cache.put('http://active', {'url': 'http://active', 'content': 'A', 'is_active': True})
+        cache.put('http://b', {'url': 'http://b', 'content': 'B'})
+        cache.put('http://c', {'url': 'http://c', 'content': 'C'})
+
+        self.assertEqual([page['url'] for page in cache], ['http://active', 'http://c'])
+        self.assertEqual(cache.active()['url'], 'http://active')
+
+    def test_evicts_by_bytes_but_keeps_active_and_newest_page(self):
+        cache = PageCache(max_bytes=10)
+        cache.put('http://active', {'url': 'http://active', 'content': 'é' * 3, 'is_active': True})  # 6 bytes
+        cache.put('http://b', {'url': 'http://b', 'content': 'bbbb'})
+        self.assertEqual(cache.total_bytes, 10)
+
+        cache.put('http://c', {'url': 'http://c', 'content': 'c' * 20})
+
+        self.assertEqual([page['url'] for page in cache], ['http://active', 'http://c'])
+        self.assertEqual(cache.total_bytes, 26)  # over the limit, but both are kept
+        self.assertIsNone(cache.get('http://b'))
+
+    def test_touch_keeps_background_page_alive(self):
+        cache = PageCache(background_ttl=600)
+        with mock.patch('api.page_cache.time.monotonic', return_value=0):
+            cache.put('http://a', {'url': 'http://a', 'content': 'A'})
+            cache.put('http://b', {'url': 'http://b', 'content': 'B', 'is_active': True})
+        with mock.patch('api.page_cache.time.monotonic', return_value=500):
+            self.assertTrue(cache.touch('http://a'))
+        with mock.patch('api.page_cache.time.monotonic', return_value=1000):
+            self.assertEqual(cache.get('http://a')['content'], 'A')
+        with mock.patch('api.page_cache.time.monotonic', return_value=1200):
+            self.assertIsNone(cache.get('http://a'))
+            self.assertFalse(cache.touch('http://a'))
+
+
+class PageDeltaTests(SimpleTestCase):
+    """Line-op deltas rebuild the page on the last snapshot; a hash mismatch asks for a resync."""
+
+    BASE = 'Revenue\n12B\nMargins\n30%'
+
+    def setUp(self):
+        self.consumer = PageInfoConsumer()
+        self.consumer.send = mock.AsyncMock()
+        self.consumer.send_to_chat_sessions = mock.AsyncMock(return_value=1)
+
+    async def send_full_page(self):
+        await self.consumer.handle_page_delta({
+            'type': 'page_delta', 'base': None, 'url': 'https://a.example',
+            'content': self.BASE, 'hash': page_text_hash(self.BASE), 'session_id': 'tab-1'
+        })
+
+    def test_apply_line_ops(self):
+        text = apply_line_ops(self.BASE, [[1, 2, ['13B', '(restated)']], [3, 4, []]])
+
+        self.assertEqual(text, 'Revenue\n13B\n(restated)\nMargins')
+        with self.assertRaises(PageDeltaError):
+            apply_line_ops(self.BASE, [[2, 3, []], [1, 2, []]])  # out of order
+        with self.assertRaises(PageDeltaError):
+            apply_line_ops(self.BASE, [[3, 5, []]])  # past the last line
+
+    async def test_delta_with_matching_hash_is_forwarded(self):
+        await self.send_full_page()
+        expected = 'Revenue\n13B\nMargins\n30%'
+        await self.consumer.handle_page_delta({
+            'type': 'page_delta', 'base': page_text_hash(self.BASE), 'hash': page_text_hash(expected),
+            'ops': [[1, 2, ['13B']]], 'url': 'https://a.example', 'session_id': 'tab-1'
+        })
+
+        self.consumer.send.assert_not_called()
+        self.assertEqual(self.consumer.send_to_chat_sessions.await_args.args[1]['content'], expected)
+        self.assertEqual(self.consumer.snapshot['content'], expected)
+
+    async def test_hash_mismatch_requests_resync(self):
+        await self.send_full_page()
+        await self.consumer.handle_page_delta({
+            'type': 'page_delta', 'base': page_text_hash(self.BASE), 'hash': page_text_hash('something else'),
+            'ops': [[1, 2, ['13B']]], 'url': 'https://a.example', 'session_id': 'tab-1'
+        })
+
+        self.consumer.send.assert_awaited_once_with(text_data=json.dumps({'type': 'page_resync'}))
+        self.assertIsNone(self.consumer.snapshot)
+        self.assertEqual(self.consumer.send_to_chat_sessions.await_count, 1)  # only the full page
+
+    async def test_unknown_base_requests_resync(self):
+        await self.consumer.handle_page_delta({
+            'type': 'page_delta', 'base': page_text_hash(self.BASE), 'hash': page_text_hash(self.BASE),
+            'ops': [], 'url': 'https://a.example', 'session_id': 'tab-1'
+        })
+
+        self.consumer.send.assert_awaited_once_with(text_data=json.dumps({'type': 'page_resync'}))
+        self.consumer.send_to_chat_sessions.assert_not_called()
+
+
+class ToolCallStreamParserTests(SimpleTestCase):
+    """Tool call blocks end where their JSON ends, not at the first </tool_call> text."""
+
+    def test_flushes_text_after_unterminated_tool_call(self):
+        parser = ToolCallStreamParser()
+        events = []
+        for chunk in ['Checking. <tool_call>\n', '{"tool": "browser_info", "parameters": {}}', '\nThe price is 42.']:
+            events += parser.feed(chunk)
+        events += parser.finish()
+
+        self.assertEqual(events, [
+            ('text', 'Checking. '),
+            ('tool_call', {'tool': 'browser_info', 'parameters': {}}),
+            ('text', 'The price is 42.'),
+        ])
+
+    def test_close_tag_inside_string_argument_does_not_end_call(self):
+        parser = ToolCallStreamParser()
+        events = []
+        for chunk in ['<tool_call>{"tool": "browser_type", "parameters": {"text": "a </tool_call>',
+                      ' b"}}</tool_call>', 'Typed.']:
+            events += parser.feed(chunk)
+        events += parser.finish()
+
+        self.assertEqual(events, [
+            ('tool_call', {'tool': 'browser_type', 'parameters': {'text': 'a </tool_call> b'}}),
+            ('text', 'Typed.'),
+        ])
+
+
+class StreamCoalescerCloseTests(SimpleTestCase):
+    """close() returns only after a frame the flush timer is still sending."""
+
+    async def test_close_waits_for_in_flight_timer_send(self):
+        sent = []
+
+        async def send(text_data=None, bytes_data=None):
+            await asyncio.sleep(0.05)
+            sent.append(json.loads(text_data)['content'])
+
+        coalescer = StreamCoalescer(mock.Mock(send=send), flush_interval=0.01)
+        await coalescer.push('last words')
+        await asyncio.sleep(0.02)  # the timer has taken the buffer and is sending
+        await coalescer.close()
+        sent.append('stream_end')
+
+        self.assertEqual(sent, ['last words', 'stream_end'])
+
+
+class LegacyWebContentTests(SimpleTestCase):
+    """input_webtext keeps one legacy message_list entry per URL."""
+
+    def post_page(self, url, text):
+        return self.client.post('/input_webtext/', json.dumps({
+            'textContent': text, 'currentUrl': url, 'use_r2c': False
+        }), content_type='application/json')
+
+    def test_entries_are_keyed_by_url(self):
+        system = {'role': 'user', 'content': 'system'}
+        store = WebContentStore()
+        with mock.patch.object(views, 'message_list', [system]), \
+                mock.patch.dict(views._legacy_web_entries, clear=True), \
+                mock.patch.object(views, 'get_web_content_store', side_effect=lambda: store), \
+                mock.patch.object(views, '_log_interaction'):
+            # Two URLs with the same text share one blob in the store
+            self.post_page('https://a.example', 'same text')
+            self.post_page('https://b.example', 'same text')
+            self.post_page('https://b.example', 'updated b')
+            self.assertEqual([msg['content'] for msg in views.message_list],
+                             ['system', 'same text', 'updated b'])
+
+            # After the store forgets a URL, its entry is still replaced rather than duplicated
+            store = WebContentStore()
+            self.post_page('https://a.example', 'updated a')
+            self.assertEqual([msg['content'] for msg in views.message_list],
+                             ['system', 'updated a', 'updated b'])
+            self.assertEqual(self.post_page('https://a.example', 'updated a').json()['resp'],
+                             'Text unchanged; already in context')
+
+
+class RagReloadTests(SimpleTestCase):
+    """reload_rag closes the replaced chunk store once no query is using it."""
+
+    def test_old_chunk_store_closes_after_last_reader(self):
+        old_store, new_store = mock.Mock(), mock.Mock()
+        states = iter([cdm_rag._RagState(mock.Mock(), old_store), cdm_rag._RagState(mock.Mock(), new_store)])
+        with mock.patch.object(cdm_rag, '_rag_state', None), \
+                mock.patch.object(cdm_rag, '_load_rag_state', side_effect=lambda: next(states)):
+            with cdm_rag._using_rag_state() as (_, chunk_store):
+                self.assertIs(chunk_store, old_store)
+                cdm_rag.reload_rag()
+                old_store.close.assert_not_called()
+            old_store.close.assert_called_once_with()
+            new_store.close.assert_not_called()
+
+
+class _TrackedPage(WebPage):
+    __slots__ = ('__weakref__',)
+
+
+class R2CSessionEvictionTests(SimpleTestCase):
+    """The shared context manager drops idle and least recently used sessions."""
+
+    def add_page(self, manager, session_id, url):
+        page = _TrackedPage(url, content_digest(url), f"Quarterly report at {url}")
+        manager.add_web_content(session_id, page)
+        return weakref.ref(page)
+
+    def test_least_recently_used_session_releases_its_records(self):
+        manager = R2CContextManager(max_sessions=2)
+        page = self.add_page(manager, 'old', 'https://a.example')
+        manager.add_message('recent', 'user', 'What was revenue?')
+        manager.get_context('old')
+        manager.get_context('recent')  # 'old' is now the least recently used
+        manager.add_message('new', 'user', 'And margins?')
+
+        self.assertEqual(set(manager.sessions), {'recent', 'new'})
+        self.assertIsNone(page())
+        self.assertEqual(len(manager.get_context('old')), 1)  # only the system prompt
+
+    def test_idle_session_expires(self):
+        manager = R2CContextManager(session_ttl=60)
+        with mock.patch('datascraper.r2c_context_manager.time.monotonic', return_value=0):
+            page = self.add_page(manager, 'idle', 'https://a.example')
+        with mock.patch('datascraper.r2c_context_manager.time.monotonic', return_value=61):
+            manager.add_message('active', 'user', 'What was revenue?')
+
+        self.assertEqual(set(manager.sessions), {'active'})
+        self.assertIsNone(page())
+
+
+class R2CBudgetPackingTests(SimpleTestCase):
+    """get_context(model=) packs the latest message, web content, then recent history into the budget."""
+
+    def setUp(self):
+        self.manager = R2CContextManager()
+        self.manager.add_message('s', 'user', 'What did the company report last year?')
+        self.manager.add_message('s', 'assistant', 'Revenue grew eight percent on higher volumes. ' * 5)
+        page = WebPage('https://a.example', content_digest('report'), 'Quarterly revenue was 12 billion dollars.')
+        self.manager.add_web_content('s', page)
+        self.manager.add_message('s', 'assistant', 'The filing covers the third quarter.')
+        self.manager.add_message('s', 'user', 'How does that compare with margins?')
+        self.state = self.manager._snapshot('s')
+
+    def context_with_budget(self, budget):
+        with mock.patch.object(self.manager, 'get_token_budget', return_value=budget):
+            return self.manager.get_context('s', model='any-model')
+
+    def test_prefers_web_content_and_recent_history(self):
+        tokens = self.state.message_tokens
+        budget = self.manager.system_prompt_tokens + tokens[4] + tokens[2] + tokens[3]
+        context = self.context_with_budget(budget)
+
+        messages = self.state.messages
+        self.assertEqual(context[0]['content'], self.manager.system_prompt)
+        self.assertEqual(context[1:], [messages[i].to_payload() for i in (2, 3, 4)])
+
+    def test_always_keeps_latest_message(self):
+        context = self.context_with_budget(self.manager.system_prompt_tokens)
+
+        self.assertEqual(context[1:], [self.state.messages[-1].to_payload()])
+
+    def test_budget_reserves_answer_tokens(self):
+        with mock.patch('datascraper.r2c_context_manager.get_context_window', return_value=8000):
+            self.assertEqual(self.manager.get_token_budget('any-model'), 8000 - self.manager.answer_reserve_tokens)
+
+
+class EmbeddingRetryTests(SimpleTestCase):
+    """BatchingEmbedder retries transient API failures only."""
+
+    def embed_with_failures(self, *failures):
+        backend = LocalEmbedder(dimension=8)
+        outcomes = list(failures)
+
+        def embed_batch(texts):
+            if outcomes:
+                raise outcomes.pop(0)
+            return LocalEmbedder.embed_batch(backend, texts)
+
+        calls = mock.Mock(side_effect=embed_batch)
+        backend.embed_batch = calls
+        with mock.patch('datascraper.embedders.time.sleep'):
+            vectors = BatchingEmbedder(backend, max_workers=1).embed(['revenue grew'])
+        return vectors, calls.call_count
+
+    def test_transient_errors_are_retried(self):
+        server_error = openai.InternalServerError(
+            'unavailable', response=mock.Mock(status_code=503, headers={}), body=None
+        )
+        vectors, calls = self.embed_with_failures(openai.APIConnectionError(request=mock.Mock()), server_error)
+        self.assertEqual(vectors.shape, (1, 8))
+        self.assertEqual(calls, 3)
+
+    def test_programming_errors_fail_immediately(self):
+        with self.assertRaises(TypeError):
+            self.embed_with_failures(TypeError('bad response shape'))
+
+        auth_error = openai.AuthenticationError(
+            'invalid key', response=mock.Mock(status_code=401, headers={}), body=None
+        )
+        backend = mock.Mock(dimension=8, embed_batch=mock.Mock(side_effect=auth_error))
+        with self.assertRaises(openai.AuthenticationError):
+            BatchingEmbedder(backend, max_workers=1).embed(['revenue grew'])
+        self.assertEqual(backend.embed_batch.call_count, 1)
+
+
+class OpenAIToolAdapterTests(SimpleTestCase):
+    """The native tool path caps output tokens below the model's context window."""
+
+    async def test_max_tokens_is_clamped_to_output_limit(self):
+        stream = mock.MagicMock()
+        stream.__aiter__.return_value = []
+        stream.close = mock.AsyncMock()
+        create = mock.AsyncMock(return_value=stream)
+        client = mock.Mock()
+        client.chat.completions.create = create
+        adapter = OpenAIToolAdapter(client, {'model_name': 'gpt-4o', 'max_tokens': 128000}, [])
+        events = [event async for event in adapter.stream_turn([{'role': 'user', 'content': 'hi'}])]
+
+        self.assertEqual(events, [])
+        self.assertEqual(create.call_args.kwargs['max_tokens'], OPENAI_MAX_OUTPUT_TOKENS)
@@ -5,16 +5,16 @@ import asyncio
 import logging
 from datetime import datetime
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from datascraper import datascraper as ds
-from datascraper import create_embeddings as ce
 from datascraper.preferred_links_manager import get_manager
+from datascraper.web_content_store import get_web_content_store
 
 from django.views import View
 from mcp_client.agent import create_fin_agent
 from agents import Runner
-from datascraper.r2c_context_manager import R2CContextManager
-from datascraper.models_config import MODELS_CONFIG
+from datascraper.r2c_context_manager import get_r2c_manager
+from datascraper.models_config import MODELS_CONFIG, get_context_window
 
 # Constants
 QUESTION_LOG_PATH = os.path.join(os.path.dirname(__file__), 'questionLog.csv')
@@ -26,13 +26,11 @@ message_list = [
      "content": "You are a helpful financial assistant. Always answer questions to the best of your ability."}
 ]
 
-# R2C
-r2c_manager = R2CContextManager(
-    max_tokens=20000,
-    compression_ratio=0.5,
-    rho=0.5,
-    gamma=1.0
-)
+# URL -> its web content entry in message_list
+_legacy_web_entries = {}
+
+# R2C (shared with the WebSocket consumers)
+r2c_manager = get_r2c_manager()
 
 class MCPGreetView(View):
     def get(self, request):
@@ -97,7 +95,7 @@ def _get_session_id(request):
         logging.info(f"[R2C DEBUG] Using existing Django session: {request.session.session_key}")
     return request.session.session_key
 
-def _prepare_context_messages(request, question, use_r2c=True):
+def _prepare_context_messages(request, question, use_r2c=True, models=None):
     """
     Prepare context messages using R2C or legacy system.
     
@@ -105,6 +103,8 @@ def _prepare_context_messages(request, question, use_r2c=True):
         request: Django request object
         question: User's question to add
         use_r2c: Whether to use R2C context management
+        models: Models that will consume the context; R2C packs the history
+            into the smallest of their token limits
         
     Returns:
         tuple: (legacy_messages, session_id)
@@ -114,7 +114,9 @@ def _prepare_context_messages(request, question, use_r2c=True):
     if use_r2c and session_id:
         r2c_manager.add_message(session_id, "user", question)
 
-        context_messages = r2c_manager.get_context(session_id)
+        # The same context is shared by every selected model, so fit the tightest one
+        budget_model = min(models, key=get_context_window) if models else None
+        context_messages = r2c_manager.get_context(session_id, model=budget_model)
         
         # R2C already includes system prompt and handles compression
         # Just use the context messages directly
@@ -225,6 +227,23 @@ def _log_interaction(button_clicked, current_url, question, response=None):
             writer = csv.writer(log_file)
             writer.writerow([button_clicked, current_url, question, date_str, time_str, response_preview])
 
+def _upsert_legacy_web_content(url, page):
+    """
+    Keep a single legacy message_list entry per URL.
+    Entries are keyed by URL, not by text, since pages with identical text share one blob.
+    """
+    entry = _legacy_web_entries.get(url)
+    index = next((i for i, msg in enumerate(message_list) if msg is entry), None) if entry is not None else None
+    if index is not None and entry["content"] == page.content:
+        return False
+    entry = {"role": "user", "content": page.content}
+    if index is None:
+        message_list.append(entry)
+    else:
+        message_list[index] = entry
+    _legacy_web_entries[url] = entry
+    return True
+
 # View to handle appending the text from FRONT-END SCRAPER to the message list
 @csrf_exempt
 def add_webtext(request):
@@ -245,20 +264,22 @@ def add_webtext(request):
             logging.warning("[R2C DEBUG] No text content provided")
             return JsonResponse({"error": "No textContent provided."}, status=400)
 
-        message_list.append({
-            "role": "user",
-            "content": text_content
-        })
+        # Pages are stored once by URL and content hash; sessions keep references
+        page, _ = get_web_content_store().put(current_url, text_content)
+        changed = _upsert_legacy_web_content(current_url, page)
 
         if use_r2c:
             session_id = _get_session_id(request)
             if session_id:
                 logging.info(f"[R2C DEBUG] Adding web content to session {session_id}, URL: {current_url}, content length: {len(text_content)}")
-                r2c_manager.add_message(session_id, "user", f"[Web Content from {current_url}]: {text_content}")
+                changed = r2c_manager.add_web_content(session_id, page)
                 # Log session stats after adding
                 stats = r2c_manager.get_session_stats(session_id)
                 logging.info(f"[R2C DEBUG] Session {session_id} stats after web content: {stats}")
 
+        if not changed:
+            return JsonResponse({"resp": "Text unchanged; already in context"})
+
         _log_interaction("add_webtext", current_url, f"Added web content: {text_content[:20]}...")
         
         return JsonResponse({"resp": "Text added successfully as user message"})
@@ -286,7 +307,7 @@ def chat_response(request):
     responses = {}
     
     # Prepare context messages using R2C or legacy system
-    legacy_messages, session_id = _prepare_context_messages(request, question, use_r2c)
+    legacy_messages, session_id = _prepare_context_messages(request, question, use_r2c, models)
     logging.info(f"[R2C DEBUG] Prepared {len(legacy_messages)} messages for session {session_id}")
     
     # Log message contents for debugging
@@ -336,7 +357,7 @@ def mcp_chat_response(request):
     responses = {}
     
     # Prepare context messages using R2C or legacy system
-    legacy_messages, session_id = _prepare_context_messages(request, question, use_r2c)
+    legacy_messages, session_id = _prepare_context_messages(request, question, use_r2c, models)
 
     for model in models:
         try:
@@ -392,7 +413,7 @@ def adv_response(request):
     responses = {}
     
     # Prepare context messages using R2C or legacy system
-    legacy_messages, session_id = _prepare_context_messages(request, question, use_r2c)
+    legacy_messages, session_id = _prepare_context_messages(request, question, use_r2c, models)
     
     for model in models:
         try:
@@ -439,6 +460,8 @@ def clear(request):
         
         message_list.clear()
         message_list.extend(preserved_messages)
+        for url in [url for url, msg in _legacy_web_entries.items() if not any(msg is kept for kept in message_list)]:
+            del _legacy_web_entries[url]
     
     # Clear only conversation in R2C if enabled
     if use_r2c:
@@ -584,18 +607,90 @@ def folder_path(request):
             json_data = json.loads(file.read())
             # print("[DEBUG] json_data: ", json_data)
 
-            # Create embeddings for files
-            response_data, status_code = ce.upload_folder(json_data)
-            print("[DEBUG] Flask API response:", response_data)
-            print("[DEBUG] Response status code:", status_code)
+            # Index in the background; poll api/rag_jobs/<job_id> for progress
+            from datascraper.indexing_jobs import get_job_manager, spool_ndjson
+            # Body: {"filePaths": [{"name": ..., "content": ...}, ...]}
+            ndjson_path = spool_ndjson(
+                (json.dumps({'name': item.get('name'), 'content': item.get('content')}) + "\n").encode('utf-8')
+                for item in json_data.get('filePaths', [])
+            )
+            job = get_job_manager().submit(ndjson_path=ndjson_path, source='folder_path')
+            print("[DEBUG] Queued indexing job:", job.job_id)
 
-            return JsonResponse(response_data, status=status_code)
+            return JsonResponse({'message': 'Indexing started', 'job_id': job.job_id}, status=202)
 
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
     else:
         return JsonResponse({'error': 'Only POST requests allowed'}, status=405)
 
+@csrf_exempt
+async def folder_path_stream(request):
+    """
+    Upload files for the RAG as NDJSON, one {"name": ..., "content": ...} object per line.
+    The response streams a "job" event with the job id, NDJSON progress events,
+    then a "done", "cancelled" or "error" event.
+    Under ASGI the server receives the whole body before the view runs, so
+    indexing starts once the upload is complete; progress is streamed live.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests allowed'}, status=405)
+
+    from datascraper import create_embeddings as ce
+    from datascraper.indexing_jobs import get_job_manager
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_event(event):
+        # Called on the indexing thread; hand the event to the response's event loop
+        if event['type'] == 'failed':
+            logging.error(f"Streaming folder upload failed: {event['error']}")
+            event = {'type': 'error', 'job_id': event['job_id'], 'error': event['error']}
+        loop.call_soon_threadsafe(events.put_nowait, event)
+        if event['type'] != 'progress':
+            loop.call_soon_threadsafe(events.put_nowait, None)
+
+    job = get_job_manager().submit(
+        files=ce.iter_ndjson_files(request), source='folder_path_stream', listener=on_event
+    )
+
+    async def event_stream():
+        yield json.dumps({'type': 'job', 'job_id': job.job_id}) + "\n"
+        while True:
+            event = await events.get()
+            if event is None:
+                return
+            yield json.dumps(event) + "\n"
+
+    return StreamingHttpResponse(event_stream(), content_type='application/x-ndjson')
+
+def rag_jobs(request):
+    """List RAG indexing jobs, newest first."""
+    from datascraper.indexing_jobs import get_job_manager
+    jobs = [job.to_dict() for job in reversed(get_job_manager().list_jobs())]
+    return JsonResponse({'jobs': jobs})
+
+def rag_job_status(request, job_id):
+    """Status and progress of one RAG indexing job."""
+    from datascraper.indexing_jobs import get_job_manager
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+    return JsonResponse(job.to_dict())
+
+@csrf_exempt
+def cancel_rag_job(request, job_id):
+    """Cancel a queued or running RAG indexing job; the current index is kept."""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests allowed'}, status=405)
+    from datascraper.indexing_jobs import get_job_manager
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+    if not job.cancel():
+        return JsonResponse({'error': f'Job already {job.status}'}, status=409)
+    return JsonResponse({'message': 'Cancellation requested', 'job_id': job_id})
+
 
 # MCP Management API Endpoints
 
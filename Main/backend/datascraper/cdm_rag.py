@@ -2,13 +2,14 @@
 from dotenv import load_dotenv
 import os
 # import re
-import pickle
 import numpy as np
-import faiss
 import openai
-import ast  # For Python code parsing
-import markdown  # For Markdown parsing
 import logging
+import threading
+from contextlib import contextmanager
+from .embedders import EmbeddingCache, get_embedder
+from . import rag_store
+from . import vector_index
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
@@ -26,84 +27,238 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-# Global variables for index and embeddings
-index = None
-all_chunks = None
+# Loaded (index, chunk store) pair. Replaced as a whole, so a query always
+# sees an index and chunk store from the same load.
+_rag_state = None
+_rag_lock = threading.Lock()
+
+# Number of chunks retrieved per question
+DEFAULT_TOP_K = 3
+
+# Hybrid retrieval: vector and BM25 rankings are merged by reciprocal rank fusion
+RRF_K = 60
+DEFAULT_VECTOR_WEIGHT = 1.0
+DEFAULT_LEXICAL_WEIGHT = 1.0
+# Candidates taken from each ranking per chunk returned
+CANDIDATE_MULTIPLIER = 4
+
+# Query embeddings are reused for repeated questions within an hour
+_query_cache = EmbeddingCache(max_entries=1024, ttl_seconds=3600)
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
-def initialize_rag():
+class _RagState:
     """
-    Initializes the RAG components by loading the FAISS index and chunk list.
+    An index and the chunk store opened with it.
+    Once replaced, its chunk store is closed as soon as no query is using it.
     """
-    global index, all_chunks
-    index_file = os.path.join(current_dir, 'faiss_index.idx')
-    embeddings_file = os.path.join(current_dir, 'embeddings.pkl')
+    __slots__ = ("index", "chunk_store", "readers", "retired")
 
-    if os.path.exists(index_file) and os.path.exists(embeddings_file):
-        # Load FAISS index
-        index = faiss.read_index(index_file)
+    def __init__(self, index, chunk_store):
+        self.index = index
+        self.chunk_store = chunk_store
+        self.readers = 0
+        self.retired = False
 
-        # Load chunks list (with text, metadata, embedding)
-        with open(embeddings_file, 'rb') as f:
-            all_chunks = pickle.load(f)
+def _load_rag_state():
+    """
+    Memory-maps the FAISS index of the current manifest generation and opens
+    the chunk store, without publishing them.
+    """
+    manifest = rag_store.load_manifest()
+    if manifest is None or manifest.get("version") != rag_store.MANIFEST_VERSION:
+        raise FileNotFoundError(f"Missing files for RAG: {rag_store.manifest_file}")
 
-        print("Loaded existing FAISS index and chunk data.")
-    else:
-        missing = []
-        if not os.path.exists(index_file):
-            missing.append(index_file)
-        if not os.path.exists(embeddings_file):
-            missing.append(embeddings_file)
+    index_file = rag_store.generation_files(manifest["generation"])["index"]
+    missing = [path for path in (index_file, rag_store.chunks_db_file) if not os.path.exists(path)]
+    if missing:
         raise FileNotFoundError(f"Missing files for RAG: {', '.join(missing)}")
 
-def load_index_and_embeddings(index_file='faiss_index.idx', embeddings_file='embeddings.pkl'):
+    # Load FAISS index; pages are read on demand and shared between processes
+    loaded_index = rag_store.read_index(index_file)
+    vector_index.configure_search(loaded_index)
+
+    # Chunk text and metadata are fetched from SQLite per query
+    chunk_store = rag_store.ChunkStore()
+
+    print("Loaded existing FAISS index and chunk data.")
+    return _RagState(loaded_index, chunk_store)
+
+def initialize_rag():
     """
-    Loads the FAISS index and embeddings with metadata from disk.
+    Initializes the RAG components if they are not loaded yet.
     """
-    index = faiss.read_index(index_file)
-    with open(embeddings_file, 'rb') as f:
-        embeddings_data = pickle.load(f)
-        embeddings = embeddings_data['embeddings']
-
-    return index, embeddings
+    global _rag_state
+    with _rag_lock:
+        if _rag_state is None:
+            _rag_state = _load_rag_state()
+    return _rag_state
 
-def embed_query(query, model="text-embedding-3-large"):
+@contextmanager
+def _using_rag_state():
     """
-    Generates an embedding for the query text.
+    Yields the current (index, chunk store) for the duration of a query.
+    A state replaced meanwhile stays open until its last query finishes.
     """
-    # response = openai.Embedding.create(
-    #     input=query,
-    #     model=model
-    # )
-    # return response['data'][0]['embedding']
-    response = openai.Embedding.create(
-        input=query,
-        model=model
-    )
-    return response['data'][0]['embedding']
+    global _rag_state
+    with _rag_lock:
+        if _rag_state is None:
+            _rag_state = _load_rag_state()
+        state = _rag_state
+        state.readers += 1
+    try:
+        yield state.index, state.chunk_store
+    finally:
+        with _rag_lock:
+            state.readers -= 1
+            close = state.retired and state.readers == 0
+        if close:
+            state.chunk_store.close()
 
+def _replace_rag_state(state):
+    """Publishes `state` and closes the previous chunk store once it is idle."""
+    global _rag_state
+    with _rag_lock:
+        previous, _rag_state = _rag_state, state
+        close = False
+        if previous is not None:
+            previous.retired = True
+            close = previous.readers == 0
+    if close:
+        previous.chunk_store.close()
 
-def retrieve_chunks(query, k=1):
+def reload_rag():
     """
-    Retrieves the most relevant chunks for a given query.
+    Loads the latest index generation and swaps it in atomically.
+    Queries keep using the previous index until the new one is fully loaded.
+    """
+    try:
+        state = _load_rag_state()
+    except FileNotFoundError as e:
+        logging.info(f"RAG index unavailable after reload: {e}")
+        state = None
+    _replace_rag_state(state)
+
+def warm_up():
     """
-    global index, all_chunks
-    if index is None or all_chunks is None:
+    Loads the index and chunk store ahead of the first RAG question.
+    Safe to call when no index has been built yet.
+    """
+    try:
         initialize_rag()
+        get_embedder()
+        logging.info("RAG warm-up complete")
+    except FileNotFoundError as e:
+        logging.info(f"RAG warm-up skipped: {e}")
 
-    # Prepare the query vector
-    query_embedding = embed_query(query)
-    query_vector = np.array([query_embedding], dtype='float32')
-    faiss.normalize_L2(query_vector)  # Normalizing if index was built from normalized embeddings
+def reset_rag():
+    """
+    Drops the loaded index and chunks so the next query reloads them from disk.
+    """
+    _replace_rag_state(None)
 
-    # Search
-    distances, idxs = index.search(query_vector, k)
-    # idxs is shape (1, k), e.g. [[1, 10, 0, ...]]
+def embed_queries(queries):
+    """
+    Generates embeddings for several queries with the same embedder used for indexing.
+    Cached queries are served from memory; the rest are embedded in one request.
+    """
+    embedder = get_embedder()
+    model = embedder.embedder.model
+    keys = [_query_cache.key(model, query) for query in queries]
+    vectors = [_query_cache.get(key) for key in keys]
+
+    # Embed each distinct missing query once
+    missing = {}
+    for query, key, vector in zip(queries, keys, vectors):
+        if vector is None and key not in missing:
+            missing[key] = query
+    if missing:
+        for key, vector in zip(missing, embedder.embed(list(missing.values()))):
+            _query_cache.put(key, vector)
+            missing[key] = vector
+        vectors = [missing[key] if vector is None else vector for key, vector in zip(keys, vectors)]
 
-    # Map each index to the chunk in `all_chunks`
-    results = [all_chunks[i] for i in idxs[0]]
-    return results
+    return np.array(vectors, dtype='float32').reshape(len(queries), embedder.dimension)
+
+def embed_query(query):
+    """
+    Generates an embedding for the query text with the same embedder used for indexing.
+    """
+    return embed_queries([query])[0]
+
+
+def reciprocal_rank_fusion(rankings, weights, k, rrf_k=RRF_K):
+    """
+    Merges ranked id lists: each id scores sum(weight / (rrf_k + rank)).
+
+    Args:
+        rankings: Lists of ids, best first
+        weights: One weight per ranking
+        k: Number of ids to return
+        rrf_k: Damping constant; larger values flatten the rank curve
+
+    Returns:
+        The k best ids, best first.
+    """
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + weight / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+def retrieve_chunks_batch(queries, k=DEFAULT_TOP_K, vector_weight=DEFAULT_VECTOR_WEIGHT,
+                          lexical_weight=DEFAULT_LEXICAL_WEIGHT):
+    """
+    Retrieves the most relevant chunks for each of several queries.
+    Vector search embeds all queries in one request and runs a single FAISS
+    search; BM25 search catches exact tickers, form numbers and figures.
+    The two rankings are merged with reciprocal rank fusion.
+
+    Args:
+        queries: Query strings
+        k: Chunks returned per query
+        vector_weight: Weight of the embedding ranking (0 disables it)
+        lexical_weight: Weight of the BM25 ranking (0 disables it)
+
+    Returns:
+        One list of chunks per query, in query order.
+    """
+    with _using_rag_state() as (index, all_chunks):
+        if not queries:
+            return []
+
+        candidates = min(k * CANDIDATE_MULTIPLIER, index.ntotal)
+        if k <= 0 or candidates == 0:
+            return [[] for _ in queries]
+
+        vector_rankings = [[] for _ in queries]
+        if vector_weight > 0:
+            # The index holds L2-normalized vectors, so inner product is cosine similarity
+            query_vectors = vector_index.normalize(embed_queries(queries))
+            distances, idxs = index.search(query_vectors, candidates)
+            # idxs is shape (len(queries), candidates); FAISS pads missing results with -1
+            vector_rankings = [[int(i) for i in row if i >= 0] for row in idxs]
+
+        lexical_rankings = [[] for _ in queries]
+        if lexical_weight > 0:
+            lexical_rankings = [all_chunks.search_lexical(query, candidates) for query in queries]
+
+        ids_per_query = [
+            reciprocal_rank_fusion((vector_ids, lexical_ids), (vector_weight, lexical_weight), k)
+            for vector_ids, lexical_ids in zip(vector_rankings, lexical_rankings)
+        ]
+
+        # Map each id to its chunk; ids removed by a sync that another process has
+        # just published are skipped
+        found = all_chunks.get_many({i for ids in ids_per_query for i in ids})
+        return [[found[i] for i in ids if i in found] for ids in ids_per_query]
+
+def retrieve_chunks(query, k=DEFAULT_TOP_K, vector_weight=DEFAULT_VECTOR_WEIGHT,
+                    lexical_weight=DEFAULT_LEXICAL_WEIGHT):
+    """
+    Retrieves the most relevant chunks for a given query.
+    """
+    return retrieve_chunks_batch([query], k, vector_weight, lexical_weight)[0]
 
 def generate_answer(query, relevant_chunks, model_name):
     """
@@ -112,8 +267,11 @@ def generate_answer(query, relevant_chunks, model_name):
     # Build a string context from the chunk data
     context = ""
     for chunk in relevant_chunks:
-        file_path = chunk['metadata']['file_path']
+        metadata = chunk['metadata']
+        file_path = metadata['file_path']
         text = chunk['text']
+        if 'start_byte' in metadata:
+            file_path = f"{file_path} (bytes {metadata['start_byte']}-{metadata['end_byte']})"
         context += f"File: {file_path}\nContent:\n{text}\n\n"
 
     # prompt
@@ -144,11 +302,10 @@ def get_rag_response(question, model_name="o1-preview"):
     """
     Generates a response using the RAG pipeline with the specified model.
     """
-    if index is None or all_chunks is None:
-        initialize_rag()
+    initialize_rag()
 
-        # 1. Retrieve relevant chunks
-    relevant_chunks = retrieve_chunks(question, k=1)
+    # 1. Retrieve relevant chunks
+    relevant_chunks = retrieve_chunks(question, k=DEFAULT_TOP_K)
 
     # 2. Log them
     logging.info("\nRetrieved Chunks:")
@@ -0,0 +1,177 @@
+"""
+Document chunking for the RAG pipeline.
+Splits files into token-bounded, overlapping chunks before embedding.
+Markdown is split on headings and Python on top-level definitions first,
+so chunks follow the document structure where possible.
+"""
+
+import ast  # For Python code parsing
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import tiktoken
+
+# text-embedding-3-large accepts up to 8191 tokens; smaller chunks keep
+# retrieved passages focused and prompts short.
+DEFAULT_CHUNK_TOKENS = 512
+DEFAULT_OVERLAP_TOKENS = 64
+EMBEDDING_ENCODING = "cl100k_base"
+
+MARKDOWN_EXTENSIONS = (".md", ".markdown")
+PYTHON_EXTENSIONS = (".py",)
+
+_HEADING_RE = re.compile(r"^#{1,6}\s+(.*)$")
+_FENCE_RE = re.compile(r"^(```|~~~)")
+
+
+@lru_cache(maxsize=None)
+def _get_encoding():
+    """Load the embedding model's tokenizer once."""
+    return tiktoken.get_encoding(EMBEDDING_ENCODING)
+
+
+def _line_starts(content: str) -> List[int]:
+    """Character offset at which each line starts."""
+    starts = [0]
+    for line in content.splitlines(keepends=True):
+        starts.append(starts[-1] + len(line))
+    return starts
+
+
+def _markdown_sections(content: str) -> List[Tuple[int, Optional[str]]]:
+    """Section boundaries (char offset, heading) at Markdown headings outside code fences."""
+    sections = [(0, None)]
+    in_fence = False
+    offset = 0
+    for line in content.splitlines(keepends=True):
+        stripped = line.strip()
+        if _FENCE_RE.match(stripped):
+            in_fence = not in_fence
+        elif not in_fence:
+            match = _HEADING_RE.match(stripped)
+            if match and offset > 0:
+                sections.append((offset, match.group(1).strip()))
+            elif match:
+                sections[0] = (0, match.group(1).strip())
+        offset += len(line)
+    return sections
+
+
+def _python_sections(content: str) -> List[Tuple[int, Optional[str]]]:
+    """Section boundaries (char offset, name) at top-level functions and classes."""
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError):
+        return [(0, None)]
+
+    starts = _line_starts(content)
+    sections = [(0, None)]
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        # Decorators belong to the definition they decorate
+        first_line = min([node.lineno] + [d.lineno for d in node.decorator_list])
+        offset = starts[first_line - 1]
+        if offset == 0:
+            sections[0] = (0, node.name)
+        else:
+            sections.append((offset, node.name))
+    return sections
+
+
+def _split_sections(file_path: str, content: str) -> List[Tuple[int, int, Optional[str]]]:
+    """Split content into (start_char, end_char, title) sections based on file type."""
+    lower = file_path.lower()
+    if lower.endswith(MARKDOWN_EXTENSIONS):
+        boundaries = _markdown_sections(content)
+    elif lower.endswith(PYTHON_EXTENSIONS):
+        boundaries = _python_sections(content)
+    else:
+        boundaries = [(0, None)]
+
+    sections = []
+    for i, (start, title) in enumerate(boundaries):
+        end = boundaries[i + 1][0] if i + 1 < len(boundaries) else len(content)
+        if end > start:
+            sections.append((start, end, title))
+    return sections
+
+
+def chunk_document(
+    file_path: str,
+    content: str,
+    max_tokens: int = DEFAULT_CHUNK_TOKENS,
+    overlap_tokens: int = DEFAULT_OVERLAP_TOKENS
+) -> List[Dict]:
+    """
+    Split a document into chunks of at most max_tokens tokens.
+
+    Adjacent small sections are merged; sections longer than max_tokens are
+    cut into windows that overlap by overlap_tokens.
+
+    Args:
+        file_path: Name of the file, used to pick the structure-aware splitter
+        content: Full file text
+        max_tokens: Maximum tokens per chunk
+        overlap_tokens: Tokens shared between consecutive windows of a long section
+
+    Returns:
+        List of chunk dicts with "text" and "metadata" (file_path, chunk_index,
+        start_byte, end_byte, section). Byte offsets refer to the UTF-8 file content.
+    """
+    if not content:
+        return []
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens must be smaller than max_tokens")
+
+    encoding = _get_encoding()
+    data = content.encode("utf-8")
+
+    # Tokenize each section once, keeping the byte length of every token
+    sections = []
+    byte_offset = 0
+    for start, end, title in _split_sections(file_path, content):
+        text = content[start:end]
+        token_bytes = [len(encoding.decode_single_token_bytes(t)) for t in encoding.encode(text, disallowed_special=())]
+        sections.append((byte_offset, token_bytes, title))
+        byte_offset += len(text.encode("utf-8"))
+
+    # Merge adjacent sections that fit together in one chunk
+    merged = []
+    for section in sections:
+        if merged and len(merged[-1][1]) + len(section[1]) <= max_tokens:
+            prev_start, prev_tokens, prev_title = merged[-1]
+            merged[-1] = (prev_start, prev_tokens + section[1], prev_title or section[2])
+        else:
+            merged.append(section)
+
+    chunks = []
+    step = max_tokens - overlap_tokens
+    for section_start, token_bytes, title in merged:
+        # Cumulative byte offsets of token boundaries within the section
+        offsets = [section_start]
+        for size in token_bytes:
+            offsets.append(offsets[-1] + size)
+
+        window_start = 0
+        while True:
+            window_end = min(window_start + max_tokens, len(token_bytes))
+            start_byte, end_byte = offsets[window_start], offsets[window_end]
+            text = data[start_byte:end_byte].decode("utf-8", errors="ignore")
+            if text.strip():
+                chunks.append({
+                    "text": text,
+                    "metadata": {
+                        "file_path": file_path,
+                        "chunk_index": len(chunks),
+                        "start_byte": start_byte,
+                        "end_byte": end_byte,
+                        "section": title
+                    }
+                })
+            if window_end >= len(token_bytes):
+                break
+            window_start += step
+
+    return chunks
@@ -5,7 +5,14 @@ import openai
 import pickle
 import numpy as np
 import faiss
+import hashlib
 import json
+import threading
+from . import cdm_rag
+from . import rag_store
+from . import vector_index
+from .chunking import chunk_document
+from .embedders import get_embedder
 # OpenAI API key
 # Load .env from the backend root directory
 from pathlib import Path
@@ -15,97 +22,397 @@ api_key = os.getenv("OPENAI_API_KEY")
 openai.api_key = api_key
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
-index_file = os.path.join(current_dir, 'faiss_index.idx')
-embeddings_file = os.path.join(current_dir, 'embeddings.pkl')
+# Files written by versions that stored chunks in a pickle; read once to reuse their embeddings
+legacy_embeddings_file = os.path.join(current_dir, 'embeddings.pkl')
+
+# Rows copied at a time when writing a new vector file
+COPY_BLOCK_ROWS = 65536
+
+# New chunks embedded per flush while streaming files; bounds the text held in memory
+EMBED_FLUSH_CHUNKS = 512
+
+# One sync at a time: each writes the next index generation
+_sync_lock = threading.Lock()
 
 # Helper function to generate embeddings
 def embed_file_content(file_content):
     """
-    Function to send file content to OpenAI's embedding API and get embeddings.
+    Function to send file content to the embedding API and get embeddings.
+    """
+    return get_embedder().embed([file_content])[0]
+
+# Helper function to create a FAISS index
+def create_faiss_index(ids, vectors):
+    """
+    Create a FAISS index from `vectors`, one row per id in `ids`.
+    The ids are stored in the index so chunks can later be removed or
+    replaced in place. The index type (flat, HNSW or IVF-PQ) is chosen by
+    corpus size.
+    """
+    print("Creating index with dimension:", vectors.shape[1])
+    index = vector_index.build_index(vectors, ids)
+    print("Embeddings numpy shape:", vectors.shape)
+    return index
+
+def _hash_text(text):
+    """SHA-256 of a file or chunk's text, used to detect changes."""
+    return hashlib.sha256(text.encode("utf-8", errors="replace")).hexdigest()
+
+def _new_manifest(embedder):
+    return {
+        "version": rag_store.MANIFEST_VERSION,
+        "embedding_model": embedder.embedder.model,
+        "dimension": embedder.dimension,
+        "next_id": 0,
+        "generation": 0,
+        "num_chunks": 0,
+        "files": {}
+    }
+
+def _legacy_embeddings(embedder):
+    """Embeddings from a pickle written by an older version, keyed by chunk text hash."""
+    reusable = {}
+    if not os.path.exists(legacy_embeddings_file):
+        return reusable
+    try:
+        with open(legacy_embeddings_file, 'rb') as f:
+            old_chunks = pickle.load(f)
+    except Exception as e:
+        print(f"[DEBUG] Could not load {legacy_embeddings_file}: {e}")
+        return reusable
+    values = old_chunks.values() if isinstance(old_chunks, dict) else old_chunks
+    for chunk in values:
+        embedding = chunk.get("embedding")
+        if embedding is not None and len(embedding) == embedder.dimension:
+            reusable[_hash_text(chunk["text"])] = np.asarray(embedding, dtype='float32')
+    return reusable
+
+def load_index_state(embedder, store):
     """
-    response = openai.Embedding.create(
-        input=file_content,
-        model="text-embedding-3-large"
+    Load the manifest, FAISS index and stored embeddings from disk.
+
+    Returns:
+        Tuple of (manifest, index, ids, vectors, reusable). `ids` are the
+        sorted chunk ids and `vectors` the memory-mapped embeddings, one row
+        per id. When there is no compatible state on disk (first run, older
+        storage format, or a different embedding model), an empty state is
+        returned and `reusable` maps chunk text hashes to embeddings from a
+        legacy pickle so unchanged text is not re-embedded.
+    """
+    manifest = rag_store.load_manifest()
+    compatible = (
+        manifest is not None
+        and manifest.get("version") == rag_store.MANIFEST_VERSION
+        and manifest.get("embedding_model") == embedder.embedder.model
+        and manifest.get("dimension") == embedder.dimension
     )
-    return response['data'][0]['embedding']
+    if compatible:
+        files = rag_store.generation_files(manifest["generation"])
+        try:
+            if manifest["num_chunks"]:
+                # A writable in-memory copy; the published file stays untouched
+                index = faiss.read_index(files["index"])
+                ids, vectors = rag_store.load_vectors(manifest["generation"])
+            else:
+                index = None
+                ids = np.zeros(0, dtype='int64')
+                vectors = np.zeros((0, embedder.dimension), dtype='float32')
+            # Rows written by a sync that failed before publishing its manifest
+            store.write({}, store.ids_from(manifest["next_id"]))
+            return manifest, index, ids, vectors, {}
+        except (OSError, RuntimeError) as e:
+            print(f"[DEBUG] Could not load index generation {manifest['generation']}: {e}")
 
-# Helper function to store embeddings (pickling embeddings)
-def store_embeddings(embeddings, file_paths):
+    # Start over
+    reusable = _legacy_embeddings(embedder)
+    store.clear()
+    fresh = _new_manifest(embedder)
+    if manifest is not None:
+        # Never reuse generation numbers another process may still have mapped
+        fresh["generation"] = manifest.get("generation", 0) + 1
+    print(f"[DEBUG] Starting a new index ({len(reusable)} reusable embeddings)")
+    return (fresh, None, np.zeros(0, dtype='int64'),
+            np.zeros((0, embedder.dimension), dtype='float32'), reusable)
+
+class _VectorSpill:
     """
-    Store the generated embeddings and file paths into a pickle file.
+    Append-only float32 file for embeddings produced during a sync, so memory
+    stays bounded however many chunks a folder has.
     """
-    embeddings_data = {'file_paths': file_paths, 'embeddings': embeddings}
-    with open(embeddings_file, 'wb') as f:
-        pickle.dump(embeddings_data, f)
 
-# Helper function to create a FAISS index
-def create_faiss_index(chunks):
+    def __init__(self, path, dimension):
+        self.path = path
+        self.dimension = dimension
+        self.ids = []
+        self._file = open(path, 'wb')
+
+    def append(self, chunk_id, vector):
+        self._file.write(np.asarray(vector, dtype='float32').tobytes())
+        self.ids.append(chunk_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def finish(self):
+        """Close the file; return (sorted ids, row order for those ids, memory-mapped rows)."""
+        self._file.close()
+        ids = np.array(self.ids, dtype='int64')
+        order = np.argsort(ids, kind='stable')
+        if not len(ids):
+            return ids, order, np.zeros((0, self.dimension), dtype='float32')
+        rows = np.memmap(self.path, dtype='float32', mode='r', shape=(len(ids), self.dimension))
+        return ids[order], order, rows
+
+    def remove(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def _write_vectors(path, old_ids, old_vectors, keep_mask, added_ids, added_order, added_rows):
     """
-    Create and store a FAISS index from the embeddings in `chunks`.
-    Each item in `chunks` is expected to be a dict with key "embedding".
+    Write kept old rows followed by added rows to a new .npy file.
+    New ids are always larger than existing ones, so rows stay sorted by id.
     """
-    # Assume at least one chunk
-    dimension = len(chunks[0]["embedding"])
-    index = faiss.IndexFlatL2(dimension)  # L2 distance metric
-    print("Creating index with dimension:", dimension)
+    total = int(keep_mask.sum()) + len(added_ids)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=(total, old_vectors.shape[1]))
+    row = 0
+    for start in range(0, len(old_ids), COPY_BLOCK_ROWS):
+        block = old_vectors[start:start + COPY_BLOCK_ROWS][keep_mask[start:start + COPY_BLOCK_ROWS]]
+        out[row:row + len(block)] = block
+        row += len(block)
+    for start in range(0, len(added_ids), COPY_BLOCK_ROWS):
+        block = added_rows[added_order[start:start + COPY_BLOCK_ROWS]]
+        out[row:row + len(block)] = block
+        row += len(block)
+    out.flush()
+    del out
+    return np.concatenate([old_ids[keep_mask], added_ids])
 
-    # Extract all embeddings into a NumPy array
-    embeddings_np = np.array(
-        [chunk["embedding"] for chunk in chunks], dtype='float32'
-    )
-    index.add(embeddings_np)
-    print("Embeddings numpy shape:", embeddings_np.shape)
+def sync_index(files, progress=None, reload=True):
+    """
+    Bring the index in line with `files`, embedding only new or changed chunks.
+
+    Files are processed one at a time and embeddings are flushed to disk in
+    batches, so `files` can be a lazy stream of arbitrary total size.
 
-    # Store
-    faiss.write_index(index, index_file)
+    Args:
+        files: Dict mapping file name to full file content, or an iterable of
+            (file name, content) pairs. Files indexed earlier but missing
+            here are removed from the index.
+        progress: Optional callable receiving a copy of the running stats
+            (plus "file") after each file. An exception raised by it aborts
+            the sync and leaves the published index untouched.
+        reload: Swap the new index into cdm_rag when done. Pass False when
+            syncing in a process that does not serve queries.
+
+    Returns:
+        Dict of counts: files added/updated/removed/unchanged and chunks
+        embedded/reused/removed.
+    """
+    if isinstance(files, dict):
+        files = files.items()
+    embedder = get_embedder()
+    with _sync_lock:
+        store = rag_store.ChunkStore(readonly=False)
+        try:
+            return _sync_index(files, embedder, store, progress, reload)
+        except BaseException:
+            store.rollback()
+            raise
+        finally:
+            store.close()
+
+def _sync_index(files, embedder, store, progress, reload):
+    manifest, index, old_ids, old_vectors, reusable = load_index_state(embedder, store)
+    stats = dict.fromkeys(
+        ("files_added", "files_updated", "files_removed", "files_unchanged",
+         "chunks_embedded", "chunks_reused", "chunks_removed"), 0)
+
+    def stored_vector(chunk_id):
+        row = int(np.searchsorted(old_ids, chunk_id))
+        if row < len(old_ids) and old_ids[row] == chunk_id:
+            return old_vectors[row]
+        return None
+
+    # Chunks already on disk, by text hash, for content moved between files
+    stored_by_hash = store.ids_by_hash()
+
+    old_generation = manifest["generation"]
+    new_files = rag_store.generation_files(old_generation + 1)
+    spill = _VectorSpill(new_files["vectors"] + ".added.tmp", embedder.dimension)
+
+    removed_ids = []
+    changed = False
+    pending = []   # (chunk id, text) pairs that still need an embedding
+    seen = set()
+
+    def flush_pending():
+        if pending:
+            embeddings = embedder.embed([text for _, text in pending])
+            for (chunk_id, _), embedding in zip(pending, embeddings):
+                spill.append(chunk_id, embedding)
+            stats["chunks_embedded"] += len(pending)
+            pending.clear()
+
+    try:
+        for file_name, content in files:
+            seen.add(file_name)
+            file_hash = _hash_text(content)
+            previous = manifest["files"].get(file_name)
+            if previous is not None and previous["hash"] == file_hash:
+                stats["files_unchanged"] += 1
+            else:
+                changed = True
+                stats["files_updated" if previous is not None else "files_added"] += 1
+
+                # Chunks whose text is unchanged keep their id and embedding
+                old_ids_by_hash = {}
+                for entry in (previous or {}).get("chunks", []):
+                    old_ids_by_hash.setdefault(entry["hash"], []).append(entry["id"])
+
+                entries = []
+                upserts = {}
+                for chunk in chunk_document(file_name, content):
+                    chunk_hash = _hash_text(chunk["text"])
+                    chunk["hash"] = chunk_hash
+                    if old_ids_by_hash.get(chunk_hash):
+                        # Offsets may have moved; the vector is unchanged
+                        chunk_id = old_ids_by_hash[chunk_hash].pop()
+                    else:
+                        chunk_id = manifest["next_id"]
+                        manifest["next_id"] += 1
+                        vector = reusable.get(chunk_hash)
+                        if vector is None and chunk_hash in stored_by_hash:
+                            vector = stored_vector(stored_by_hash[chunk_hash])
+                        if vector is not None:
+                            spill.append(chunk_id, vector)
+                            stats["chunks_reused"] += 1
+                        else:
+                            pending.append((chunk_id, chunk["text"]))
+                    upserts[chunk_id] = chunk
+                    entries.append({"id": chunk_id, "hash": chunk_hash})
+
+                file_removed = [i for ids in old_ids_by_hash.values() for i in ids]
+                removed_ids.extend(file_removed)
+                manifest["files"][file_name] = {"hash": file_hash, "chunks": entries}
+                # Written in the sync's open transaction; published on commit
+                store.write(upserts, file_removed, commit=False)
+
+            # Embed new chunks in batched, concurrent requests
+            if len(pending) >= EMBED_FLUSH_CHUNKS:
+                flush_pending()
+            if progress is not None:
+                progress(dict(stats, file=file_name))
+        flush_pending()
+
+        for file_name in list(manifest["files"]):
+            if file_name not in seen:
+                file_removed = [entry["id"] for entry in manifest["files"].pop(file_name)["chunks"]]
+                removed_ids.extend(file_removed)
+                store.write({}, file_removed, commit=False)
+                stats["files_removed"] += 1
+                changed = True
+        stats["chunks_removed"] = len(removed_ids)
+
+        if not changed:
+            print(f"[DEBUG] Index sync: {stats}")
+            return stats
+
+        if removed_ids or len(spill) or index is None:
+            # Publish vectors and index as a new generation
+            manifest["generation"] = old_generation + 1
+            added_ids, added_order, added_rows = spill.finish()
+            keep_mask = ~np.isin(old_ids, np.array(removed_ids, dtype='int64'))
+            new_ids = _write_vectors(new_files["vectors"], old_ids, old_vectors, keep_mask,
+                                     added_ids, added_order, added_rows)
+            np.save(new_files["ids"], new_ids)
+            manifest["num_chunks"] = len(new_ids)
+
+            # Update the FAISS index in place, rebuilding when the corpus size calls for
+            # another index type or the index cannot drop vectors (HNSW)
+            rebuild = (
+                index is None
+                or vector_index.index_type_of(index) != vector_index.choose_index_type(len(new_ids))
+                or (removed_ids and not vector_index.supports_remove(index))
+            )
+            if not len(new_ids):
+                index = None
+            elif rebuild:
+                _, new_vectors = rag_store.load_vectors(manifest["generation"])
+                index = create_faiss_index(new_ids, new_vectors)
+                del new_vectors
+            else:
+                if removed_ids:
+                    index.remove_ids(np.array(removed_ids, dtype='int64'))
+                for start in range(0, len(added_ids), COPY_BLOCK_ROWS):
+                    rows = added_rows[added_order[start:start + COPY_BLOCK_ROWS]]
+                    index.add_with_ids(vector_index.normalize(rows), added_ids[start:start + COPY_BLOCK_ROWS])
+            del added_rows
+            if index is not None:
+                faiss.write_index(index, new_files["index"])
+    finally:
+        spill.remove()
+
+    # Chunk text is committed before the manifest that refers to it
+    store.commit()
+    rag_store.write_manifest(manifest)
+
+    # Swap the new generation into cdm_rag, then drop the old one
+    if reload:
+        cdm_rag.reload_rag()
+    if manifest["generation"] != old_generation:
+        del old_vectors
+        rag_store.remove_stale_generations(manifest["generation"])
+    print(f"[DEBUG] Index sync: {stats}")
+    return stats
+
+def iter_ndjson_files(lines):
+    """
+    Parse an NDJSON upload lazily: one {"name": ..., "content": ...} object per line.
+    Blank lines and entries without a name or content are skipped.
+
+    Args:
+        lines: Iterable of bytes or str lines (e.g. a Django request)
+
+    Yields:
+        (file name, content) pairs
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON on line {line_number}: {e}") from e
+        file_name = item.get('name')
+        file_content = item.get('content')
+        if file_name and file_content:
+            print(f"[DEBUG] Processing file: {file_name}, length of content: {len(file_content)}")
+            yield file_name, file_content
 
 def upload_folder(data):
     """
-    Process incoming files and store chunk dictionaries (with text, metadata, embedding).
+    Sync the RAG index with the incoming files.
+    Only new or changed chunks are embedded; files missing from `data` are removed.
     """
     try:
         print("[DEBUG] Starting upload_folder with data:", data)
 
-        # This will be your master list of chunk dictionaries
-        chunks_list = []
-
-        files = data.get('filePaths', [])
-        print("[DEBUG] files array:", files)
-
-        # Process each "file"
-        for file_item in files:
+        files = {}
+        for file_item in data.get('filePaths', []):
             file_name = file_item.get('name')
             file_content = file_item.get('content')
             if file_name and file_content:
                 print(f"[DEBUG] Processing file: {file_name}, length of content: {len(file_content)}")
+                files[file_name] = file_content
 
-                # Create the embedding for this file's content
-                embedding = embed_file_content(file_content)
-
-                # Build the chunk dictionary
-                chunk_dict = {
-                    "text": file_content,
-                    "metadata": {
-                        "file_path": file_name
-                    },
-                    "embedding": embedding
-                }
-                chunks_list.append(chunk_dict)
-
-        # Now pickle the entire list
-        with open(embeddings_file, 'wb') as f:
-            pickle.dump(chunks_list, f)
-
-        print("[DEBUG] Saved chunks to embeddings.pkl")
-
-        # Create a FAISS index
-        if len(chunks_list) > 0:
-            create_faiss_index(chunks_list)
-            print("[DEBUG] FAISS index created.")
-        else:
-            print("[DEBUG] No valid chunks found; not creating FAISS index.")
-
-        return {"message": "Files processed, embeddings stored, and FAISS index created."}, 200
+        stats = sync_index(files)
+        return {"message": "Files processed, embeddings stored, and FAISS index updated.", "stats": stats}, 200
 
     except Exception as e:
         print(f"[DEBUG] Unexpected error in upload_folder: {str(e)}")
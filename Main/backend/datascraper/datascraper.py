@@ -16,7 +16,6 @@ from urllib.parse import urljoin
 # from transformers import AutoTokenizer, AutoModelForCausalLM
 # from accelerate import init_empty_weights, load_checkpoint_and_dispatch
 
-from . import cdm_rag
 from mcp_client.agent import create_fin_agent, USER_ONLY_MODELS, DEFAULT_PROMPT
 from .models_config import (
     MODELS_CONFIG,
@@ -280,6 +279,8 @@ def create_rag_response(user_input, message_list, model):
     Generates a response using the RAG pipeline.
     """
     try:
+        # Imported on first use: the RAG stack pulls in faiss and numpy
+        from . import cdm_rag
         response = cdm_rag.get_rag_response(user_input, model)
         message_list.append({"role": "user", "content": response})
         return response
@@ -550,6 +551,7 @@ def create_rag_advanced_response(user_input: str, message_list: list[dict], mode
     """
     try:
         # First try to get response from RAG
+        from . import cdm_rag
         rag_response = cdm_rag.get_rag_advanced_response(user_input, model)
         if rag_response:
             return rag_response
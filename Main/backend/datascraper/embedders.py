@@ -0,0 +1,341 @@
+"""
+Embedding backends for the RAG pipeline.
+BatchingEmbedder packs many texts into each embedding request, runs several
+requests concurrently under a rate-limit governor and retries failed batches.
+LocalEmbedder is a deterministic offline stand-in for benchmarks and tests.
+"""
+
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSION = 3072
+
+# OpenAI accepts up to 2048 inputs and 300k tokens per embedding request
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_BATCH_TOKENS = 200_000
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_RETRIES = 5
+
+# Status codes worth retrying besides 5xx server errors
+_RETRYABLE_STATUS = {429}
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (about 4 characters per token) used for batch packing."""
+    return max(1, len(text) // 4)
+
+
+class RateLimiter:
+    """
+    Token-bucket governor for requests per minute and tokens per minute.
+    Shared by all worker threads of an embedder.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        """
+        Initialize the governor.
+
+        Args:
+            requests_per_minute: Request budget, or None for unlimited
+            tokens_per_minute: Token budget, or None for unlimited
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_allowance = float(requests_per_minute or 0)
+        self._token_allowance = float(tokens_per_minute or 0)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_minute:
+            self._request_allowance = min(
+                self.requests_per_minute,
+                self._request_allowance + elapsed * self.requests_per_minute / 60.0
+            )
+        if self.tokens_per_minute:
+            self._token_allowance = min(
+                self.tokens_per_minute,
+                self._token_allowance + elapsed * self.tokens_per_minute / 60.0
+            )
+
+    def acquire(self, tokens: int) -> None:
+        """Block until one request carrying `tokens` tokens fits in the budget."""
+        if self.tokens_per_minute:
+            # A single oversized batch may never fit; let it through at a full bucket
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                wait = 0.0
+                if self.requests_per_minute and self._request_allowance < 1:
+                    wait = max(wait, (1 - self._request_allowance) * 60.0 / self.requests_per_minute)
+                if self.tokens_per_minute and self._token_allowance < tokens:
+                    wait = max(wait, (tokens - self._token_allowance) * 60.0 / self.tokens_per_minute)
+                if wait == 0.0:
+                    if self.requests_per_minute:
+                        self._request_allowance -= 1
+                    if self.tokens_per_minute:
+                        self._token_allowance -= tokens
+                    return
+            time.sleep(wait)
+
+
+class OpenAIEmbedder:
+    """Embeds a batch of texts with one OpenAI embeddings request."""
+
+    def __init__(self, model: str = EMBEDDING_MODEL, api_key: Optional[str] = None):
+        from openai import OpenAI
+
+        self.model = model
+        self.dimension = EMBEDDING_DIMENSION
+        # Retries are handled by BatchingEmbedder
+        self.client = OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+    def embed_batch(self, texts: Sequence[str]) -> List[List[float]]:
+        response = self.client.embeddings.create(input=list(texts), model=self.model)
+        # Results are not guaranteed to come back in input order
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class LocalEmbedder:
+    """
+    Offline stand-in embedder: hashed bag-of-words vectors, L2-normalized.
+    Texts sharing words get similar vectors, which is enough to exercise
+    indexing and retrieval without network access.
+    """
+
+    def __init__(self, dimension: int = 256, latency: float = 0.0, per_item_latency: float = 0.0):
+        """
+        Initialize the embedder.
+
+        Args:
+            dimension: Vector size
+            latency: Simulated seconds per request
+            per_item_latency: Simulated seconds per text in a request
+        """
+        self.model = "local-hash"
+        self.dimension = dimension
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+
+    def _embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimension, dtype="float32")
+        for word in _WORD_RE.findall(text.lower()):
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimension
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+    def embed_batch(self, texts: Sequence[str]) -> List[np.ndarray]:
+        if self.latency or self.per_item_latency:
+            time.sleep(self.latency + self.per_item_latency * len(texts))
+        return [self._embed_one(text) for text in texts]
+
+
+def _is_retryable(exc: Exception) -> bool:
+    """
+    Retry connection errors, timeouts, rate limits and 5xx responses.
+    Anything else (bad requests, auth errors, programming errors) fails at once.
+    """
+    import openai
+
+    # APITimeoutError is a subclass of APIConnectionError
+    if isinstance(exc, (openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in _RETRYABLE_STATUS or exc.status_code >= 500
+    return False
+
+
+class BatchingEmbedder:
+    """Packs texts into batches and embeds them concurrently with retries."""
+
+    def __init__(
+        self,
+        embedder,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        batch_tokens: int = DEFAULT_BATCH_TOKENS,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        rate_limiter: Optional[RateLimiter] = None
+    ):
+        """
+        Initialize the batching embedder.
+
+        Args:
+            embedder: Backend with embed_batch(texts) and a dimension attribute
+            batch_size: Maximum texts per request
+            batch_tokens: Maximum estimated tokens per request
+            max_workers: Requests in flight at once
+            max_retries: Attempts after the first failure of a batch
+            rate_limiter: Shared governor, or None for no client-side limit
+        """
+        self.embedder = embedder
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter
+
+    @property
+    def dimension(self) -> int:
+        return self.embedder.dimension
+
+    def _make_batches(self, texts: Sequence[str]) -> List[tuple]:
+        """Group consecutive texts into (start, end, tokens) batches."""
+        batches = []
+        start = 0
+        tokens = 0
+        for i, text in enumerate(texts):
+            text_tokens = estimate_tokens(text)
+            if i > start and (i - start >= self.batch_size or tokens + text_tokens > self.batch_tokens):
+                batches.append((start, i, tokens))
+                start, tokens = i, 0
+            tokens += text_tokens
+        if start < len(texts):
+            batches.append((start, len(texts), tokens))
+        return batches
+
+    def _embed_with_retry(self, texts: Sequence[str], tokens: int) -> List:
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(tokens)
+            try:
+                return self.embedder.embed_batch(texts)
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    raise
+                # Exponential backoff with jitter so workers don't retry in lockstep
+                delay = min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+                attempt += 1
+                logging.warning(f"[Embeddings] Batch of {len(texts)} failed ({e}); retry {attempt} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Embed texts, preserving order.
+
+        Args:
+            texts: Texts to embed
+
+        Returns:
+            float32 array of shape (len(texts), dimension)
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dimension), dtype="float32")
+
+        batches = self._make_batches(texts)
+        result = np.empty((len(texts), self.dimension), dtype="float32")
+
+        def run(batch):
+            start, end, tokens = batch
+            result[start:end] = np.asarray(self._embed_with_retry(texts[start:end], tokens), dtype="float32")
+
+        if len(batches) == 1 or self.max_workers <= 1:
+            for batch in batches:
+                run(batch)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+                # list() re-raises the first batch failure
+                list(executor.map(run, batches))
+
+        logging.info(f"[Embeddings] Embedded {len(texts)} texts in {len(batches)} requests")
+        return result
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache of embeddings with a time-to-live.
+    Keys are (model, normalized text): whitespace is collapsed and case folded,
+    so trivially different spellings of the same question share an entry.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600.0):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries: Entries kept before the least recently used is evicted
+            ttl_seconds: Age after which an entry is no longer returned
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, text: str) -> tuple:
+        return model, " ".join(text.split()).casefold()
+
+    def get(self, key: tuple) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, vector: np.ndarray) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+# Global instance
+_embedder_instance = None
+_embedder_lock = threading.Lock()
+
+def get_embedder() -> BatchingEmbedder:
+    """
+    Get the global embedder.
+    Set EMBEDDING_BACKEND=local to use LocalEmbedder instead of OpenAI;
+    EMBEDDING_RPM / EMBEDDING_TPM set the client-side rate limits.
+    """
+    global _embedder_instance
+    if _embedder_instance is None:
+        with _embedder_lock:
+            if _embedder_instance is None:
+                if os.getenv("EMBEDDING_BACKEND", "openai").lower() == "local":
+                    backend = LocalEmbedder()
+                else:
+                    backend = OpenAIEmbedder()
+                limiter = RateLimiter(_env_int("EMBEDDING_RPM"), _env_int("EMBEDDING_TPM"))
+                _embedder_instance = BatchingEmbedder(backend, rate_limiter=limiter)
+    return _embedder_instance
@@ -0,0 +1,277 @@
+"""
+Background RAG indexing jobs.
+Uploads are spooled to an NDJSON file and indexed by a worker pool, so HTTP
+requests return immediately. Each job has an id, live progress and can be
+cancelled; the new index is swapped into cdm_rag only when a job completes,
+so queries keep using the previous index meanwhile.
+Set RAG_INDEXING_PROCESS=1 to run each job in a separate process, keeping
+chunking and index building off the server's GIL.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+FINISHED_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+
+class IndexingCancelled(Exception):
+    """Raised from the progress callback to abort a sync."""
+
+
+def spool_ndjson(chunks: Iterable[bytes]) -> str:
+    """
+    Write an upload to a temporary NDJSON file without holding it in memory.
+
+    Args:
+        chunks: Byte chunks of the upload body
+
+    Returns:
+        Path of the spooled file; the job that consumes it deletes it
+    """
+    fd, path = tempfile.mkstemp(prefix="rag_upload_", suffix=".ndjson")
+    with os.fdopen(fd, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return path
+
+
+def _read_ndjson(path: str):
+    from . import create_embeddings as ce
+
+    with open(path, "rb") as f:
+        yield from ce.iter_ndjson_files(f)
+
+
+class IndexingJob:
+    """State of one indexing job, safe to read from request threads."""
+
+    def __init__(self, source: str):
+        self.job_id = uuid.uuid4().hex
+        self.source = source
+        self.status = STATUS_QUEUED
+        self.progress: Dict = {}
+        self.stats: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.cancel_event = threading.Event()
+        self.listeners: List[Callable[[Dict], None]] = []
+
+    def cancel(self) -> bool:
+        """Request cancellation; returns False if the job already finished."""
+        if self.status in FINISHED_STATUSES:
+            return False
+        self.cancel_event.set()
+        return True
+
+    def emit(self, event: Dict) -> None:
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logging.warning(f"[Indexing] Listener failed for job {self.job_id}: {e}")
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "source": self.source,
+            "status": self.status,
+            "progress": self.progress,
+            "stats": self.stats,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+def _process_main(ndjson_path: str, events, cancel_event) -> None:
+    """Entry point of a separate indexing process; reports back through `events`."""
+    from . import create_embeddings as ce
+
+    def progress(stats):
+        if cancel_event.is_set():
+            raise IndexingCancelled()
+        events.put(("progress", stats))
+
+    try:
+        stats = ce.sync_index(_read_ndjson(ndjson_path), progress=progress, reload=False)
+        events.put(("done", stats))
+    except IndexingCancelled:
+        events.put(("cancelled", None))
+    except Exception as e:
+        events.put(("failed", str(e)))
+
+
+class IndexingJobManager:
+    """Runs indexing jobs on a worker pool and keeps their status."""
+
+    def __init__(self, max_workers: int = 1, use_process: bool = False, max_finished: int = 50):
+        """
+        Initialize the manager.
+
+        Args:
+            max_workers: Jobs run at once; syncs are serialized by
+                create_embeddings anyway, extra workers only queue there
+            use_process: Run each spooled job in a separate process
+            max_finished: Finished jobs kept for status queries
+        """
+        self.use_process = use_process
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-index")
+        self._jobs: "OrderedDict[str, IndexingJob]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, files: Optional[Iterable[Tuple[str, str]]] = None, ndjson_path: Optional[str] = None,
+               source: str = "upload", listener: Optional[Callable[[Dict], None]] = None) -> IndexingJob:
+        """
+        Queue an indexing job.
+
+        Args:
+            files: Iterable of (file name, content) pairs consumed by the job
+                thread; always indexed in-process
+            ndjson_path: Spooled NDJSON upload, deleted when the job ends
+            source: Label shown in job status
+            listener: Optional callable receiving each progress/final event
+
+        Returns:
+            The queued job
+        """
+        if (files is None) == (ndjson_path is None):
+            raise ValueError("Pass exactly one of files or ndjson_path")
+        job = IndexingJob(source)
+        if listener is not None:
+            job.listeners.append(listener)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune()
+        self._executor.submit(self._run, job, files, ndjson_path)
+        logging.info(f"[Indexing] Queued job {job.job_id} ({source})")
+        return job
+
+    def get(self, job_id: str) -> Optional[IndexingJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> List[IndexingJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        return job is not None and job.cancel()
+
+    def _prune(self) -> None:
+        """Forget the oldest finished jobs beyond max_finished. Caller holds the lock."""
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_STATUSES]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _finish(self, job: IndexingJob, status: str, stats: Optional[Dict] = None, error: Optional[str] = None) -> None:
+        job.stats = stats
+        job.error = error
+        job.finished_at = time.time()
+        job.status = status
+        logging.info(f"[Indexing] Job {job.job_id} {status}" + (f": {error}" if error else ""))
+        job.emit({"type": status, "job_id": job.job_id, "stats": stats, "error": error})
+
+    def _run(self, job: IndexingJob, files, ndjson_path: Optional[str]) -> None:
+        result = (STATUS_CANCELLED, None, None)
+        try:
+            if not job.cancel_event.is_set():
+                job.status = STATUS_RUNNING
+                job.started_at = time.time()
+                if ndjson_path is not None and self.use_process:
+                    result = self._run_in_process(job, ndjson_path)
+                else:
+                    result = self._run_in_thread(job, files if files is not None else _read_ndjson(ndjson_path))
+        except Exception as e:
+            result = (STATUS_FAILED, None, str(e))
+        finally:
+            # Clean up before the job is reported finished
+            if ndjson_path is not None:
+                try:
+                    os.remove(ndjson_path)
+                except OSError:
+                    pass
+        self._finish(job, *result)
+
+    def _on_progress(self, job: IndexingJob, stats: Dict) -> None:
+        job.progress = stats
+        job.emit({"type": "progress", "job_id": job.job_id, **stats})
+
+    def _run_in_thread(self, job: IndexingJob, files) -> Tuple[str, Optional[Dict], Optional[str]]:
+        from . import create_embeddings as ce
+
+        def progress(stats):
+            if job.cancel_event.is_set():
+                raise IndexingCancelled()
+            self._on_progress(job, stats)
+
+        try:
+            return STATUS_DONE, ce.sync_index(files, progress=progress), None
+        except IndexingCancelled:
+            return STATUS_CANCELLED, None, None
+
+    def _run_in_process(self, job: IndexingJob, ndjson_path: str) -> Tuple[str, Optional[Dict], Optional[str]]:
+        from . import cdm_rag
+
+        context = multiprocessing.get_context("spawn")
+        events = context.Queue()
+        cancel_event = context.Event()
+        process = context.Process(
+            target=_process_main, args=(ndjson_path, events, cancel_event), name=f"rag-index-{job.job_id[:8]}"
+        )
+        process.start()
+        try:
+            while True:
+                if job.cancel_event.is_set():
+                    cancel_event.set()
+                try:
+                    kind, payload = events.get(timeout=0.5)
+                except queue.Empty:
+                    if not process.is_alive():
+                        raise RuntimeError(f"Indexing process exited with code {process.exitcode}")
+                    continue
+                if kind == "progress":
+                    self._on_progress(job, payload)
+                elif kind == "done":
+                    # The child wrote the new generation; load it here
+                    cdm_rag.reload_rag()
+                    return STATUS_DONE, payload, None
+                elif kind == "cancelled":
+                    return STATUS_CANCELLED, None, None
+                else:
+                    return STATUS_FAILED, None, payload
+        finally:
+            process.join(timeout=5)
+
+
+# Global instance
+_job_manager_instance = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager() -> IndexingJobManager:
+    """Get the global IndexingJobManager instance."""
+    global _job_manager_instance
+    if _job_manager_instance is None:
+        with _job_manager_lock:
+            if _job_manager_instance is None:
+                use_process = os.getenv("RAG_INDEXING_PROCESS", "").lower() in ("1", "true", "yes")
+                _job_manager_instance = IndexingJobManager(use_process=use_process)
+    return _job_manager_instance
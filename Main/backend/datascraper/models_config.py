@@ -131,4 +131,11 @@ def validate_model_support(model_id: str, feature: str) -> bool:
     config = get_model_config(model_id)
     if not config:
         return False
-    return config.get(f"supports_{feature}", False)
\ No newline at end of file
+    return config.get(f"supports_{feature}", False)
+
+def get_context_window(model_id: str, default: int = 4096) -> int:
+    """Get the token limit (max_tokens) for a model, or a conservative default."""
+    config = get_model_config(model_id)
+    if not config:
+        return default
+    return config.get("max_tokens", default)
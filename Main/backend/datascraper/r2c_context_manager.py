@@ -5,12 +5,161 @@ Implements multi-granularity hierarchical compression for conversation context.
 
 import re
 import logging
-import numpy as np
-from typing import List, Dict, Tuple, Optional
-from collections import defaultdict
+import math
+import threading
+import time
+from array import array
+from functools import lru_cache
+from itertools import islice
+from typing import List, Dict, Tuple, Optional, Iterable
 import tiktoken
 from datetime import datetime
 
+from .models_config import get_context_window
+from .web_content_store import WebPage
+
+
+# Compact role codes stored on each message instead of prefixed strings
+ROLE_USER = 0
+ROLE_ASSISTANT = 1
+ROLE_SYSTEM = 2
+
+# Sessions idle for longer than this are dropped (seconds)
+DEFAULT_SESSION_TTL = 2 * 3600
+# Sessions kept at most; the least recently used are dropped first
+DEFAULT_MAX_SESSIONS = 256
+
+_ROLE_CODES = {
+    "user": ROLE_USER,
+    "assistant": ROLE_ASSISTANT,
+}
+
+# Headers applied only when the API payload is built
+_ROLE_HEADERS = {
+    ROLE_USER: "[USER QUESTION]: ",
+    ROLE_ASSISTANT: "[ASSISTANT RESPONSE]: ",
+    ROLE_SYSTEM: "",
+}
+
+
+class _Message:
+    """Single conversation message stored as a role code plus raw content."""
+
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: int, content: str):
+        self.role = role
+        self.content = content
+
+    @property
+    def formatted(self) -> str:
+        """Content with its role header, as sent to the model."""
+        return _ROLE_HEADERS[self.role] + self.content
+
+    @property
+    def is_web_content(self) -> bool:
+        """Whether this message holds page text added through add_webtext."""
+        return self.content.startswith("[Web Content from")
+
+    def to_payload(self) -> Dict:
+        """Build the API message dict (always user role for compatibility)."""
+        return {"role": "user", "content": self.formatted}
+
+
+class _WebContentMessage(_Message):
+    """Web content message referencing a shared WebPage instead of copying its text."""
+
+    __slots__ = ("page",)
+
+    def __init__(self, page: WebPage):
+        self.role = ROLE_USER
+        self.page = page
+
+    @property
+    def content(self) -> str:
+        return f"[Web Content from {self.page.url}]: {self.page.content}"
+
+    @property
+    def is_web_content(self) -> bool:
+        return True
+
+
+class _SessionState:
+    """
+    Immutable snapshot of a session's conversation.
+
+    Writers build a new state and publish it with a single attribute
+    assignment, so readers can use whatever state they load without locking.
+    """
+
+    __slots__ = (
+        "messages",
+        "message_tokens",
+        "compressed_context",
+        "compressed_tokens",
+        "token_count",
+    )
+
+    def __init__(
+        self,
+        messages: Tuple[_Message, ...] = (),
+        message_tokens: Optional[array] = None,
+        compressed_context: Optional[str] = None,
+        compressed_tokens: int = 0,
+        token_count: int = 0
+    ):
+        self.messages = messages
+        self.message_tokens = message_tokens if message_tokens is not None else array("I")  # Track tokens separately
+        self.compressed_context = compressed_context
+        self.compressed_tokens = compressed_tokens  # Tokens of the "[Compressed Context]" payload
+        self.token_count = token_count
+
+    def with_message(self, message: _Message, tokens: int, index: Optional[int] = None) -> "_SessionState":
+        """Return a new state with the message appended, or replacing the one at index."""
+        message_tokens = array("I", self.message_tokens)
+        if index is None:
+            messages = self.messages + (message,)
+            message_tokens.append(tokens)
+            token_count = self.token_count + tokens
+        else:
+            messages = self.messages[:index] + (message,) + self.messages[index + 1:]
+            token_count = self.token_count + tokens - message_tokens[index]
+            message_tokens[index] = tokens
+        return _SessionState(
+            messages, message_tokens, self.compressed_context, self.compressed_tokens, token_count
+        )
+
+
+_EMPTY_STATE = _SessionState()
+
+
+@lru_cache(maxsize=None)
+def _get_tokenizer(model: str):
+    """Load a tiktoken encoding once per process and model."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class _Session:
+    """Per-session lock plus the currently published conversation state."""
+
+    __slots__ = (
+        "lock",
+        "state",
+        "compression_history",
+        "web_pages",
+        "last_used",
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()  # Serializes writers; readers never take it
+        self.last_used = time.monotonic()  # Refreshed on every read and write
+        self.state = _EMPTY_STATE
+        self.compression_history: List[Dict] = []  # Replaced, never mutated, once published
+        self.web_pages: Dict[str, _WebContentMessage] = {}  # URL -> live web content message (writers only)
+
 
 class R2CContextManager:
     """
@@ -24,7 +173,10 @@ class R2CContextManager:
         compression_ratio: float = 0.5,
         rho: float = 0.5,
         gamma: float = 1.0,
-        model: str = "gpt-3.5-turbo"
+        model: str = "gpt-3.5-turbo",
+        answer_reserve_tokens: int = 1024,
+        session_ttl: Optional[float] = DEFAULT_SESSION_TTL,
+        max_sessions: int = DEFAULT_MAX_SESSIONS
     ):
         """
         Initialize R2C Context Manager.
@@ -35,29 +187,30 @@ class R2CContextManager:
             rho: Hierarchical ratio for chunk vs sentence compression (0-1)
             gamma: Power factor for importance allocation
             model: Model name for tokenizer selection
+            answer_reserve_tokens: Tokens kept free for the answer when packing
+                context for a specific model
+            session_ttl: Seconds a session may stay idle before it is dropped
+                (None keeps idle sessions)
+            max_sessions: Sessions kept at most; the least recently used go first
         """
         self.max_tokens = max_tokens
         self.compression_ratio = compression_ratio
         self.rho = rho
         self.gamma = gamma
+        self.answer_reserve_tokens = answer_reserve_tokens
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
         
-        # Initialize tokenizer based on model
-        try:
-            self.tokenizer = tiktoken.encoding_for_model(model)
-        except:
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")
-        
-        # Session storage
-        self.sessions = defaultdict(lambda: {
-            "messages": [],
-            "message_tokens": [],  # Track tokens separately
-            "compressed_context": None,
-            "token_count": 0,
-            "compression_history": []
-        })
+        # Initialize tokenizer based on model (shared across managers)
+        self.tokenizer = _get_tokenizer(model)
+        
+        # Session storage; the registry lock only guards session creation and removal
+        self.sessions: Dict[str, _Session] = {}
+        self._sessions_lock = threading.Lock()
         
         # Initial system message for financial assistant
         self.system_prompt = "You are a helpful financial assistant. Always answer questions to the best of your ability."
+        self.system_prompt_tokens = self.count_tokens(self.system_prompt)
         
         # Financial keywords for importance scoring
         self.financial_keywords = {
@@ -74,6 +227,43 @@ class R2CContextManager:
     def count_tokens(self, text: str) -> int:
         """Count tokens in text using the model's tokenizer."""
         return len(self.tokenizer.encode(text))
+
+    def _get_session(self, session_id: str) -> _Session:
+        """
+        Get or create a session without holding any lock on the fast path.
+        Idle and least recently used sessions are dropped when one is created.
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            with self._sessions_lock:
+                session = self.sessions.get(session_id)
+                if session is None:
+                    self._evict_sessions()
+                    session = _Session()
+                    self.sessions[session_id] = session
+        session.last_used = time.monotonic()
+        return session
+
+    def _evict_sessions(self) -> None:
+        """Drop idle sessions, then the least recently used ones above the limit. Caller holds _sessions_lock."""
+        if self.session_ttl is not None:
+            deadline = time.monotonic() - self.session_ttl
+            for session_id in [sid for sid, session in self.sessions.items() if session.last_used < deadline]:
+                del self.sessions[session_id]
+        excess = len(self.sessions) - self.max_sessions + 1
+        if excess > 0:
+            by_age = sorted(self.sessions, key=lambda sid: self.sessions[sid].last_used)
+            for session_id in by_age[:excess]:
+                del self.sessions[session_id]
+            logging.info(f"[R2C] Dropped {excess} least recently used session(s)")
+
+    def _snapshot(self, session_id: str) -> _SessionState:
+        """Load the published state of a session for lock-free reading."""
+        session = self.sessions.get(session_id)
+        if session is None:
+            return _EMPTY_STATE
+        session.last_used = time.monotonic()
+        return session.state
     
     def add_message(self, session_id: str, role: str, content: str) -> None:
         """
@@ -85,43 +275,88 @@ class R2CContextManager:
             content: Message content
         """
         logging.info(f"[R2C DEBUG] Adding message to session {session_id}, role: {role}, content_length: {len(content)}")
-        session = self.sessions[session_id]
-        
-        # Format content with headers to distinguish roles
-        if role == "assistant":
-            formatted_content = f"[ASSISTANT RESPONSE]: {content}"
-        elif role == "user":
-            formatted_content = f"[USER QUESTION]: {content}"
-        else:  # system or other
-            formatted_content = content
-        
-        message = {
-            "role": "user",  # Always use user role for compatibility
-            "content": formatted_content
-        }
+        session = self._get_session(session_id)
         
-        tokens = self.count_tokens(formatted_content)
-        session["messages"].append(message)
-        session["message_tokens"].append(tokens)
-        session["token_count"] += tokens
+        # Store the raw content with a role code; headers are added when the payload is built
+        message = _Message(_ROLE_CODES.get(role, ROLE_SYSTEM), content)
         
-        # Check if compression is needed
-        if session["token_count"] > self.max_tokens:
-            logging.info(f"[R2C DEBUG] Token count {session['token_count']} exceeds max {self.max_tokens}, compressing...")
-            self._compress_context(session_id)
+        # Tokenize outside the lock
+        tokens = self.count_tokens(message.formatted)
+
+        with session.lock:
+            session.state = session.state.with_message(message, tokens)
+            
+            # Check if compression is needed
+            if session.state.token_count > self.max_tokens:
+                logging.info(f"[R2C DEBUG] Token count {session.state.token_count} exceeds max {self.max_tokens}, compressing...")
+                self._compress_context(session_id, session)
     
-    def get_context(self, session_id: str, include_compressed: bool = True) -> List[Dict]:
+    def add_web_content(self, session_id: str, page: WebPage) -> bool:
+        """
+        Add page text to session history, keeping one message per URL.
+
+        Args:
+            session_id: Unique session identifier
+            page: Page snapshot from the WebContentStore
+
+        Returns:
+            False if the session already holds this exact page content,
+            True if the page was added or its previous version replaced
+        """
+        session = self._get_session(session_id)
+        existing = session.web_pages.get(page.url)
+        if existing is not None and existing.page.digest == page.digest:
+            logging.info(f"[R2C DEBUG] Web content for {page.url} unchanged in session {session_id}, skipping")
+            return False
+
+        # Tokenize outside the lock
+        message = _WebContentMessage(page)
+        tokens = self.count_tokens(message.formatted)
+
+        with session.lock:
+            existing = session.web_pages.get(page.url)
+            if existing is not None and existing.page.digest == page.digest:
+                return False
+
+            index = None
+            if existing is not None:
+                # Messages compare by identity, so this finds the stored record
+                try:
+                    index = session.state.messages.index(existing)
+                except ValueError:
+                    index = None
+
+            session.state = session.state.with_message(message, tokens, index)
+            session.web_pages[page.url] = message
+            if index is not None:
+                logging.info(f"[R2C DEBUG] Replaced web content for {page.url} in session {session_id}")
+
+            if session.state.token_count > self.max_tokens:
+                logging.info(f"[R2C DEBUG] Token count {session.state.token_count} exceeds max {self.max_tokens}, compressing...")
+                self._compress_context(session_id, session)
+        return True
+
+    def get_context(
+        self,
+        session_id: str,
+        include_compressed: bool = True,
+        model: Optional[str] = None
+    ) -> List[Dict]:
         """
         Get conversation context for a session.
 
         Args:
             session_id: Session identifier
             include_compressed: Whether to include compressed context
+            model: Model ID from MODELS_CONFIG. When given, history is packed
+                into the model's token limit minus the reserved answer tokens
+                instead of using the fixed last-5-messages window.
 
         Returns:
             List of messages for the session
         """
-        session = self.sessions[session_id]
+        # Lock-free read: work from one published snapshot
+        state = self._snapshot(session_id)
 
         # Always include system prompt as first message with user role
         context = [{
@@ -129,61 +364,138 @@ class R2CContextManager:
             "content": self.system_prompt
         }]
 
-        if include_compressed and session["compressed_context"]:
+        if model is not None:
+            records, use_compressed = self._budgeted_records(
+                state, include_compressed, self.get_token_budget(model)
+            )
+        else:
+            records = self._context_records(state, include_compressed)
+            use_compressed = include_compressed and bool(state.compressed_context)
+
+        if use_compressed:
             # Add compressed context with user role
             context.append({
                 "role": "user",
-                "content": f"[Compressed Context]: {session['compressed_context']}"
+                "content": f"[Compressed Context]: {state.compressed_context}"
             })
-            # Add recent messages (last 5 messages uncompressed)
-            context.extend(session["messages"][-5:])
-        else:
-            # Add all messages
-            context.extend(session["messages"])
+
+        # Payload dicts are only built here, from a view over the stored records
+        context.extend(message.to_payload() for message in records)
 
         return context
 
-    def prepare_context_messages(self, session_id: str) -> List[Dict]:
+    def get_token_budget(self, model: str) -> int:
+        """Tokens available for context: the model's limit minus the answer reserve."""
+        window = get_context_window(model)
+        return window - min(self.answer_reserve_tokens, window // 4)
+
+    def _context_records(self, state: _SessionState, include_compressed: bool) -> Iterable[_Message]:
+        """
+        Return a view over the session messages that belong in the context.
+
+        With compressed context only the last 5 messages are kept uncompressed,
+        otherwise all messages are returned. No message is copied.
+        """
+        messages = state.messages
+        if include_compressed and state.compressed_context:
+            return islice(messages, max(len(messages) - 5, 0), None)
+        return messages
+
+    def _budgeted_records(
+        self,
+        state: _SessionState,
+        include_compressed: bool,
+        budget: int
+    ) -> Tuple[List[_Message], bool]:
+        """
+        Pack session messages into a token budget using the cached token counts.
+
+        Priority: the latest message, the compressed context, web content
+        (newest first), then the most recent conversation history. Selected
+        messages keep their original order.
+
+        Returns:
+            Tuple of (selected messages, whether compressed context fits)
+        """
+        messages = state.messages
+        tokens = state.message_tokens
+        count = len(messages)
+        remaining = budget - self.system_prompt_tokens
+        selected = bytearray(count)
+
+        # The latest message is the current question; always keep it
+        if count:
+            selected[-1] = 1
+            remaining -= tokens[-1]
+
+        use_compressed = (
+            include_compressed
+            and bool(state.compressed_context)
+            and state.compressed_tokens <= remaining
+        )
+        if use_compressed:
+            remaining -= state.compressed_tokens
+
+        # Web content is what questions are usually about
+        for i in range(count - 2, -1, -1):
+            if tokens[i] <= remaining and messages[i].is_web_content:
+                selected[i] = 1
+                remaining -= tokens[i]
+
+        # Fill the rest with contiguous recent history
+        for i in range(count - 2, -1, -1):
+            if selected[i]:
+                continue
+            if tokens[i] > remaining:
+                break
+            selected[i] = 1
+            remaining -= tokens[i]
+
+        return [messages[i] for i in range(count) if selected[i]], use_compressed
+
+    def prepare_context_messages(self, session_id: str, model: Optional[str] = None) -> List[Dict]:
         """
         Prepare context messages for API calls.
         Alias for get_context for compatibility.
 
         Args:
             session_id: Session identifier
+            model: Optional model ID used to budget the context
 
         Returns:
             List of messages ready for API calls
         """
-        return self.get_context(session_id, include_compressed=True)
+        return self.get_context(session_id, include_compressed=True, model=model)
     
     def clear_session(self, session_id: str) -> None:
         """Clear all messages for a session."""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        with self._sessions_lock:
+            self.sessions.pop(session_id, None)
     
     def clear_conversation_only(self, session_id: str) -> None:
         """Clear conversation messages but preserve web content."""
-        if session_id not in self.sessions:
+        session = self.sessions.get(session_id)
+        if session is None:
             return
             
-        session = self.sessions[session_id]
-        preserved_messages = []
-        preserved_tokens = []
-        preserved_token_count = 0
-        
-        # Preserve web content messages
-        for i, msg in enumerate(session["messages"]):
-            if "[Web Content from" in msg.get("content", ""):
-                preserved_messages.append(msg)
-                preserved_tokens.append(session["message_tokens"][i])
-                preserved_token_count += session["message_tokens"][i]
-        
-        # Reset session with preserved content
-        session["messages"] = preserved_messages
-        session["message_tokens"] = preserved_tokens
-        session["token_count"] = preserved_token_count
-        session["compressed_context"] = None
-        session["compression_history"] = []
+        with session.lock:
+            state = session.state
+            preserved_messages = []
+            preserved_tokens = array("I")
+            preserved_token_count = 0
+            
+            # Preserve web content messages
+            for msg, tokens in zip(state.messages, state.message_tokens):
+                if msg.is_web_content:
+                    preserved_messages.append(msg)
+                    preserved_tokens.append(tokens)
+                    preserved_token_count += tokens
+            
+            # Reset session with preserved content
+            session.state = _SessionState(
+                tuple(preserved_messages), preserved_tokens, token_count=preserved_token_count
+            )
+            session.compression_history = []
         
         logging.info(f"[R2C DEBUG] Cleared conversation for session {session_id}, preserved {len(preserved_messages)} web content messages")
     
@@ -222,7 +534,7 @@ class R2CContextManager:
         # 1. Length-based score (shorter = more important)
         words = text.split()
         if words:
-            length_score = 1.0 / (1.0 + np.log(len(words)))
+            length_score = 1.0 / (1.0 + math.log(len(words)))
             score += length_score * 0.2
         
         # 2. Financial keyword score
@@ -251,15 +563,17 @@ class R2CContextManager:
         
         return min(score, 1.0)
     
-    def _compress_context(self, session_id: str) -> None:
+    def _compress_context(self, session_id: str, session: _Session) -> None:
         """
         Compress context using R2C algorithm.
+        The caller must hold session.lock.
         
         Args:
             session_id: Session identifier
+            session: Session to compress
         """
-        session = self.sessions[session_id]
-        messages = session["messages"]
+        state = session.state
+        messages = state.messages
         
         if len(messages) < 3:  # Don't compress if too few messages
             return
@@ -269,7 +583,8 @@ class R2CContextManager:
         current_chunk = []
         current_role = None
         
-        for msg in messages[:-2]:  # Keep last 2 messages uncompressed
+        for record in messages[:-2]:  # Keep last 2 messages uncompressed
+            msg = record.to_payload()
             if msg["role"] != current_role and current_chunk:
                 chunks.append({
                     "role": current_role,
@@ -295,26 +610,34 @@ class R2CContextManager:
         compressed_text = self._r2c_compress(chunks)
         
         # Calculate original token count before updating
-        original_token_count = sum(session["message_tokens"][:-2])  # All tokens except last 2
+        original_token_count = sum(state.message_tokens[:-2])  # All tokens except last 2
         compressed_tokens = self.count_tokens(compressed_text)
         
-        # Update session
-        session["compressed_context"] = compressed_text
-        session["messages"] = messages[-2:]  # Keep only recent messages
-        session["message_tokens"] = session["message_tokens"][-2:]  # Keep corresponding tokens
-        session["token_count"] = compressed_tokens + sum(session["message_tokens"])
+        # Publish the compressed session as one new state
+        recent_messages = messages[-2:]  # Keep only recent messages
+        recent_tokens = state.message_tokens[-2:]  # Keep corresponding tokens
+        session.state = _SessionState(
+            recent_messages,
+            recent_tokens,
+            compressed_text,
+            self.count_tokens(f"[Compressed Context]: {compressed_text}"),
+            compressed_tokens + sum(recent_tokens)
+        )
+        session.web_pages = {
+            url: msg for url, msg in session.web_pages.items() if msg in recent_messages
+        }
         
         # Log compression
-        session["compression_history"].append({
+        session.compression_history = session.compression_history + [{
             "timestamp": datetime.now().isoformat(),
             "original_tokens": original_token_count,
             "compressed_tokens": compressed_tokens,
             "chunks_compressed": len(chunks)
-        })
+        }]
         
         logging.info(f"Compressed context for session {session_id}: "
                     f"{len(messages)} messages -> {len(chunks)} chunks -> "
-                    f"{session['token_count']} tokens")
+                    f"{session.state.token_count} tokens")
     
     def _r2c_compress(self, chunks: List[Dict]) -> str:
         """
@@ -427,14 +750,35 @@ class R2CContextManager:
     
     def get_session_stats(self, session_id: str) -> Dict:
         """Get statistics for a session."""
-        if session_id not in self.sessions:
+        session = self.sessions.get(session_id)
+        if session is None:
             return {}
         
-        session = self.sessions[session_id]
+        state = session.state
+        compression_history = session.compression_history
         return {
-            "message_count": len(session["messages"]),
-            "token_count": session["token_count"],
-            "compressed": session["compressed_context"] is not None,
-            "compression_count": len(session["compression_history"]),
-            "compression_history": session["compression_history"]
-        }
\ No newline at end of file
+            "message_count": len(state.messages),
+            "token_count": state.token_count,
+            "compressed": state.compressed_context is not None,
+            "compression_count": len(compression_history),
+            "compression_history": compression_history
+        }
+
+
+# Global instance shared by the REST views and WebSocket consumers
+_manager_instance = None
+_manager_lock = threading.Lock()
+
+def get_r2c_manager() -> R2CContextManager:
+    """Get the process-wide R2CContextManager instance."""
+    global _manager_instance
+    if _manager_instance is None:
+        with _manager_lock:
+            if _manager_instance is None:
+                _manager_instance = R2CContextManager(
+                    max_tokens=20000,
+                    compression_ratio=0.5,
+                    rho=0.5,
+                    gamma=1.0
+                )
+    return _manager_instance
@@ -0,0 +1,286 @@
+"""
+On-disk storage for the RAG index.
+Chunk text and metadata live in a SQLite database, together with an FTS5
+full-text index used for BM25 search; embeddings live in a
+.npy file that is memory-mapped read-only; the FAISS index is memory-mapped
+where the index type allows it. Index and vector files carry a generation
+number recorded in the manifest, so a new build never overwrites files that
+another process may still have mapped.
+"""
+
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import faiss
+import numpy as np
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+manifest_file = os.path.join(current_dir, 'index_manifest.json')
+chunks_db_file = os.path.join(current_dir, 'rag_chunks.sqlite3')
+
+# Version 3: SQLite chunk store and generation-numbered index/vector files
+MANIFEST_VERSION = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    file_path TEXT NOT NULL,
+    chunk_index INTEGER,
+    start_byte INTEGER,
+    end_byte INTEGER,
+    section TEXT,
+    hash TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_hash ON chunks(hash);
+"""
+
+# BM25 full-text index over chunk text, kept in step with `chunks` by triggers.
+# External content: the text itself is stored only once, in `chunks`.
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(text, content='chunks', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS chunks_fts_insert AFTER INSERT ON chunks BEGIN
+    INSERT INTO chunks_fts(rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_fts_delete AFTER DELETE ON chunks BEGIN
+    INSERT INTO chunks_fts(chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+# Characters trimmed from query terms before they are quoted for FTS5
+_TERM_STRIP = "\"'()[]{}<>,;:!?*^"
+
+_METADATA_COLUMNS = ("file_path", "chunk_index", "start_byte", "end_byte", "section")
+
+
+def generation_files(generation: int) -> Dict[str, str]:
+    """Paths of the index, vector and id files for a manifest generation."""
+    return {
+        "index": os.path.join(current_dir, f"faiss_index.{generation}.idx"),
+        "vectors": os.path.join(current_dir, f"rag_vectors.{generation}.npy"),
+        "ids": os.path.join(current_dir, f"rag_vector_ids.{generation}.npy"),
+    }
+
+
+def load_manifest() -> Optional[dict]:
+    """Return the manifest, or None if there is none."""
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest: dict) -> None:
+    """Atomically replace the manifest; this publishes a new generation."""
+    tmp_path = manifest_file + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_file)
+
+
+def read_index(path: str):
+    """Read a FAISS index, memory-mapping its vectors when supported."""
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    try:
+        return faiss.read_index(path, flags)
+    except RuntimeError as e:
+        logging.info(f"[RAG store] Cannot mmap {path} ({e}); loading into memory")
+        return faiss.read_index(path)
+
+
+def load_vectors(generation: int):
+    """
+    Open the stored embeddings of a generation.
+
+    Returns:
+        Tuple of (ids, vectors): sorted int64 ids and a read-only memory-mapped
+        float32 array with one row per id.
+    """
+    files = generation_files(generation)
+    ids = np.load(files["ids"])
+    vectors = np.load(files["vectors"], mmap_mode='r')
+    return ids, vectors
+
+
+def remove_stale_generations(current: int) -> None:
+    """
+    Delete index and vector files of every generation except `current`.
+    Files still mapped by another process (Windows refuses to delete them)
+    are left for a later sync.
+    """
+    keep = set(generation_files(current).values())
+    for pattern in ("faiss_index.*.idx", "rag_vectors.*.npy", "rag_vector_ids.*.npy"):
+        for path in glob.glob(os.path.join(current_dir, pattern)):
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.info(f"[RAG store] Could not remove {path}: {e}")
+
+
+class ChunkStore:
+    """SQLite-backed map from chunk id to {"text", "metadata", "hash"}."""
+
+    def __init__(self, db_path: Optional[str] = None, readonly: bool = True):
+        """
+        Open the store.
+
+        Args:
+            db_path: SQLite database file, chunks_db_file by default
+            readonly: Open read-only (query path) or read-write (indexer)
+        """
+        db_path = db_path or chunks_db_file
+        self.db_path = db_path
+        self.readonly = readonly
+        if readonly:
+            uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            # WAL lets readers in other processes keep querying during a sync
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(_SCHEMA)
+            self._create_fts()
+        self.has_fts = self._table_exists("chunks_fts")
+        self.lock = threading.Lock()
+
+    def _table_exists(self, name: str) -> bool:
+        row = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+        return row is not None
+
+    def _create_fts(self) -> None:
+        """Create the full-text index, filling it from existing chunks the first time."""
+        existed = self._table_exists("chunks_fts")
+        try:
+            self.conn.executescript(_FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            logging.warning(f"[RAG store] SQLite FTS5 unavailable ({e}); lexical search disabled")
+            return
+        if not existed:
+            with self.conn:
+                self.conn.execute("INSERT INTO chunks_fts(chunks_fts) VALUES ('rebuild')")
+
+    @staticmethod
+    def fts_query(text: str) -> str:
+        """
+        Turn free text into an FTS5 query matching any of its terms.
+        Each term is quoted, so identifiers like "10-K" or "Q3" are matched
+        as token sequences instead of being parsed as query syntax.
+        """
+        terms = []
+        for raw in text.split():
+            term = raw.strip(_TERM_STRIP).replace('"', '""')
+            if any(ch.isalnum() for ch in term):
+                terms.append(f'"{term}"')
+        return " OR ".join(terms)
+
+    def search_lexical(self, text: str, limit: int) -> List[int]:
+        """Ids of the chunks that best match `text` by BM25, best first."""
+        query = self.fts_query(text)
+        if not self.has_fts or not query:
+            return []
+        with self.lock:
+            try:
+                rows = self.conn.execute(
+                    "SELECT rowid FROM chunks_fts WHERE chunks_fts MATCH ? ORDER BY bm25(chunks_fts) LIMIT ?",
+                    (query, limit)
+                ).fetchall()
+            except sqlite3.OperationalError as e:
+                logging.info(f"[RAG store] Lexical search failed for {query!r}: {e}")
+                return []
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _row_to_chunk(row) -> dict:
+        return {
+            "text": row[7],
+            "hash": row[6],
+            "metadata": dict(zip(_METADATA_COLUMNS, row[1:6])),
+        }
+
+    def get_many(self, chunk_ids: Iterable[int]) -> Dict[int, dict]:
+        """Fetch several chunks in one query; unknown ids are left out."""
+        chunk_ids = [int(i) for i in chunk_ids]
+        if not chunk_ids:
+            return {}
+        placeholders = ",".join("?" * len(chunk_ids))
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, file_path, chunk_index, start_byte, end_byte, section, hash, text "
+                f"FROM chunks WHERE id IN ({placeholders})",
+                chunk_ids
+            ).fetchall()
+        return {row[0]: self._row_to_chunk(row) for row in rows}
+
+    def get(self, chunk_id: int, default=None):
+        return self.get_many([chunk_id]).get(int(chunk_id), default)
+
+    def __getitem__(self, chunk_id: int) -> dict:
+        chunk = self.get(chunk_id)
+        if chunk is None:
+            raise KeyError(chunk_id)
+        return chunk
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def ids_by_hash(self) -> Dict[str, int]:
+        """Map each stored chunk text hash to one chunk id carrying it."""
+        with self.lock:
+            return {h: i for i, h in self.conn.execute("SELECT id, hash FROM chunks")}
+
+    def ids_from(self, first_id: int) -> list:
+        """Ids at or above `first_id`."""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT id FROM chunks WHERE id >= ?", (first_id,))]
+
+    def clear(self) -> None:
+        """Delete every chunk."""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM chunks")
+
+    def write(self, upserts: Dict[int, dict], deletes: Iterable[int], commit: bool = True) -> None:
+        """
+        Insert or replace `upserts` and delete `deletes`.
+
+        Args:
+            upserts: Chunks to write, by id
+            deletes: Ids to remove
+            commit: Commit now; with False the changes stay in the open
+                transaction, invisible to readers until commit()
+        """
+        rows = [
+            (chunk_id, *(chunk["metadata"].get(col) for col in _METADATA_COLUMNS), chunk["hash"], chunk["text"])
+            for chunk_id, chunk in upserts.items()
+        ]
+        # Replaced rows are deleted first so the full-text triggers see both sides
+        deleted = [(int(i),) for i in deletes] + [(row[0],) for row in rows]
+        with self.lock:
+            try:
+                self.conn.executemany("DELETE FROM chunks WHERE id = ?", deleted)
+                self.conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            except BaseException:
+                self.conn.rollback()
+                raise
+            if commit:
+                self.conn.commit()
+
+    def commit(self) -> None:
+        with self.lock:
+            self.conn.commit()
+
+    def rollback(self) -> None:
+        with self.lock:
+            self.conn.rollback()
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,138 @@
+"""
+FAISS index construction for the RAG pipeline.
+Vectors are L2-normalized at build and query time and compared by inner
+product (cosine similarity). The index type is picked by corpus size:
+exact flat search for small corpora, HNSW for medium ones and IVF-PQ for
+large ones. RAG_INDEX_TYPE forces a specific type.
+"""
+
+import logging
+import math
+import os
+from typing import Optional
+
+import faiss
+import numpy as np
+
+INDEX_FLAT = "flat"
+INDEX_HNSW = "hnsw"
+INDEX_IVFPQ = "ivfpq"
+INDEX_TYPES = (INDEX_FLAT, INDEX_HNSW, INDEX_IVFPQ)
+
+# Corpus sizes at which approximate search starts to pay off
+HNSW_MIN_VECTORS = 20_000
+IVFPQ_MIN_VECTORS = 500_000
+
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+
+IVF_NPROBE = 16
+PQ_MAX_SUBQUANTIZERS = 64
+PQ_BITS = 8
+
+
+def normalize(vectors) -> np.ndarray:
+    """Return a float32, L2-normalized copy of `vectors` (2-D)."""
+    vectors = np.array(vectors, dtype="float32", copy=True, ndmin=2)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def choose_index_type(num_vectors: int) -> str:
+    """Pick the index type for a corpus, honouring RAG_INDEX_TYPE if set."""
+    forced = os.getenv("RAG_INDEX_TYPE", "").lower()
+    if forced in INDEX_TYPES:
+        return forced
+    if num_vectors >= IVFPQ_MIN_VECTORS:
+        return INDEX_IVFPQ
+    if num_vectors >= HNSW_MIN_VECTORS:
+        return INDEX_HNSW
+    return INDEX_FLAT
+
+
+def index_type_of(index) -> Optional[str]:
+    """Return the type of an index built by build_index, or None for anything else."""
+    if isinstance(index, faiss.IndexIDMap2):
+        inner = faiss.downcast_index(index.index)
+        if inner.metric_type != faiss.METRIC_INNER_PRODUCT:
+            return None
+        if isinstance(inner, faiss.IndexFlat):
+            return INDEX_FLAT
+        if isinstance(inner, faiss.IndexHNSW):
+            return INDEX_HNSW
+        if isinstance(inner, faiss.IndexIVFPQ):
+            return INDEX_IVFPQ
+    return None
+
+
+def supports_remove(index) -> bool:
+    """HNSW graphs cannot drop vectors; the other types can."""
+    return index_type_of(index) != INDEX_HNSW
+
+
+def _pq_subquantizers(dimension: int) -> int:
+    """Largest divisor of the dimension not above PQ_MAX_SUBQUANTIZERS."""
+    for m in range(min(PQ_MAX_SUBQUANTIZERS, dimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def build_index(vectors, ids, index_type: Optional[str] = None):
+    """
+    Build an ID-mapped inner-product index.
+
+    Args:
+        vectors: Array of shape (n, dimension); normalized here
+        ids: int64 ids, one per vector
+        index_type: One of INDEX_TYPES, or None to choose by corpus size
+
+    Returns:
+        faiss.IndexIDMap2 wrapping the chosen index
+    """
+    vectors = normalize(vectors)
+    ids = np.asarray(ids, dtype="int64")
+    num_vectors, dimension = vectors.shape
+    index_type = index_type or choose_index_type(num_vectors)
+
+    if index_type == INDEX_IVFPQ:
+        nlist = max(1, int(4 * math.sqrt(num_vectors)))
+        # k-means needs ~39 training points per centroid, PQ 256 per code
+        nlist = min(nlist, num_vectors // 39)
+        if nlist < 1 or num_vectors < 2 ** PQ_BITS:
+            logging.warning(f"[RAG index] {num_vectors} vectors is too few for IVF-PQ; using HNSW")
+            index_type = INDEX_HNSW
+
+    if index_type == INDEX_IVFPQ:
+        quantizer = faiss.IndexFlatIP(dimension)
+        inner = faiss.IndexIVFPQ(
+            quantizer, dimension, nlist, _pq_subquantizers(dimension), PQ_BITS, faiss.METRIC_INNER_PRODUCT
+        )
+        inner.train(vectors)
+        inner.nprobe = min(IVF_NPROBE, nlist)
+    elif index_type == INDEX_HNSW:
+        inner = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        inner.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        inner.hnsw.efSearch = HNSW_EF_SEARCH
+    else:
+        inner = faiss.IndexFlatIP(dimension)
+
+    # The Python wrappers keep `inner` and `quantizer` alive alongside `index`
+    index = faiss.IndexIDMap2(inner)
+    if num_vectors:
+        index.add_with_ids(vectors, ids)
+    logging.info(f"[RAG index] Built {index_type} index with {num_vectors} vectors of dimension {dimension}")
+    return index
+
+
+def configure_search(index) -> None:
+    """Apply search-time parameters (RAG_HNSW_EF_SEARCH, RAG_IVF_NPROBE) to a loaded index."""
+    index_type = index_type_of(index)
+    if index_type is None:
+        return
+    inner = faiss.downcast_index(index.index)
+    if index_type == INDEX_HNSW:
+        inner.hnsw.efSearch = int(os.getenv("RAG_HNSW_EF_SEARCH", HNSW_EF_SEARCH))
+    elif index_type == INDEX_IVFPQ:
+        inner.nprobe = min(int(os.getenv("RAG_IVF_NPROBE", IVF_NPROBE)), inner.nlist)
@@ -0,0 +1,111 @@
+"""
+Web Content Store
+Content-addressed storage for page text sent by the browser extension.
+Pages are keyed by URL and SHA-256 of their text, so sessions can hold
+references to a single shared copy and unchanged re-sends are detected.
+"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+
+class WebPage:
+    """Immutable snapshot of a page's text."""
+
+    __slots__ = ("url", "digest", "content")
+
+    def __init__(self, url: str, digest: str, content: str):
+        self.url = url
+        self.digest = digest
+        self.content = content
+
+
+def content_digest(content: str) -> str:
+    """Return the SHA-256 hex digest used to address page content."""
+    return hashlib.sha256(content.encode("utf-8", errors="replace")).hexdigest()
+
+
+class WebContentStore:
+    """Keeps the latest version of each page, sharing identical text across URLs."""
+
+    def __init__(self, max_pages: int = 256):
+        """
+        Initialize the store.
+
+        Args:
+            max_pages: Number of URLs tracked before the least recently
+                updated one is evicted. Sessions keep their own reference
+                to evicted pages.
+        """
+        self.max_pages = max_pages
+        self._pages: "OrderedDict[str, WebPage]" = OrderedDict()
+        self._blobs: Dict[str, str] = {}
+        self._blob_refs: Dict[str, int] = {}
+        self.lock = Lock()
+
+    def put(self, url: str, content: str) -> Tuple[WebPage, Optional[WebPage]]:
+        """
+        Store the current text of a page.
+
+        Args:
+            url: Page URL
+            content: Full page text
+
+        Returns:
+            Tuple of (current page, previous page for this URL or None).
+            The two are the same object when the content is unchanged.
+        """
+        digest = content_digest(content)
+        with self.lock:
+            previous = self._pages.get(url)
+            if previous is not None and previous.digest == digest:
+                self._pages.move_to_end(url)
+                return previous, previous
+
+            # Reuse an identical blob stored for another URL
+            blob = self._blobs.get(digest)
+            if blob is None:
+                blob = content
+                self._blobs[digest] = blob
+            self._blob_refs[digest] = self._blob_refs.get(digest, 0) + 1
+
+            page = WebPage(url, digest, blob)
+            self._pages[url] = page
+            self._pages.move_to_end(url)
+
+            if previous is not None:
+                self._release(previous.digest)
+            while len(self._pages) > self.max_pages:
+                _, evicted = self._pages.popitem(last=False)
+                self._release(evicted.digest)
+
+        if previous is not None:
+            logging.info(f"[WebContentStore] Page changed: {url}")
+        return page, previous
+
+    def get(self, url: str) -> Optional[WebPage]:
+        """Get the latest stored version of a page."""
+        return self._pages.get(url)
+
+    def _release(self, digest: str) -> None:
+        """Drop one reference to a blob, freeing it when unused."""
+        refs = self._blob_refs.get(digest, 0) - 1
+        if refs <= 0:
+            self._blob_refs.pop(digest, None)
+            self._blobs.pop(digest, None)
+        else:
+            self._blob_refs[digest] = refs
+
+
+# Global instance
+_store_instance = None
+
+def get_web_content_store() -> WebContentStore:
+    """Get the global WebContentStore instance."""
+    global _store_instance
+    if _store_instance is None:
+        _store_instance = WebContentStore()
+    return _store_instance
@@ -29,6 +29,10 @@ urlpatterns = [
     path('api/add_preferred_url/', views.add_preferred_url, name='add_preferred_url'),
     path('api/sync_preferred_urls/', views.sync_preferred_urls, name='sync_preferred_urls'),
     path('api/folder_path', views.folder_path, name='folder_path'),
+    path('api/folder_path_stream', views.folder_path_stream, name='folder_path_stream'),
+    path('api/rag_jobs/', views.rag_jobs, name='rag_jobs'),
+    path('api/rag_jobs/<str:job_id>/', views.rag_job_status, name='rag_job_status'),
+    path('api/rag_jobs/<str:job_id>/cancel/', views.cancel_rag_job, name='cancel_rag_job'),
     path('get_mcp_response/', views.mcp_chat_response, name='get_mcp_response'),
     path('log_question/', views.log_question, name='log_question'),
     path('api/get_r2c_stats/', views.get_r2c_stats, name='get_r2c_stats'),
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Prompt size and latency of the builtin agent's two tool-calling modes.
+"prompt" pastes the tool documentation into the system prompt and parses
+<tool_call> blocks; "native" sends structured tool schemas to the
+provider's tool-calling API.
+
+Without --live the script only counts tokens. With --live it runs one
+agent turn per mode against the configured provider and reports the time
+to the first tool call and to the end of the turn.
+
+Usage:
+    python scripts/benchmark_agent_prompt.py [--iterations 5]
+    python scripts/benchmark_agent_prompt.py --live --model o4-mini [--runs 3]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from contextlib import aclosing
+from pathlib import Path
+
+backend_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(backend_dir))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_config.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import tiktoken  # noqa: E402
+
+from api import consumers  # noqa: E402
+from api.builtin_tools import ToolCallStreamParser, builtin_tool_manager  # noqa: E402
+from api.native_tools import build_agent_prompt, make_tool_adapter  # noqa: E402
+from datascraper.models_config import MODELS_CONFIG, PROVIDER_CONFIGS  # noqa: E402
+
+QUESTION = "Open https://finance.yahoo.com/quote/AAPL and tell me the current price."
+CONTEXT = [
+    {"role": "user", "content": "What is Apple's ticker?"},
+    {"role": "assistant", "content": "Apple trades on NASDAQ as AAPL."},
+]
+
+
+def count_tokens(encoding, text):
+    return len(encoding.encode(text))
+
+
+def report_prompt_sizes(iterations):
+    encoding = tiktoken.get_encoding("cl100k_base")
+    definitions = builtin_tool_manager.get_tool_definitions()
+    schemas = json.dumps(builtin_tool_manager.get_tool_schemas())
+
+    prompt_mode = count_tokens(encoding, build_agent_prompt(QUESTION, CONTEXT, definitions))
+    native_prompt = count_tokens(encoding, build_agent_prompt(QUESTION, CONTEXT))
+    # Providers render the schemas into the model input too; this is an estimate
+    native_schemas = count_tokens(encoding, schemas)
+    native_mode = native_prompt + native_schemas
+
+    print("=== Agent prompt size (cl100k_base tokens) ===")
+    print(f"{'mode':<8} {'system':>8} {'schemas':>8} {'per turn':>9} {f'x{iterations} turns':>12}")
+    print(f"{'prompt':<8} {prompt_mode:8d} {0:8d} {prompt_mode:9d} {prompt_mode * iterations:12d}")
+    print(f"{'native':<8} {native_prompt:8d} {native_schemas:8d} {native_mode:9d} {native_mode * iterations:12d}")
+    saved = prompt_mode - native_mode
+    print(f"Saved per turn: {saved} tokens ({saved / prompt_mode:.0%})")
+
+
+async def time_prompt_mode(client, model_config):
+    """Return (seconds to first tool call or None, seconds to end of turn)."""
+    system_prompt = build_agent_prompt(QUESTION, CONTEXT, builtin_tool_manager.get_tool_definitions())
+    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": QUESTION}]
+    parser = ToolCallStreamParser()
+    start = time.perf_counter()
+    first_call = None
+    async with aclosing(consumers.stream_chat_completion(client, model_config, messages)) as stream:
+        async for content in stream:
+            for kind, _ in parser.feed(content):
+                if kind == "tool_call" and first_call is None:
+                    first_call = time.perf_counter() - start
+    return first_call, time.perf_counter() - start
+
+
+async def time_native_mode(adapter):
+    messages = adapter.initial_messages(build_agent_prompt(QUESTION, CONTEXT), QUESTION)
+    start = time.perf_counter()
+    first_call = None
+    async with aclosing(adapter.stream_turn(messages)) as stream:
+        async for kind, _ in stream:
+            if kind == "tool_call" and first_call is None:
+                first_call = time.perf_counter() - start
+    return first_call, time.perf_counter() - start
+
+
+def summarize(name, samples):
+    first_calls = [first for first, _ in samples if first is not None]
+    totals = [total for _, total in samples]
+    first = f"{statistics.median(first_calls):.2f}" if first_calls else "-"
+    print(f"{name:<8} {first:>16} {statistics.median(totals):10.2f} {len(first_calls)}/{len(samples)}")
+
+
+async def run_live(model_id, runs):
+    model_config = MODELS_CONFIG[model_id]
+    provider = model_config["provider"]
+    provider_config = PROVIDER_CONFIGS[provider]
+    api_key = os.getenv(provider_config["env_key"])
+    if not api_key:
+        sys.exit(f"{provider_config['env_key']} is not set")
+    client = consumers.get_async_client(api_key, provider_config.get("base_url"), provider)
+    adapter = make_tool_adapter(provider, client, model_config, builtin_tool_manager.get_tool_schemas())
+
+    prompt_samples, native_samples = [], []
+    for _ in range(runs):
+        if provider != "anthropic":
+            prompt_samples.append(await time_prompt_mode(client, model_config))
+        native_samples.append(await time_native_mode(adapter))
+
+    print(f"\n=== Live turn latency, {model_id}, median of {runs} (seconds) ===")
+    print(f"{'mode':<8} {'first tool call':>16} {'turn end':>10} calls")
+    if prompt_samples:
+        summarize("prompt", prompt_samples)
+    summarize("native", native_samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent tool-calling mode benchmark")
+    parser.add_argument("--iterations", type=int, default=consumers.MAX_AGENT_ITERATIONS)
+    parser.add_argument("--live", action="store_true", help="also time real model turns")
+    parser.add_argument("--model", default="o4-mini", choices=sorted(MODELS_CONFIG))
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    report_prompt_sizes(args.iterations)
+    if args.live:
+        asyncio.run(run_live(args.model, args.runs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the embedding pipeline.
+Embeds synthetic chunks with the offline LocalEmbedder (simulated request
+latency) one request per chunk, then with BatchingEmbedder.
+
+Usage:
+    python scripts/benchmark_embedding.py [--chunks 2000] [--latency 0.05] [--workers 4]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+backend_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(backend_dir))
+
+from datascraper.embedders import BatchingEmbedder, LocalEmbedder, RateLimiter  # noqa: E402
+
+WORDS = ("revenue margin growth quarter guidance filing operating cash flow "
+         "segment earnings dividend debt equity outlook risk liquidity").split()
+
+
+def make_chunks(count, words_per_chunk=300, seed=0):
+    """Synthetic chunks roughly the size of the default 512-token chunk."""
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(words_per_chunk)) for _ in range(count)]
+
+
+def run(label, embedder, texts):
+    start = time.perf_counter()
+    vectors = embedder.embed(texts)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:8.2f}s  {len(texts) / elapsed:9.1f} chunks/s")
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding throughput benchmark")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated seconds per request")
+    parser.add_argument("--per-item", type=float, default=0.0005, help="Simulated seconds per text")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rpm", type=int, default=None, help="Requests-per-minute limit")
+    args = parser.parse_args()
+
+    texts = make_chunks(args.chunks)
+    backend = LocalEmbedder(latency=args.latency, per_item_latency=args.per_item)
+
+    print("=== Embedding Throughput Benchmark ===")
+    print(f"Chunks: {args.chunks}, request latency: {args.latency}s, per-item: {args.per_item}s")
+
+    serial = BatchingEmbedder(backend, batch_size=1, max_workers=1)
+    batched = BatchingEmbedder(
+        backend,
+        batch_size=args.batch_size,
+        max_workers=args.workers,
+        rate_limiter=RateLimiter(requests_per_minute=args.rpm)
+    )
+
+    baseline = run("One request per chunk", serial, texts)
+    result = run(f"Batched x{args.batch_size}, {args.workers} workers", batched, texts)
+    assert (baseline == result).all(), "batched results differ from serial results"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for R2C session storage.
+Compares the legacy dict-per-message layout with the compact slotted records
+used by R2CContextManager, for many live sessions.
+
+Usage:
+    python scripts/benchmark_r2c_memory.py [--sessions 2000] [--messages 20]
+"""
+import argparse
+import sys
+from array import array
+import tracemalloc
+from pathlib import Path
+
+backend_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(backend_dir))
+
+from datascraper.r2c_context_manager import (  # noqa: E402
+    _Message,
+    _Session,
+    _SessionState,
+    ROLE_USER,
+    ROLE_ASSISTANT,
+)
+
+QUESTION = "What was the revenue growth and operating margin for this company last quarter?"
+ANSWER = ("Revenue grew 12% year over year while operating margin expanded to 31%, "
+          "driven by higher services mix and lower component costs.")
+
+
+def approx_tokens(text):
+    """Cheap token estimate so the benchmark runs without downloading a tokenizer."""
+    return max(1, len(text) // 4)
+
+
+def build_legacy(num_sessions, num_messages):
+    """Build sessions the way the manager stored them before compact records."""
+    sessions = {}
+    for s in range(num_sessions):
+        session = {
+            "messages": [],
+            "message_tokens": [],
+            "compressed_context": None,
+            "token_count": 0,
+            "compression_history": []
+        }
+        for i in range(num_messages):
+            if i % 2 == 0:
+                content = f"[USER QUESTION]: {QUESTION} #{s}-{i}"
+            else:
+                content = f"[ASSISTANT RESPONSE]: {ANSWER} #{s}-{i}"
+            tokens = approx_tokens(content)
+            session["messages"].append({"role": "user", "content": content})
+            session["message_tokens"].append(tokens)
+            session["token_count"] += tokens
+        sessions[f"session_{s}"] = session
+    return sessions
+
+
+def build_compact(num_sessions, num_messages):
+    """Build sessions with slotted records and array-backed token counts."""
+    sessions = {}
+    for s in range(num_sessions):
+        session = _Session()
+        messages = []
+        message_tokens = array("I")
+        for i in range(num_messages):
+            if i % 2 == 0:
+                message = _Message(ROLE_USER, f"{QUESTION} #{s}-{i}")
+            else:
+                message = _Message(ROLE_ASSISTANT, f"{ANSWER} #{s}-{i}")
+            messages.append(message)
+            message_tokens.append(approx_tokens(message.formatted))
+        session.state = _SessionState(
+            tuple(messages), message_tokens, token_count=sum(message_tokens)
+        )
+        sessions[f"session_{s}"] = session
+    return sessions
+
+
+def measure(builder, num_sessions, num_messages):
+    """Return (current_bytes, peak_bytes) allocated while building the sessions."""
+    tracemalloc.start()
+    sessions = builder(num_sessions, num_messages)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del sessions
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="R2C session memory benchmark")
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+
+    print("=== R2C Session Memory Benchmark ===")
+    print(f"Sessions: {args.sessions}, messages per session: {args.messages}")
+
+    legacy_current, legacy_peak = measure(build_legacy, args.sessions, args.messages)
+    compact_current, compact_peak = measure(build_compact, args.sessions, args.messages)
+
+    mib = 1024 * 1024
+    print(f"Legacy dict layout:   {legacy_current / mib:8.2f} MiB (peak {legacy_peak / mib:8.2f} MiB)")
+    print(f"Compact slotted:      {compact_current / mib:8.2f} MiB (peak {compact_peak / mib:8.2f} MiB)")
+    if legacy_current:
+        saved = 1 - compact_current / legacy_current
+        print(f"Reduction:            {saved:8.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Recall vs. latency benchmark for the RAG index types.
+Builds flat, HNSW and IVF-PQ indexes over synthetic clustered vectors and
+compares their top-k results with exact search.
+
+Usage:
+    python scripts/benchmark_rag_index.py [--vectors 50000] [--dim 256] [--queries 500] [--k 3]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+backend_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(backend_dir))
+
+from datascraper import vector_index  # noqa: E402
+
+
+def make_vectors(num_vectors, dimension, num_queries, seed=0):
+    """Clustered vectors, so nearest neighbours are meaningful, plus nearby queries."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, num_vectors // 100), dimension)).astype("float32")
+    assignment = rng.integers(0, len(centers), num_vectors)
+    vectors = centers[assignment] + 0.5 * rng.standard_normal((num_vectors, dimension)).astype("float32")
+    picks = rng.integers(0, num_vectors, num_queries)
+    queries = vectors[picks] + 0.3 * rng.standard_normal((num_queries, dimension)).astype("float32")
+    return vectors, vector_index.normalize(queries)
+
+
+def evaluate(index, queries, truth, k):
+    """Return (mean latency in ms per query, recall@k against `truth`)."""
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        _, ids = index.search(query[None, :], k)
+        results.append(ids[0])
+    latency = (time.perf_counter() - start) * 1000 / len(queries)
+    hits = sum(len(set(found) & set(expected)) for found, expected in zip(results, truth))
+    return latency, hits / (len(queries) * k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG index recall/latency benchmark")
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    vectors, queries = make_vectors(args.vectors, args.dim, args.queries)
+    ids = np.arange(args.vectors, dtype="int64")
+
+    print("=== RAG Index Benchmark ===")
+    print(f"Vectors: {args.vectors} x {args.dim}, queries: {args.queries}, k: {args.k}")
+    print(f"Auto-selected type: {vector_index.choose_index_type(args.vectors)}")
+    print(f"{'index':<8} {'build s':>9} {'ms/query':>9} {'recall@k':>9}")
+
+    truth = None
+    for index_type in vector_index.INDEX_TYPES:
+        start = time.perf_counter()
+        index = vector_index.build_index(vectors, ids, index_type)
+        build_time = time.perf_counter() - start
+
+        if truth is None:
+            # Flat search is exact and runs first
+            _, truth = index.search(queries, args.k)
+        latency, recall = evaluate(index, queries, truth, args.k)
+        print(f"{index_type:<8} {build_time:9.2f} {latency:9.3f} {recall:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,21 @@
 // background.js - Service Worker for FinGPT WebSocket
 
+// 导航等待页面加载完成的最长时间，之后带当前内容回执
+const NAVIGATE_LOAD_TIMEOUT_MS = 25000;
+
+// 配对码：桌面客户端填写同一个配对码后，只有它能收到本浏览器的页面并控制本浏览器
+const PAIRING_ID_KEY = 'fingptPairingId';
+
+async function getPairingId() {
+    const stored = await chrome.storage.local.get(PAIRING_ID_KEY);
+    if (stored[PAIRING_ID_KEY]) {
+        return stored[PAIRING_ID_KEY];
+    }
+    const pairingId = crypto.randomUUID().replace(/-/g, '').slice(0, 12).toUpperCase();
+    await chrome.storage.local.set({ [PAIRING_ID_KEY]: pairingId });
+    return pairingId;
+}
+
 class FinGPTBackground {
     constructor() {
         this.connectionStates = new Map(); // tabId -> connection state
@@ -32,6 +48,13 @@ class FinGPTBackground {
             this.handleTabUpdate(tabId, changeInfo, tab);
         });
 
+        // 标签页关闭后不再声明其会话
+        chrome.tabs.onRemoved.addListener((tabId) => {
+            if (this.connectionStates.delete(tabId)) {
+                this.registerSessions();
+            }
+        });
+
         // Handle browser action click - launch Electron app
         chrome.action.onClicked.addListener((tab) => {
             this.handleActionClick(tab);
@@ -104,6 +127,7 @@ class FinGPTBackground {
 
                 case 'CONNECTION_STATUS_CHANGED':
                     this.updateConnectionStatus(sender.tab.id, message.status);
+                    this.registerSessions();
                     this.notifyPopupStatusChange(sender.tab.id, message.status);
                     sendResponse({ success: true });
                     break;
@@ -322,6 +346,7 @@ class FinGPTBackground {
             this.websocket.onopen = () => {
                 console.log('Connected to FinGPT backend for browser control');
                 this.reconnectAttempts = 0;
+                this.registerSessions();
             };
 
             this.websocket.onmessage = (event) => {
@@ -356,16 +381,16 @@ class FinGPTBackground {
 
         switch (data.type) {
             case 'browser_navigate':
-                await this.executeBrowserNavigate(data.url);
+                await this.executeBrowserNavigate(data.url, data.request_id);
                 break;
             case 'browser_press_key':
-                await this.executeBrowserPressKey(data.key);
+                await this.executeBrowserPressKey(data.key, data.request_id);
                 break;
             case 'browser_type':
-                await this.executeBrowserType(data.text);
+                await this.executeBrowserType(data.text, data.request_id);
                 break;
             case 'browser_click':
-                await this.executeBrowserClick(data.selector);
+                await this.executeBrowserClick(data.selector, data.request_id);
                 break;
             case 'browser_info':
                 await this.executeBrowserInfo(data.request_id);
@@ -375,112 +400,157 @@ class FinGPTBackground {
         }
     }
 
-    async executeBrowserNavigate(url) {
+    async executeBrowserNavigate(url, requestId) {
         try {
             // 在当前活动标签页中导航到URL
             const [activeTab] = await chrome.tabs.query({ active: true, currentWindow: true });
-            if (activeTab) {
-                await chrome.tabs.update(activeTab.id, { url: url });
-                console.log(`Navigated to: ${url}`);
-
-                // 发送确认消息回后端
-                this.sendBackendResponse({
-                    type: 'browser_navigate_result',
-                    success: true,
-                    url: url,
-                    message: `Successfully navigated to ${url}`
-                });
+            if (!activeTab) {
+                throw new Error('No active tab');
             }
+
+            // 先开始监听再导航，避免错过加载完成事件
+            const loaded = this.waitForTabLoad(activeTab.id, NAVIGATE_LOAD_TIMEOUT_MS);
+            await chrome.tabs.update(activeTab.id, { url: url });
+            const completed = await loaded;
+            console.log(`Navigated to: ${url} (${completed ? 'loaded' : 'load timed out'})`);
+
+            // 页面内容随回执一起返回，后端无需再等待页面信息更新
+            const { html, ...pageInfo } = await this.getPageContent(activeTab.id);
+
+            this.sendBackendResponse({
+                type: 'browser_navigate_result',
+                request_id: requestId,
+                success: true,
+                url: url,
+                timed_out: !completed,
+                pageInfo: pageInfo,
+                message: `Successfully navigated to ${url}`
+            });
         } catch (error) {
             console.error('Failed to navigate:', error);
             this.sendBackendResponse({
                 type: 'browser_navigate_result',
+                request_id: requestId,
                 success: false,
                 error: error.message
             });
         }
     }
 
+    waitForTabLoad(tabId, timeoutMs) {
+        // 等待标签页开始加载后再完成加载；超时返回false
+        return new Promise((resolve) => {
+            let sawLoading = false;
+            const finish = (completed) => {
+                clearTimeout(timer);
+                chrome.tabs.onUpdated.removeListener(listener);
+                resolve(completed);
+            };
+            const listener = (updatedTabId, changeInfo) => {
+                if (updatedTabId !== tabId) return;
+                if (changeInfo.status === 'loading') {
+                    sawLoading = true;
+                } else if (changeInfo.status === 'complete' && sawLoading) {
+                    finish(true);
+                }
+            };
+            const timer = setTimeout(() => finish(false), timeoutMs);
+            chrome.tabs.onUpdated.addListener(listener);
+        });
+    }
 
 
-    async executeBrowserPressKey(key) {
+
+    async executeBrowserPressKey(key, requestId) {
         try {
             // 向当前活动标签页的content script发送按键命令
             const [activeTab] = await chrome.tabs.query({ active: true, currentWindow: true });
-            if (activeTab) {
-                await chrome.tabs.sendMessage(activeTab.id, {
-                    type: 'press_key',
-                    key: key
-                });
-                console.log(`Pressed key: ${key}`);
-
-                this.sendBackendResponse({
-                    type: 'browser_press_key_result',
-                    success: true,
-                    key: key,
-                    message: `Successfully pressed key: ${key}`
-                });
+            if (!activeTab) {
+                throw new Error('No active tab');
             }
+            await chrome.tabs.sendMessage(activeTab.id, {
+                type: 'press_key',
+                key: key
+            });
+            console.log(`Pressed key: ${key}`);
+
+            this.sendBackendResponse({
+                type: 'browser_press_key_result',
+                request_id: requestId,
+                success: true,
+                key: key,
+                message: `Successfully pressed key: ${key}`
+            });
         } catch (error) {
             console.error('Failed to press key:', error);
             this.sendBackendResponse({
                 type: 'browser_press_key_result',
+                request_id: requestId,
                 success: false,
                 error: error.message
             });
         }
     }
 
-    async executeBrowserType(text) {
+    async executeBrowserType(text, requestId) {
         try {
             // 向当前活动标签页的content script发送输入命令
             const [activeTab] = await chrome.tabs.query({ active: true, currentWindow: true });
-            if (activeTab) {
-                await chrome.tabs.sendMessage(activeTab.id, {
-                    type: 'type_text',
-                    text: text
-                });
-                console.log(`Typed text: ${text}`);
-
-                this.sendBackendResponse({
-                    type: 'browser_type_result',
-                    success: true,
-                    text: text,
-                    message: `Successfully typed: ${text}`
-                });
+            if (!activeTab) {
+                throw new Error('No active tab');
             }
+            await chrome.tabs.sendMessage(activeTab.id, {
+                type: 'type_text',
+                text: text
+            });
+            console.log(`Typed text: ${text}`);
+
+            this.sendBackendResponse({
+                type: 'browser_type_result',
+                request_id: requestId,
+                success: true,
+                text: text,
+                message: `Successfully typed: ${text}`
+            });
         } catch (error) {
             console.error('Failed to type text:', error);
             this.sendBackendResponse({
                 type: 'browser_type_result',
+                request_id: requestId,
                 success: false,
                 error: error.message
             });
         }
     }
 
-    async executeBrowserClick(selector) {
+    async executeBrowserClick(selector, requestId) {
         try {
             // 向当前活动标签页的content script发送点击命令
             const [activeTab] = await chrome.tabs.query({ active: true, currentWindow: true });
-            if (activeTab) {
-                await chrome.tabs.sendMessage(activeTab.id, {
-                    type: 'click_element',
-                    selector: selector
-                });
-                console.log(`Clicked element: ${selector}`);
-
-                this.sendBackendResponse({
-                    type: 'browser_click_result',
-                    success: true,
-                    selector: selector,
-                    message: `Successfully clicked element: ${selector}`
-                });
+            if (!activeTab) {
+                throw new Error('No active tab');
+            }
+            const response = await chrome.tabs.sendMessage(activeTab.id, {
+                type: 'click_element',
+                selector: selector
+            });
+            if (response && response.success === false) {
+                throw new Error(response.error || `Could not click ${selector}`);
             }
+            console.log(`Clicked element: ${selector}`);
+
+            this.sendBackendResponse({
+                type: 'browser_click_result',
+                request_id: requestId,
+                success: true,
+                selector: selector,
+                message: `Successfully clicked element: ${selector}`
+            });
         } catch (error) {
             console.error('Failed to click element:', error);
             this.sendBackendResponse({
                 type: 'browser_click_result',
+                request_id: requestId,
                 success: false,
                 error: error.message
             });
@@ -517,6 +587,18 @@ class FinGPTBackground {
         }
     }
 
+    // 向后端声明本浏览器各标签页的会话，命令按会话直接发给本连接
+    async registerSessions() {
+        const sessionIds = [...this.connectionStates.values()]
+            .map(state => state.sessionId)
+            .filter(Boolean);
+        this.sendBackendResponse({
+            type: 'register',
+            session_ids: sessionIds,
+            pairing_id: await getPairingId()
+        });
+    }
+
     sendBackendResponse(data) {
         if (this.websocket && this.websocket.readyState === WebSocket.OPEN) {
             this.websocket.send(JSON.stringify(data));
@@ -1,11 +1,38 @@
 // content.js - WebSocket Content Script for FinGPT
+
+// 页面更新超过该字节数时以deflate压缩的二进制帧发送
+const PAGE_COMPRESS_MIN_BYTES = 1024;
+
+// 页面未变化时每隔该时间发送一次 page_touch，使后端缓存的后台页面不过期（需小于后端的 DEFAULT_BACKGROUND_TTL）
+const PAGE_TOUCH_INTERVAL = 60000;
+
+// CRC-32查找表，用于页面内容哈希（后端以zlib.crc32校验）
+const CRC32_TABLE = (() => {
+    const table = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+        }
+        table[n] = c >>> 0;
+    }
+    return table;
+})();
+
 class FinGPTContentScript {
     constructor() {
         this.ws = null;
         this.sessionId = `session_${Date.now()}_${Math.random().toString(36).substr(2, 9)}`;
         this.isConnected = false;
         this.currentUrl = window.location.href;
-        this.lastContent = '';
+        // 上次发送给后端的页面内容，增量更新以它为基准
+        this.sentText = null;
+        this.sentLines = null;
+        this.sentHash = null;
+        this.sentState = null;
+        this.sentAt = 0;
+        this.sendChain = Promise.resolve();
+        this.textEncoder = new TextEncoder();
 
         this.init();
     }
@@ -33,6 +60,8 @@ class FinGPTContentScript {
             this.ws.onopen = () => {
                 console.log('Page info WebSocket connected');
                 this.isConnected = true;
+                // 新连接没有基准内容，下次发送完整内容
+                this.resetSentPage();
                 this.reportConnectionStatus();
             };
 
@@ -69,6 +98,10 @@ class FinGPTContentScript {
             console.log('Content Script: Received page info request, sending response...');
             // 响应页面信息请求
             this.sendCurrentPageInfo();
+        } else if (data.type === 'page_resync') {
+            // 后端的基准内容与本地不一致，重新发送完整内容
+            this.resetSentPage();
+            this.sendPageUpdate();
         } else {
             console.log('Content Script: Unknown message type:', data.type);
         }
@@ -112,67 +145,136 @@ class FinGPTContentScript {
         console.log('Started periodic page updates (30s interval)');
     }
 
-    sendPageUpdate() {
+    sendPageUpdate(content = null) {
         if (!this.isConnected || !this.ws || this.ws.readyState !== WebSocket.OPEN) {
             return;
         }
 
+        const textContent = content || document.body.innerText || '';
+
         // 确保使用最新的URL
         this.currentUrl = window.location.href;
 
-        const textContent = document.body.innerText || '';
-        const pageTitle = document.title || '';
-        const isActive = !document.hidden;
+        const state = {
+            url: this.currentUrl,
+            title: document.title || '',
+            // 检测是否为活跃页面（当前标签页是否可见）
+            is_active: !document.hidden
+        };
+        const stateChanged = !this.sentState || Object.keys(state).some(key => state[key] !== this.sentState[key]);
+
+        // 内容和状态都未变化时不发送，只定期告知后端页面仍然有效
+        if (textContent === this.sentText && !stateChanged) {
+            if (Date.now() - this.sentAt >= PAGE_TOUCH_INTERVAL) {
+                this.sentAt = Date.now();
+                this.sendPageMessage({
+                    type: 'page_touch',
+                    url: this.currentUrl,
+                    session_id: this.sessionId,
+                    hash: this.sentHash
+                });
+            }
+            return;
+        }
 
+        const lines = textContent.split('\n');
+        const hash = textContent === this.sentText ? this.sentHash : this.pageTextHash(textContent);
         const message = {
-            type: 'page_update',
-            url: this.currentUrl,
-            content: textContent,
-            title: pageTitle,
+            type: 'page_delta',
+            ...state,
             session_id: this.sessionId,
             timestamp: Date.now(),
-            is_active: isActive
+            base: this.sentHash,
+            hash: hash
         };
+        if (this.sentText === null) {
+            message.content = textContent;
+        } else {
+            // 只发送相对上次内容变化的行
+            message.ops = this.diffPageLines(this.sentLines, lines);
+        }
 
-        this.ws.send(JSON.stringify(message));
-        console.log(`Periodic update sent: ${pageTitle} (${isActive ? 'active' : 'background'}) - URL: ${this.currentUrl}`);
+        this.sentText = textContent;
+        this.sentLines = lines;
+        this.sentHash = hash;
+        this.sentState = state;
+        this.sentAt = Date.now();
+        this.sendPageMessage(message);
+        console.log(`Page info sent to WebSocket (${state.is_active ? 'active' : 'background'}): ${state.title} - URL: ${state.url}`);
     }
 
-    sendPageUpdate(content = null) {
-        if (!this.isConnected || !this.ws || this.ws.readyState !== WebSocket.OPEN) {
-            return;
-        }
-
-        const textContent = content || document.body.innerText || '';
+    resetSentPage() {
+        this.sentText = null;
+        this.sentLines = null;
+        this.sentHash = null;
+        this.sentState = null;
+        this.sentAt = 0;
+    }
 
-        // Only send if content has changed significantly
-        if (textContent === this.lastContent) {
-            return;
+    // 页面文本哈希：UTF-8字节的CRC-32与字节长度，与后端 page_text_hash() 一致
+    pageTextHash(text) {
+        const bytes = this.textEncoder.encode(text);
+        let crc = 0xffffffff;
+        for (let i = 0; i < bytes.length; i++) {
+            crc = CRC32_TABLE[(crc ^ bytes[i]) & 0xff] ^ (crc >>> 8);
         }
+        return `${((crc ^ 0xffffffff) >>> 0).toString(16).padStart(8, '0')}:${bytes.length}`;
+    }
 
-        this.lastContent = textContent;
-
-        // 获取页面标题
-        const pageTitle = document.title || '';
-
-        // 确保使用最新的URL
-        this.currentUrl = window.location.href;
-
-        // 检测是否为活跃页面（当前标签页是否可见）
-        const isActive = !document.hidden;
+    // 按行比较，返回 [起始行, 结束行, 替换的行] 列表，行号基于上次发送的内容
+    diffPageLines(baseLines, lines) {
+        if (baseLines.length === lines.length) {
+            // 行数不变（如行情数字刷新）：逐行比较，每段连续变化的行一个修改
+            const ops = [];
+            let i = 0;
+            while (i < lines.length) {
+                if (baseLines[i] === lines[i]) {
+                    i++;
+                    continue;
+                }
+                const start = i;
+                while (i < lines.length && baseLines[i] !== lines[i]) {
+                    i++;
+                }
+                ops.push([start, i, lines.slice(start, i)]);
+            }
+            return ops;
+        }
 
-        const message = {
-            type: 'page_update',
-            url: this.currentUrl,
-            content: textContent,
-            title: pageTitle,
-            session_id: this.sessionId,
-            timestamp: Date.now(),
-            is_active: isActive
-        };
+        // 行数变化：替换公共前缀与公共后缀之间的部分
+        const shorter = Math.min(baseLines.length, lines.length);
+        let prefix = 0;
+        while (prefix < shorter && baseLines[prefix] === lines[prefix]) {
+            prefix++;
+        }
+        let suffix = 0;
+        while (suffix < shorter - prefix &&
+               baseLines[baseLines.length - 1 - suffix] === lines[lines.length - 1 - suffix]) {
+            suffix++;
+        }
+        return [[prefix, baseLines.length - suffix, lines.slice(prefix, lines.length - suffix)]];
+    }
 
-        this.ws.send(JSON.stringify(message));
-        console.log(`Page info sent to WebSocket (${isActive ? 'active' : 'background'}): ${pageTitle} - URL: ${this.currentUrl}`);
+    sendPageMessage(message) {
+        // 按顺序发送，后端依次在上一条的基础上重建
+        const json = JSON.stringify(message);
+        this.sendChain = this.sendChain
+            .then(async () => {
+                let payload = json;
+                if (json.length >= PAGE_COMPRESS_MIN_BYTES && typeof CompressionStream !== 'undefined') {
+                    const stream = new Blob([json]).stream().pipeThrough(new CompressionStream('deflate'));
+                    payload = await new Response(stream).arrayBuffer();
+                }
+                if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+                    this.ws.send(payload);
+                } else {
+                    this.resetSentPage();
+                }
+            })
+            .catch(error => {
+                console.error('Failed to send page update:', error);
+                this.resetSentPage();
+            });
     }
 
     sendInitialPageInfo() {
@@ -349,8 +451,11 @@ class FinGPTContentScript {
                     sendResponse({ success: true });
                     break;
                 case 'click_element':
-                    this.handleClickElement(message.selector);
-                    sendResponse({ success: true });
+                    if (this.handleClickElement(message.selector)) {
+                        sendResponse({ success: true });
+                    } else {
+                        sendResponse({ success: false, error: `Element not found: ${message.selector}` });
+                    }
                     break;
                 case 'get_page_info':
                     const pageInfo = this.getPageInfo();
@@ -472,12 +577,13 @@ class FinGPTContentScript {
                 element.click();
 
                 console.log(`Clicked element with selector: ${selector}`);
-            } else {
-                console.warn(`Element not found with selector: ${selector}`);
+                return true;
             }
+            console.warn(`Element not found with selector: ${selector}`);
         } catch (error) {
             console.error('Error clicking element:', error);
         }
+        return false;
     }
 
     // 获取当前页面信息
@@ -215,25 +215,39 @@ function createSettingsWindow(isFixedModeRef, settingsIcon, positionModeIcon) {
             const filesData = await Promise.all(filesPromises);
             console.log("filesdata: ", filesData);
             
-            // Create a FormData object
-            const formData = new FormData();
+            // One JSON object per line, so the backend can index files as they arrive
+            const ndjsonBlob = new Blob(filesData.map(file => JSON.stringify(file) + "\n"),
+                            { type: 'application/x-ndjson' });
 
-            // Convert your data to a JSON string and add it as a file
-            const jsonBlob = new Blob([JSON.stringify({ 'filePaths': filesData })], 
-                            { type: 'application/json' });
-            formData.append('json_data', jsonBlob, 'data.json');
-
-            // Making the POST request to Flask
-            fetch('http://127.0.0.1:8000/api/folder_path', {
+            // The response streams NDJSON progress events, then "done" or "error"
+            fetch('http://127.0.0.1:8000/api/folder_path_stream', {
                 method: 'POST',
-                body: formData
+                headers: { 'Content-Type': 'application/x-ndjson' },
+                body: ndjsonBlob
             })
-            .then(response => response.json())
-            .then(data => {
-                if (data.message) {
-                    console.log("Success:", data.message);
-                } else if (data.error) {
-                    console.error("Error:", data.error);
+            .then(async response => {
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split("\n");
+                    buffer = lines.pop();
+                    for (const line of lines) {
+                        if (!line.trim()) continue;
+                        const event = JSON.parse(line);
+                        if (event.type === 'progress') {
+                            console.log(`[RAG] Indexed ${event.file}`, event);
+                        } else if (event.type === 'done') {
+                            console.log("Success:", event.stats);
+                        } else if (event.type === 'cancelled') {
+                            console.warn("[RAG] Indexing cancelled; the previous index is kept");
+                        } else if (event.type === 'error') {
+                            console.error("Error:", event.error);
+                        }
+                    }
                 }
             })
             .catch(error => {
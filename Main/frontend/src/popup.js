@@ -17,6 +17,9 @@ class FinGPTPopup {
         
         // Load initial status
         await this.loadConnectionStatus();
+
+        // 桌面客户端需要填写的配对码（由background生成）
+        await this.loadPairingId();
         
         // Setup message listener for status updates
         this.setupMessageListener();
@@ -72,6 +75,11 @@ class FinGPTPopup {
         }
     }
 
+    async loadPairingId() {
+        const stored = await chrome.storage.local.get('fingptPairingId');
+        document.getElementById('pairingId').textContent = stored.fingptPairingId || '-';
+    }
+
     async toggleConnection() {
         try {
             if (!this.currentTab || !this.currentTab.id) {